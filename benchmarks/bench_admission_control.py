@@ -0,0 +1,86 @@
+#!/usr/bin/env python3
+"""
+Interactive latency under subagent bursts, with and without admission control
+
+Simulates one model server whose per-stream decode speed drops as it takes more
+concurrent streams (each extra stream adds a fraction of the single-stream token
+time). Interactive turns arrive steadily while bursts of background subagent
+requests land on top. Requests go through BackendPool.acquire_backend, either
+unlimited (everything forwarded at once) or with backend_max_concurrency and the
+priority queue. Reports end-to-end latency per priority.
+
+Usage:
+    python benchmarks/bench_admission_control.py [max_concurrency] [bursts] [burst_size]
+"""
+import sys
+import os
+import asyncio
+import logging
+import random
+import time
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import call_patch_proxy
+from call_patch_proxy import BackendPool
+
+TOKEN_TIME = 0.001         # Seconds per token for a single stream
+BATCH_PENALTY = 0.35       # Extra per-token time for each other concurrent stream
+INTERACTIVE_TOKENS = 150
+BACKGROUND_TOKENS = 600
+
+
+async def generate(backend, tokens: int):
+    for _ in range(0, tokens, 25):
+        await asyncio.sleep(25 * TOKEN_TIME * (1 + BATCH_PENALTY * (backend.outstanding - 1)))
+
+
+async def run(max_concurrency: int, bursts: int, burst_size: int):
+    call_patch_proxy.fix_engine.settings.update({
+        'backend_max_concurrency': max_concurrency, 'max_queue_size': 0, 'queue_timeout': 300,
+        'slot_aware_routing': False,
+    })
+    pool = BackendPool()
+    pool.configure(['http://model'])
+    latencies = {'interactive': [], 'background': []}
+    rng = random.Random(11)
+
+    async def one_request(priority: str, tokens: int):
+        started = time.perf_counter()
+        backend = await pool.acquire_backend(priority=priority)
+        try:
+            await generate(backend, tokens)
+        finally:
+            pool.release(backend)
+        latencies[priority].append(time.perf_counter() - started)
+
+    tasks = []
+    for _ in range(bursts):
+        tasks += [asyncio.ensure_future(one_request('background', BACKGROUND_TOKENS)) for _ in range(burst_size)]
+        for _ in range(4):
+            tasks.append(asyncio.ensure_future(one_request('interactive', INTERACTIVE_TOKENS)))
+            await asyncio.sleep(rng.uniform(0.1, 0.3))
+    await asyncio.gather(*tasks)
+
+    result = {}
+    for priority, values in latencies.items():
+        values.sort()
+        result[priority] = (sum(values) / len(values), values[int(len(values) * 0.95)])
+    return result
+
+
+def main():
+    max_concurrency = int(sys.argv[1]) if len(sys.argv) > 1 else 4
+    bursts = int(sys.argv[2]) if len(sys.argv) > 2 else 5
+    burst_size = int(sys.argv[3]) if len(sys.argv) > 3 else 8
+    logging.disable(logging.INFO)
+
+    print(f"{bursts} bursts of {burst_size} subagent requests, 4 interactive turns per burst")
+    for label, limit in (("unlimited", 0), (f"limit {max_concurrency} + priority", max_concurrency)):
+        result = asyncio.run(run(limit, bursts, burst_size))
+        line = "  ".join(f"{priority} mean {mean:5.2f}s p95 {p95:5.2f}s"
+                         for priority, (mean, p95) in result.items())
+        print(f"  {label:22} {line}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,106 @@
+#!/usr/bin/env python3
+"""
+Compare per-request cleanup tasks with the process-wide expiry scheduler
+
+Keeps N concurrent request states with B open tool buffers each for a few seconds
+and measures CPU time, asyncio tasks and wakeups for:
+  - the previous design: one periodic_cleanup task per request, waking every
+    buffer_timeout // 3 seconds and checking every buffer with datetime.now()
+  - ExpiryScheduler: one task sleeping until the earliest deadline
+
+Usage:
+    python benchmarks/bench_expiry.py [requests] [buffers_per_request] [seconds]
+"""
+import sys
+import os
+import asyncio
+import logging
+import time
+from datetime import datetime, timedelta
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import call_patch_proxy
+from call_patch_proxy import ExpiryScheduler, RequestState, ToolBuffer, request_states
+
+BUFFER_TIMEOUT = 3
+
+
+async def previous_cleanup(request_id: str, counters: dict):
+    """The removed periodic_cleanup/cleanup_expired_buffers pair"""
+    while request_id in request_states:
+        await asyncio.sleep(BUFFER_TIMEOUT // 3)
+        counters['wakeups'] += 1
+        state = request_states.get(request_id)
+        if state is None:
+            break
+        expired = [key for key, buffer in state.tool_buffers.items()
+                   if datetime.now() - buffer.last_updated > timedelta(seconds=BUFFER_TIMEOUT)]
+        for key in expired:
+            del state.tool_buffers[key]
+
+
+def populate(requests: int, buffers: int):
+    states = []
+    for r in range(requests):
+        state = RequestState(request_id=f"bench-{r}")
+        request_states[state.request_id] = state
+        for b in range(buffers):
+            state.add_buffer(f"index:0:{b}", ToolBuffer(call_id=f"index:0:{b}"))
+        states.append(state)
+    return states
+
+
+async def run_previous(requests: int, buffers: int, seconds: float):
+    counters = {'wakeups': 0}
+    populate(requests, buffers)
+    cpu = time.process_time()
+    tasks = [asyncio.create_task(previous_cleanup(f"bench-{r}", counters)) for r in range(requests)]
+    await asyncio.sleep(seconds)
+    cpu = time.process_time() - cpu
+    request_states.clear()
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+    return cpu, len(tasks), counters['wakeups']
+
+
+async def run_scheduler(requests: int, buffers: int, seconds: float):
+    scheduler = ExpiryScheduler()
+    call_patch_proxy.expiry_scheduler = scheduler
+    scheduler.start()
+    populate(requests, buffers)
+    wakeups = 0
+    original_expire = scheduler.expire_due
+
+    def counting_expire(now):
+        nonlocal wakeups
+        wakeups += 1
+        original_expire(now)
+    scheduler.expire_due = counting_expire
+
+    cpu = time.process_time()
+    await asyncio.sleep(seconds)
+    cpu = time.process_time() - cpu
+    evicted = scheduler.buffers_evicted
+    request_states.clear()
+    await scheduler.close()
+    return cpu, 1, wakeups, evicted
+
+
+def main():
+    requests = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+    buffers = int(sys.argv[2]) if len(sys.argv) > 2 else 4
+    seconds = float(sys.argv[3]) if len(sys.argv) > 3 else 3.5
+    call_patch_proxy.logger.setLevel(logging.ERROR)
+    call_patch_proxy.fix_engine.settings['buffer_timeout'] = BUFFER_TIMEOUT
+
+    print(f"{requests} requests x {buffers} buffers, buffer_timeout {BUFFER_TIMEOUT}s, {seconds}s window")
+    cpu, tasks, wakeups = asyncio.run(run_previous(requests, buffers, seconds))
+    print(f"  per-request tasks: {tasks:5d} tasks  {wakeups:6d} wakeups  {cpu * 1000:8.1f} ms CPU")
+    cpu, tasks, wakeups, evicted = asyncio.run(run_scheduler(requests, buffers, seconds))
+    print(f"  expiry scheduler:  {tasks:5d} task   {wakeups:6d} wakeups  {cpu * 1000:8.1f} ms CPU"
+          f"  ({evicted} buffers evicted)")
+
+
+if __name__ == "__main__":
+    main()
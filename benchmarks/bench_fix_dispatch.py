@@ -0,0 +1,200 @@
+#!/usr/bin/env python3
+"""
+Benchmark compiled fix dispatch against the previous interpreted rule walk
+
+Runs the tool call scenarios from the test suite (string todos, missing bash
+description, string replaceAll, read with content, glob without path, plus
+tools without rules) through:
+  - the previous path: loads -> nested config lookups + if/elif rule walk -> dumps
+  - get_fixed_arguments(), which uses the compiled tables and skips the JSON
+    round trip for tools that have no rules
+
+Each timing is the best of REPEATS runs, since single runs of a few microseconds
+per call are dominated by noise. The compiled numbers also include the metrics
+counter for applied fixes and the coroutine call, which the previous path did not have.
+
+Usage:
+    python benchmarks/bench_fix_dispatch.py [iterations]
+"""
+import sys
+import os
+import asyncio
+import json
+import logging
+import time
+from typing import Any, Dict
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import call_patch_proxy
+from call_patch_proxy import (ToolBuffer, ToolFixEngine, fix_engine, json_codec, get_fixed_arguments,
+                              logger, console_logger)
+
+SCENARIOS = [
+    ("todowrite", {"todos": json.dumps([{"content": "Test task", "status": "pending", "priority": "high", "id": "1"}])}),
+    ("bash", {"command": "ls -la"}),
+    ("edit", {"filePath": "/tmp/a.py", "oldString": "a", "newString": "b", "replaceAll": "true"}),
+    ("read", {"filePath": "/tmp/a.py", "content": "new file"}),
+    ("glob", {"pattern": "**/*.py"}),
+    ("write", {"filePath": "/tmp/out.py", "content": "print('hello')\n" * 200}),
+    ("webfetch", {"url": "https://example.com", "prompt": "Summarize"}),
+    ("list", {"path": "."}),
+]
+REPEATS = 5
+
+
+class InterpretedFixEngine(ToolFixEngine):
+    """The previous per-call rule walk, kept verbatim as the baseline"""
+
+    def apply_fixes(self, tool_name: str, args_obj: Dict[str, Any], request_id: str) -> tuple[str, Dict[str, Any]]:
+        """Apply configured fixes to tool arguments. Returns (possibly_changed_tool_name, fixed_args)"""
+        if not self.settings.get('case_sensitive_tools', False):
+            tool_name = tool_name.lower()
+        
+        tool_config = self.config.get('tools', {}).get(tool_name, {})
+        fixes = tool_config.get('fixes', [])
+        
+        if not fixes:
+            logger.debug(f"[{request_id}] No fixes configured for tool: {tool_name}")
+            return tool_name, args_obj
+        
+        result = args_obj.copy()
+        applied_fixes = []
+        final_tool_name = tool_name
+        
+        for fix in fixes:
+            result_or_tuple = self._apply_single_fix(result, fix, request_id)
+            if isinstance(result_or_tuple, tuple):
+                # Tool conversion happened
+                final_tool_name, applied = result_or_tuple
+                if applied:
+                    applied_fixes.append(fix['name'])
+            elif result_or_tuple:
+                applied_fixes.append(fix['name'])
+        
+        if applied_fixes:
+            if final_tool_name != tool_name:
+                console_logger.info(f"[{request_id}] 🔄 Converted {tool_name}→{final_tool_name}: {', '.join(applied_fixes)}")
+            else:
+                console_logger.info(f"[{request_id}] 🔧 Fixed {tool_name}: {', '.join(applied_fixes)}")
+            logger.info(f"[{request_id}] Applied fixes to {tool_name}: {applied_fixes}")
+        
+        return final_tool_name, result
+    
+    def _apply_single_fix(self, args_obj: Dict[str, Any], fix: Dict[str, Any], request_id: str):
+        """Apply a single fix rule. Returns bool or (new_tool_name, bool) for tool conversions"""
+        param = fix['parameter']
+        condition = fix['condition']
+        action = fix['action']
+        
+        # Check condition
+        if not self._check_condition(args_obj, param, condition, fix):
+            return False
+        
+        # Apply action
+        try:
+            if action == 'parse_json_array':
+                if isinstance(args_obj.get(param), str):
+                    try:
+                        args_obj[param] = json_codec.loads(args_obj[param])
+                    except json.JSONDecodeError:
+                        # Try to fix common JSON issues like single quotes
+                        fixed_json = self._fix_malformed_json(args_obj[param])
+                        args_obj[param] = json_codec.loads(fixed_json)
+                        console_logger.info(f"[{request_id}] 🔧 Fixed malformed JSON for {param}")
+                        logger.debug(f"[{request_id}] Fixed malformed JSON for {param}: {str(args_obj[param])[:100]}...")
+            elif action == 'set_default':
+                args_obj[param] = fix['default_value']
+            elif action == 'parse_json_object':
+                if isinstance(args_obj.get(param), str):
+                    args_obj[param] = json_codec.loads(args_obj[param])
+            elif action == 'convert_string_to_boolean':
+                if isinstance(args_obj.get(param), str):
+                    value = args_obj[param].lower().strip()
+                    args_obj[param] = value in ('true', '1', 'yes', 'on')
+            elif action == 'remove_parameter':
+                if param in args_obj:
+                    del args_obj[param]
+            elif action == 'convert_tool_to_write':
+                # Convert read+content to write tool call
+                if 'filePath' in args_obj and 'content' in args_obj:
+                    # Keep both filePath and content for write tool
+                    return ('write', True)
+                else:
+                    logger.warning(f"[{request_id}] Cannot convert to write: missing filePath or content")
+                    return False
+            return True
+        except Exception as e:
+            logger.warning(f"[{request_id}] Fix {fix['name']} failed: {e}")
+            # Use fallback if available
+            if 'fallback_value' in fix:
+                args_obj[param] = fix['fallback_value']
+                return True
+        return False
+    
+    def _check_condition(self, args_obj: Dict[str, Any], param: str, condition: str, fix: Dict[str, Any]) -> bool:
+        """Check if condition is met for applying fix"""
+        value = args_obj.get(param)
+        
+        if condition == 'is_string':
+            return isinstance(value, str)
+        elif condition == 'missing_or_empty':
+            return not value
+        elif condition == 'missing':
+            return param not in args_obj
+        elif condition == 'exists':
+            return param in args_obj
+        elif condition == 'invalid_enum':
+            valid_values = fix.get('valid_values', [])
+            return value not in valid_values
+        
+        return False
+
+
+def bench_legacy(engine, buffers, iterations):
+    start = time.perf_counter()
+    for _ in range(iterations):
+        for buffer in buffers:
+            args_obj = json_codec.loads(buffer.content)
+            _, args_obj = engine.apply_fixes(buffer.tool_name, args_obj, "bench")
+            json_codec.dumps(args_obj)
+    return time.perf_counter() - start
+
+
+async def bench_compiled(buffers, iterations):
+    start = time.perf_counter()
+    for _ in range(iterations):
+        for buffer in buffers:
+            await get_fixed_arguments(buffer, "bench")
+    return time.perf_counter() - start
+
+
+def best_of(run, *args):
+    return min(run(*args) for _ in range(REPEATS))
+
+
+def main():
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    call_patch_proxy.logger.setLevel(logging.WARNING)
+    call_patch_proxy.console_logger.setLevel(logging.WARNING)
+    interpreted = InterpretedFixEngine(call_patch_proxy.CONFIG_FILE)
+
+    print(f"Scenarios: {len(SCENARIOS)} tool calls x {iterations} iterations "
+          f"(JSON backend: {json_codec.backend})")
+    for tool_name, args in SCENARIOS:
+        buffers = [ToolBuffer(call_id="bench", content=json.dumps(args), tool_name=tool_name)]
+        legacy_time = best_of(bench_legacy, interpreted, buffers, iterations)
+        compiled_time = best_of(lambda: asyncio.run(bench_compiled(buffers, iterations)))
+        rules = len(fix_engine.get_fixes(tool_name))
+        print(f"  {tool_name:10s} ({rules} rule(s)): previous {legacy_time / iterations * 1e6:7.2f} µs"
+              f"  compiled {compiled_time / iterations * 1e6:7.2f} µs"
+              f"  ({legacy_time / compiled_time:5.1f}x)")
+
+    buffers = [ToolBuffer(call_id="bench", content=json.dumps(args), tool_name=name) for name, args in SCENARIOS]
+    legacy_time = best_of(bench_legacy, interpreted, buffers, iterations)
+    compiled_time = best_of(lambda: asyncio.run(bench_compiled(buffers, iterations)))
+    print(f"  all scenarios: previous {legacy_time:.3f} s  compiled {compiled_time:.3f} s"
+          f"  speedup {legacy_time / compiled_time:.1f}x")
+
+
+if __name__ == "__main__":
+    main()
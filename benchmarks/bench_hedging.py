@@ -0,0 +1,100 @@
+#!/usr/bin/env python3
+"""
+Time-to-first-token with and without hedged requests
+
+Two mock replicas sit behind the proxy. One of them stalls on a fraction of its
+requests before the first chunk, like a replica stuck on a long prefill. Streaming
+requests are sent one at a time through the proxy. The time to the first streamed
+byte at the client is reported with hedging off, with a fixed 0.2s threshold and
+with the p95-derived threshold, along with the number of duplicates sent.
+
+Usage:
+    python benchmarks/bench_hedging.py [requests] [stall_rate] [stall_seconds]
+"""
+import sys
+import os
+import asyncio
+import logging
+import random
+import time
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'tests'))
+
+from aiohttp import web
+from aiohttp.test_utils import TestServer, TestClient
+
+import call_patch_proxy
+from call_patch_proxy import Histogram, backend_pool, handle_request, proxy_metrics, upstream_pool_ctx
+from mock_backends import MockBackend
+
+BASE_TTFT = 0.05
+
+
+class StallingBackend(MockBackend):
+    """Mock replica whose prefill stalls on a random fraction of requests"""
+
+    def __init__(self, name: str, stall_rate: float, stall_seconds: float, seed: int):
+        super().__init__(name, chunks=3, first_delay=BASE_TTFT)
+        self.stall_rate = stall_rate
+        self.stall_seconds = stall_seconds
+        self.rng = random.Random(seed)
+
+    async def completion(self, request: web.Request):
+        stalled = self.rng.random() < self.stall_rate
+        self.first_delay = self.stall_seconds if stalled else BASE_TTFT
+        return await super().completion(request)
+
+
+async def run(hedging: bool, hedge_after, requests: int, stall_rate: float, stall_seconds: float):
+    call_patch_proxy.fix_engine.settings.update({'hedging': hedging, 'hedge_after': hedge_after,
+                                                 'hedge_min_delay': 0.1})
+    # Start each run without TTFT history, so the p95 threshold is learned from this run
+    ttfb = proxy_metrics.backend_ttfb
+    proxy_metrics.backend_ttfb = Histogram(ttfb.name, ttfb.help, ttfb.buckets)
+    flaky = await StallingBackend("flaky", stall_rate, stall_seconds, seed=5).start()
+    steady = await StallingBackend("steady", 0.0, 0.0, seed=6).start()
+    backend_pool.configure([flaky.url, steady.url])
+    app = web.Application()
+    app.cleanup_ctx.append(upstream_pool_ctx)
+    app.router.add_route("*", "/{tail:.*}", handle_request)
+    client = TestClient(TestServer(app))
+    await client.start_server()
+    sent = proxy_metrics.hedges_sent
+
+    ttfts = []
+    for _ in range(requests):
+        started = time.perf_counter()
+        resp = await client.post('/v1/chat/completions', json={"model": "bench", "stream": True})
+        await resp.content.readline()
+        ttfts.append(time.perf_counter() - started)
+        await resp.read()
+
+    await client.close()
+    await flaky.close()
+    await steady.close()
+    ttfts.sort()
+    return {
+        'mean': sum(ttfts) / len(ttfts),
+        'p95': ttfts[int(len(ttfts) * 0.95)],
+        'p99': ttfts[min(int(len(ttfts) * 0.99), len(ttfts) - 1)],
+        'hedges': proxy_metrics.hedges_sent - sent,
+    }
+
+
+def main():
+    requests = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    stall_rate = float(sys.argv[2]) if len(sys.argv) > 2 else 0.1
+    stall_seconds = float(sys.argv[3]) if len(sys.argv) > 3 else 1.0
+    logging.disable(logging.INFO)
+
+    print(f"{requests} streaming requests, one of two replicas stalls {stall_rate:.0%} of the time "
+          f"for {stall_seconds}s (normal TTFT {BASE_TTFT * 1000:.0f}ms)")
+    for label, hedging, hedge_after in (("no hedging", False, 0.2), ("hedge after 0.2s", True, 0.2),
+                                        ("hedge after p95", True, 'p95')):
+        result = asyncio.run(run(hedging, hedge_after, requests, stall_rate, stall_seconds))
+        print(f"  {label:17} TTFT mean {result['mean'] * 1000:6.1f}ms  p95 {result['p95'] * 1000:6.1f}ms  "
+              f"p99 {result['p99'] * 1000:6.1f}ms  duplicates {result['hedges']}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,74 @@
+#!/usr/bin/env python3
+"""
+Benchmark JSON codec backends on a Qwen3-style SSE stream
+
+Each event is decoded from the raw data: payload and re-encoded to bytes, which
+is what the proxy does for every event that needs rewriting. The "stdlib (str)"
+row is the previous decode -> json.loads -> json.dumps -> encode round trip.
+
+Usage:
+    python benchmarks/bench_json_codec.py [events]
+"""
+import sys
+import os
+import json
+import time
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import call_patch_proxy
+from call_patch_proxy import JSONCodec
+
+CONTENT = ["Let", " me", " update", " the", " README", " — ", "добавлю", " пример", " 🚀", "\n"]
+ARG_FRAGMENTS = ['{"filePath": "/src/app.py", ', '"content": "def main():\\n', '    print(\\"héllo\\")\\n', '"}']
+
+
+def build_payloads(count: int):
+    payloads = []
+    for i in range(count):
+        if i % 5 == 4:
+            delta = {"tool_calls": [{"index": 0, "function": {"arguments": ARG_FRAGMENTS[i % len(ARG_FRAGMENTS)]}}]}
+        else:
+            delta = {"content": CONTENT[i % len(CONTENT)]}
+        event = {
+            "id": "chatcmpl-bench", "object": "chat.completion.chunk", "created": 1755026110,
+            "model": "unsloth/Qwen3-Coder-30B-A3B-Instruct",
+            "choices": [{"index": 0, "delta": delta, "logprobs": None, "finish_reason": None}]
+        }
+        payloads.append(json.dumps(event, ensure_ascii=False).encode("utf-8"))
+    return payloads
+
+
+def bench_str_round_trip(payloads) -> float:
+    start = time.perf_counter()
+    for payload in payloads:
+        event = json.loads(payload.decode("utf-8"))
+        f"data: {json.dumps(event, ensure_ascii=False)}\n\n".encode("utf-8")
+    return time.perf_counter() - start
+
+
+def bench_codec(codec: JSONCodec, payloads) -> float:
+    start = time.perf_counter()
+    for payload in payloads:
+        event = codec.loads(payload)
+        b"data: " + codec.dumps_bytes(event) + b"\n\n"
+    return time.perf_counter() - start
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    payloads = build_payloads(count)
+    print(f"Events: {count} ({sum(len(p) for p in payloads) / 1e6:.1f} MB)")
+
+    baseline = bench_str_round_trip(payloads)
+    print(f"  {'stdlib (str)':14} {count / baseline:12.0f} events/s")
+
+    for backend in JSONCodec.BACKENDS:
+        if backend != 'stdlib' and getattr(call_patch_proxy, backend) is None:
+            print(f"  {backend:14} not installed")
+            continue
+        elapsed = bench_codec(JSONCodec(backend), payloads)
+        print(f"  {backend:14} {count / elapsed:12.0f} events/s ({baseline / elapsed:.1f}x)")
+
+
+if __name__ == "__main__":
+    main()
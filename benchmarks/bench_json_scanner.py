@@ -0,0 +1,70 @@
+#!/usr/bin/env python3
+"""
+Benchmark incremental JSON completeness scanning against a full rescan per fragment
+
+Simulates a large `write` tool call whose arguments stream in as 1-byte fragments.
+The rescan path is quadratic, so it is measured on a prefix and extrapolated.
+
+Usage:
+    python benchmarks/bench_json_scanner.py [size_kb] [rescan_prefix_kb]
+"""
+import sys
+import os
+import time
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from call_patch_proxy import JSONCompletenessScanner, is_json_complete
+
+
+def build_arguments(size: int) -> str:
+    """Build a write-call argument object of roughly `size` bytes"""
+    line = 'print(\\"hello {world}\\")  # [escaped quote]\\n'
+    body = (line * (size // len(line) + 1))[:size]
+    # Never cut an escape sequence in half
+    if body.endswith('\\'):
+        body = body[:-1]
+    return '{"filePath": "/tmp/big.py", "content": "' + body + '"}'
+
+
+def bench_incremental(text: str) -> float:
+    start = time.perf_counter()
+    scanner = JSONCompletenessScanner()
+    for char in text:
+        scanner.feed(char)
+        scanner.is_complete()
+    elapsed = time.perf_counter() - start
+    assert scanner.is_complete()
+    return elapsed
+
+
+def bench_rescan(text: str) -> float:
+    start = time.perf_counter()
+    buffer = ""
+    for char in text:
+        buffer += char
+        is_json_complete(buffer)
+    return time.perf_counter() - start
+
+
+def main():
+    size_kb = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+    prefix_kb = int(sys.argv[2]) if len(sys.argv) > 2 else 8
+
+    text = build_arguments(size_kb * 1024)
+    prefix = text[:prefix_kb * 1024]
+
+    print(f"Arguments: {len(text)} bytes in {len(text)} 1-byte fragments")
+
+    incremental = bench_incremental(text)
+    print(f"  incremental scanner: {incremental:8.3f} s ({len(text) / incremental / 1e6:.2f} M fragments/s)")
+
+    rescan_prefix = bench_rescan(prefix)
+    # Rescan cost grows with the square of the buffer length
+    rescan_full = rescan_prefix * (len(text) / len(prefix)) ** 2
+    print(f"  full rescan ({prefix_kb} KB measured): {rescan_prefix:8.3f} s")
+    print(f"  full rescan ({size_kb} KB extrapolated): {rescan_full:8.1f} s")
+    print(f"  speedup: ~{rescan_full / incremental:.0f}x")
+
+
+if __name__ == "__main__":
+    main()
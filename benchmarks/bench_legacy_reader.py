@@ -0,0 +1,156 @@
+#!/usr/bin/env python3
+"""
+Line-splitting throughput of the legacy stream reader, in MB/s of SSE payload
+
+Recorded-style legacy responses are fed to the reader as the socket would deliver
+them, and every complete line is taken out the way the proxy consumes it:
+- a token stream of small events, one HTTP chunk per event, read one event at a time
+  and in 64KB bursts
+- one write tool call whose arguments arrive as a single 256KB line in 1448-byte
+  TCP segments
+- the same token stream from a gateway whose chunk framing is broken (salvage mode)
+
+The previous read_legacy_stream loop is reproduced below (buffer += chunk, split of
+the whole buffer per read, line + b'\\n', the per-read preview decode and debug
+f-strings). It received bytes already de-chunked by aiohttp's C parser. The current
+LegacyHTTPProtocol is measured on those same bytes, as a response without chunked
+framing, and again on the chunked bytes off the socket, de-chunking included.
+
+Usage:
+    python benchmarks/bench_legacy_reader.py [rounds]
+"""
+import sys
+import os
+import asyncio
+import json
+import logging
+import time
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from call_patch_proxy import LegacyHTTPProtocol, _CHUNK_SIZE_LINE
+
+logger = logging.getLogger("bench")
+
+PLAIN = b"HTTP/1.1 200 OK\r\nContent-Type: text/event-stream\r\n\r\n"
+CHUNKED = b"HTTP/1.1 200 OK\r\nContent-Type: text/event-stream\r\nTransfer-Encoding: chunked\r\n\r\n"
+SEGMENT = 1448
+
+
+def event(delta: dict) -> bytes:
+    body = {"id": "chatcmpl-1", "object": "chat.completion.chunk", "model": "qwen3-coder",
+            "choices": [{"index": 0, "delta": delta, "finish_reason": None}]}
+    return f"data: {json.dumps(body)}\n\n".encode()
+
+
+def chunk(data: bytes) -> bytes:
+    return b"%x\r\n" % len(data) + data + b"\r\n"
+
+
+def token_events(count: int):
+    return [event({"content": f" token{i}"}) for i in range(count)] + [b"data: [DONE]\n\n"]
+
+
+def tool_call_events(size: int):
+    arguments = json.dumps({"filePath": "/tmp/out.py", "content": "x = 1\n" * (size // 6)})
+    call = {"index": 0, "id": "call_1", "type": "function", "function": {"name": "write", "arguments": arguments}}
+    return [event({"tool_calls": [call]}), b"data: [DONE]\n\n"]
+
+
+def split(data: bytes, size: int):
+    return [data[i:i + size] for i in range(0, len(data), size)]
+
+
+def workloads():
+    """(label, payload size, reads as the previous reader saw them, reads off the socket)"""
+    tokens = token_events(5000)
+    tool = tool_call_events(256 * 1024)
+    framed = b"".join(chunk(e) for e in tokens) + b"0\r\n\r\n"
+    plain = b"".join(tokens)
+    return [
+        ("tokens, one event per read", len(plain), tokens, [chunk(e) for e in tokens] + [b"0\r\n\r\n"]),
+        ("tokens, 64KB reads", len(plain), split(plain, 65536), split(framed, 65536)),
+        ("256KB tool call, 1448B reads", len(b"".join(tool)), split(b"".join(tool), SEGMENT),
+         split(b"".join(chunk(e) for e in tool) + b"0\r\n\r\n", SEGMENT)),
+        ("tokens, broken framing", len(plain), tokens, [b"ffff\r\n" + tokens[0]] + tokens[1:]),
+    ]
+
+
+def previous_reader(reads, request_id: str = "bench"):
+    """The line handling of the previous read_legacy_stream"""
+    lines = 0
+    buffer = b""
+    chunk_count = 0
+    total_bytes_read = 0
+    for chunk in reads:
+        chunk_count += 1
+        chunk_size_actual = len(chunk)
+        total_bytes_read += chunk_size_actual
+        logger.debug(f"[{request_id}] Read chunk #{chunk_count}: {chunk_size_actual} bytes (total: {total_bytes_read} bytes)")
+        preview = chunk[:100].decode('utf-8', errors='replace')
+        logger.debug(f"[{request_id}] Chunk #{chunk_count} preview: {preview!r}...")
+        buffer += chunk
+        split_lines = buffer.split(b'\n')
+        buffer = split_lines[-1]
+        complete_lines = len(split_lines) - 1
+        if complete_lines > 0:
+            logger.debug(f"[{request_id}] Yielding {complete_lines} complete lines from chunk #{chunk_count}")
+        for line in split_lines[:-1]:
+            line = line + b'\n'
+            lines += 1
+    return lines
+
+
+class NullTransport:
+    def pause_reading(self):
+        pass
+
+    def resume_reading(self):
+        pass
+
+    def close(self):
+        pass
+
+
+def current_reader(reads, head: bytes = CHUNKED):
+    """LegacyHTTPProtocol de-framing and take_lines, as LegacyResponse iterates them"""
+    protocol = LegacyHTTPProtocol()
+    protocol.connection_made(NullTransport())
+    protocol.data_received(head)
+    lines = 0
+    for data in reads:
+        protocol.data_received(data)
+        for line in protocol.take_lines():
+            if protocol.salvaged and _CHUNK_SIZE_LINE.fullmatch(line):
+                continue
+            lines += 1
+    return lines
+
+
+def measure(reader, reads, size: int, rounds: int) -> float:
+    best = float('inf')
+    for _ in range(rounds):
+        started = time.perf_counter()
+        reader(reads)
+        best = min(best, time.perf_counter() - started)
+    return size / best / 1e6
+
+
+async def run(rounds: int):
+    for label, size, plain_reads, socket_reads in workloads():
+        assert current_reader(socket_reads) == previous_reader(plain_reads), label
+        previous = measure(previous_reader, plain_reads, size, rounds)
+        current = measure(lambda reads: current_reader(reads, PLAIN), plain_reads, size, rounds)
+        chunked = measure(current_reader, socket_reads, size, rounds)
+        print(f"  {label:30} {size / 1024:5.0f}KB  previous {previous:6.1f} MB/s  "
+              f"current {current:6.1f} MB/s ({current / previous:4.1f}x)  with de-chunking {chunked:6.1f} MB/s")
+
+
+def main():
+    rounds = int(sys.argv[1]) if len(sys.argv) > 1 else 5
+    logging.disable(logging.INFO)
+    print(f"Legacy reader line splitting, best of {rounds} rounds")
+    asyncio.run(run(rounds))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,91 @@
+#!/usr/bin/env python3
+"""
+Compare round-robin with least-outstanding-requests backend selection
+
+Simulates N backends that each decode their open streams in parallel but slow
+down with concurrency (per-token time grows with the number of streams, like a
+batched llama.cpp/vLLM server). Requests arrive at a fixed rate with skewed
+generation lengths (most short, a few very long). Reports mean and p95 completion
+time and the peak per-backend concurrency for both selection policies.
+
+Usage:
+    python benchmarks/bench_load_balancing.py [backends] [requests] [arrival_interval_ms]
+"""
+import sys
+import os
+import asyncio
+import random
+import time
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from call_patch_proxy import Backend, BackendPool
+
+TOKEN_TIME = 0.0005      # Seconds per token for a single stream
+BATCH_PENALTY = 0.5      # Extra per-token slowdown for each other concurrent stream
+
+
+class RoundRobinPool(BackendPool):
+    """Plain rotation, ignoring open streams"""
+
+    def select(self, exclude=()):
+        self._turn += 1
+        backends = self.backends
+        return backends[self._turn % len(backends)]
+
+
+def skewed_lengths(count: int, seed: int = 7):
+    rng = random.Random(seed)
+    return [rng.randint(1500, 3000) if rng.random() < 0.1 else rng.randint(20, 150) for _ in range(count)]
+
+
+async def generate(backend: Backend, tokens: int, peaks: dict):
+    peaks[backend.url] = max(peaks[backend.url], backend.outstanding)
+    for _ in range(0, tokens, 10):
+        await asyncio.sleep(10 * TOKEN_TIME * (1 + BATCH_PENALTY * (backend.outstanding - 1)))
+
+
+async def run(pool: BackendPool, lengths, interval: float):
+    peaks = {url: 0 for url in pool.urls()}
+    durations = []
+
+    async def one_request(tokens: int):
+        started = time.perf_counter()
+        backend = pool.select()
+        pool.acquire(backend)
+        try:
+            await generate(backend, tokens, peaks)
+        finally:
+            pool.release(backend)
+        durations.append(time.perf_counter() - started)
+
+    tasks = []
+    for tokens in lengths:
+        tasks.append(asyncio.ensure_future(one_request(tokens)))
+        await asyncio.sleep(interval)
+    await asyncio.gather(*tasks)
+    durations.sort()
+    return {
+        'mean': sum(durations) / len(durations),
+        'p95': durations[int(len(durations) * 0.95)],
+        'peak': max(peaks.values()),
+    }
+
+
+def main():
+    backend_count = int(sys.argv[1]) if len(sys.argv) > 1 else 4
+    requests = int(sys.argv[2]) if len(sys.argv) > 2 else 300
+    interval = (float(sys.argv[3]) if len(sys.argv) > 3 else 20) / 1000
+    lengths = skewed_lengths(requests)
+    urls = [{'url': f"http://replica-{i}"} for i in range(backend_count)]
+
+    print(f"{backend_count} backends, {requests} requests every {interval * 1000:.0f}ms, "
+          f"{sum(1 for n in lengths if n > 1000)} long generations")
+    for label, pool in (("round-robin", RoundRobinPool()), ("least-outstanding", BackendPool())):
+        pool.configure(urls)
+        result = asyncio.run(run(pool, lengths, interval))
+        print(f"  {label:18} mean {result['mean'] * 1000:7.1f}ms  p95 {result['p95'] * 1000:7.1f}ms  "
+              f"peak streams/backend {result['peak']}")
+
+
+if __name__ == "__main__":
+    main()
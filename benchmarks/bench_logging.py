@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+"""
+Measure event-loop time spent on logging per SSE event
+
+Streams fragmented tool call events through forward_sse_line() with DEBUG logging
+in three configurations:
+  - previous: synchronous FileHandler on the loop, every event traced
+  - queued:   QueueHandler (file written by the listener thread), every event traced
+  - sampled:  QueueHandler with the default 1% event sampling
+
+The queue moves disk writes (and their stalls) off the loop, and records are
+formatted on the listener thread, but trace messages are still built on the loop and
+the listener competes for the GIL. Tracing every event is therefore only somewhat
+cheaper than the synchronous handler; sampling is what removes most of the cost.
+
+Usage:
+    python benchmarks/bench_logging.py [events]
+"""
+import sys
+import os
+import asyncio
+import json
+import logging
+import tempfile
+import time
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import call_patch_proxy
+from call_patch_proxy import RequestState, request_states, forward_sse_line
+
+
+class NullResponse:
+    async def write(self, data: bytes):
+        pass
+
+
+def build_lines(events: int):
+    args = json.dumps({"filePath": "/src/app.py", "content": "print('hello world')\n" * 400})
+    size = max(len(args) // events, 1)
+    lines = [b'data: {"choices": [{"index": 0, "delta": {"tool_calls": [{"index": 0, "id": "call_1", '
+             b'"type": "function", "function": {"name": "write", "arguments": ""}}]}}]}\n']
+    for i in range(0, len(args), size):
+        event = {"choices": [{"index": 0, "delta": {"tool_calls": [
+            {"index": 0, "function": {"arguments": args[i:i + size]}}]}}]}
+        lines.append(b"data: " + json.dumps(event).encode() + b"\n")
+    return lines
+
+
+async def run(lines):
+    request_states["bench"] = RequestState(request_id="bench")
+    response = NullResponse()
+    start = time.perf_counter()
+    for line in lines:
+        await forward_sse_line(line, "bench", response)
+    elapsed = time.perf_counter() - start
+    request_states.pop("bench", None)
+    return elapsed
+
+
+def main():
+    events = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    lines = build_lines(events)
+    logger = call_patch_proxy.logger
+    settings = call_patch_proxy.fix_engine.settings
+    call_patch_proxy.console_logger.setLevel(logging.WARNING)
+    queued_handlers = list(logger.handlers)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        sync_handler = logging.FileHandler(os.path.join(tmp, "sync.log"))
+        sync_handler.setFormatter(call_patch_proxy.file_formatter)
+        call_patch_proxy.file_handler.baseFilename = os.path.join(tmp, "queued.log")
+        call_patch_proxy.file_handler.stream = None
+        configurations = (
+            ("previous (sync, all)", [sync_handler], 1.0),
+            ("queued, all events", queued_handlers, 1.0),
+            ("queued, 1% sampled", queued_handlers, 0.01),
+        )
+        print(f"Stream: {len(lines)} tool call events")
+        for label, handlers, rate in configurations:
+            logger.handlers = handlers
+            settings['sse_trace_sample_rate'] = rate
+            elapsed = asyncio.run(run(lines))
+            print(f"  {label:22s} {elapsed / len(lines) * 1e6:8.1f} µs/event on the loop")
+        logger.handlers = queued_handlers
+        sync_handler.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,60 @@
+#!/usr/bin/env python3
+"""
+Measure the cost of metrics recording on the streaming hot path
+
+Reports the cost of one histogram observation, of the per-line bookkeeping the
+proxy does for every upstream SSE line, and of rendering /_metrics.
+
+Usage:
+    python benchmarks/bench_metrics.py [observations]
+"""
+import sys
+import os
+import random
+import time
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from call_patch_proxy import ProxyMetrics
+
+
+def main():
+    observations = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+    metrics = ProxyMetrics()
+    rng = random.Random(7)
+    values = [rng.expovariate(50.0) for _ in range(1024)]
+
+    start = time.perf_counter()
+    for i in range(observations):
+        metrics.event_gap.observe(values[i & 1023])
+    observe_time = time.perf_counter() - start
+
+    # Bookkeeping done per upstream line in handle_request and forward_sse_line
+    line = b'data: {"choices": [{"index": 0, "delta": {"content": "token"}}]}\n'
+    start = time.perf_counter()
+    last_event_at = time.monotonic()
+    for _ in range(observations):
+        received_at = time.monotonic()
+        metrics.bytes_in += len(line)
+        if line.startswith(b"data:"):
+            metrics.event_gap.observe(received_at - last_event_at)
+            last_event_at = received_at
+        started = time.perf_counter()
+        metrics.event_processing.observe(time.perf_counter() - started)
+        metrics.bytes_out += len(line)
+    per_line_time = time.perf_counter() - start
+
+    for i in range(200):
+        metrics.record_fixes(f"tool{i % 10}", [f"rule{i % 3}"])
+    start = time.perf_counter()
+    for _ in range(1000):
+        text = metrics.render()
+    render_time = (time.perf_counter() - start) / 1000
+
+    print(f"Observations: {observations}")
+    print(f"  histogram observe:   {observe_time / observations * 1e9:8.1f} ns")
+    print(f"  per-line bookkeeping:{per_line_time / observations * 1e9:8.1f} ns")
+    print(f"  render /_metrics:    {render_time * 1e6:8.1f} µs ({len(text)} bytes)")
+
+
+if __name__ == "__main__":
+    main()
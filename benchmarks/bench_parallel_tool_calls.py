@@ -0,0 +1,90 @@
+#!/usr/bin/env python3
+"""
+Measure when each parallel tool call is dispatched to the client
+
+Streams N interleaved `read` calls whose argument fragments arrive round-robin,
+with call k finishing k rounds after the first, through process_sse_event() and
+reports for every call the event number at which it was emitted and how far that
+is ahead of the end of the stream. The previous single-buffer consolidation could
+only release a call once the whole stream had been merged.
+
+Usage:
+    python benchmarks/bench_parallel_tool_calls.py [calls] [fragments_per_call] [token_ms]
+"""
+import sys
+import os
+import asyncio
+import json
+import logging
+import time
+import uuid
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import call_patch_proxy
+from call_patch_proxy import RequestState, request_states, process_sse_event
+
+
+def build_events(calls: int, fragments: int):
+    events = []
+    for index in range(calls):
+        events.append({"choices": [{"index": 0, "delta": {"tool_calls": [{
+            "index": index, "id": f"call_{uuid.uuid4().hex[:24]}", "type": "function",
+            "function": {"name": "read", "arguments": ""}}]}, "finish_reason": None}]})
+
+    pieces = []
+    for index in range(calls):
+        text = json.dumps({"filePath": f"/src/package/module_{index}.py"})
+        size = len(text) // fragments + 1
+        # Later calls start streaming later so they finish later
+        pieces.append([""] * index + [text[i:i + size] for i in range(0, len(text), size)])
+
+    for step in range(max(len(p) for p in pieces)):
+        for index, chunks in enumerate(pieces):
+            if step < len(chunks) and chunks[step]:
+                events.append({"choices": [{"index": 0, "delta": {"tool_calls": [{
+                    "index": index, "function": {"arguments": chunks[step]}}]}, "finish_reason": None}]})
+            elif step < len(chunks):
+                events.append({"choices": [{"index": 0, "delta": {"content": ""}, "finish_reason": None}]})
+    events.append({"choices": [{"index": 0, "delta": {}, "finish_reason": "tool_calls"}]})
+    return events
+
+
+async def run(events, token_ms: float):
+    request_id = "bench"
+    request_states[request_id] = RequestState(request_id=request_id)
+    dispatched = []
+    start = time.perf_counter()
+    for number, event in enumerate(events):
+        if token_ms:
+            await asyncio.sleep(token_ms / 1000)
+        result = await process_sse_event(event, request_id)
+        for tool_call in result["choices"][0]["delta"].get("tool_calls", []):
+            dispatched.append((tool_call["index"], number, time.perf_counter() - start))
+    end = time.perf_counter() - start
+    request_states.pop(request_id, None)
+    return dispatched, end
+
+
+def main():
+    calls = int(sys.argv[1]) if len(sys.argv) > 1 else 5
+    fragments = int(sys.argv[2]) if len(sys.argv) > 2 else 8
+    token_ms = float(sys.argv[3]) if len(sys.argv) > 3 else 20.0
+    call_patch_proxy.logger.setLevel(logging.WARNING)
+
+    events = build_events(calls, fragments)
+    dispatched, end = asyncio.run(run(events, token_ms))
+
+    print(f"Stream: {calls} parallel calls, {len(events)} events, {token_ms:.0f} ms per event")
+    for index, number, elapsed in dispatched:
+        print(f"  call {index}: event {number:4d}/{len(events) - 1}  at {elapsed * 1000:8.1f} ms"
+              f"  ({(end - elapsed) * 1000:8.1f} ms before stream end)")
+    if dispatched:
+        ahead = sum(end - elapsed for _, _, elapsed in dispatched) / len(dispatched)
+        print(f"  mean dispatch lead over stream end: {ahead * 1000:.1f} ms")
+    if len(dispatched) != calls:
+        print(f"  ✗ expected {calls} calls, got {len(dispatched)}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,114 @@
+#!/usr/bin/env python3
+"""
+Compare least-outstanding and prefix-affinity routing for multi-turn agent sessions
+
+Simulates interleaved agent conversations against N replicas. Each replica keeps
+the KV cache of its most recent `cache_slots` conversations (like llama.cpp slots
+or vLLM prefix caching). A turn that lands on a replica holding its conversation
+only prefills the new tokens; otherwise it prefills the whole context. Reports the
+cache hit rate, prefill tokens, modeled time-to-first-token and selection cost.
+
+Usage:
+    python benchmarks/bench_prefix_affinity.py [backends] [sessions] [turns] [cache_slots]
+"""
+import sys
+import os
+import random
+import time
+from collections import OrderedDict, deque
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import call_patch_proxy
+from call_patch_proxy import BackendPool
+
+SYSTEM_TOKENS = 6000       # System prompt and tool schemas
+TURN_TOKENS = 400          # Tokens added to the history per turn
+PREFILL_RATE = 3000        # Prefill tokens per second on one replica
+IN_FLIGHT = 8              # Concurrent requests across all sessions
+
+TOOLS = [{"type": "function", "function": {"name": name, "parameters": {"type": "object"}}}
+         for name in ("bash", "read", "write", "edit", "glob", "grep")]
+
+
+def request_body(session: int, turn: int):
+    messages = [{"role": "system", "content": "You are a coding agent. " * 50},
+                {"role": "user", "content": f"Task {session}"}]
+    for i in range(turn):
+        messages.append({"role": "assistant", "content": f"step {i}"})
+        messages.append({"role": "user", "content": f"result {i}"})
+    return {"model": "qwen3-coder", "tools": TOOLS, "messages": messages}
+
+
+def schedule(sessions: int, turns: int, seed: int = 3):
+    """Interleaved (session, turn) order: each session advances one turn at a time"""
+    rng = random.Random(seed)
+    progress = [0] * sessions
+    order = []
+    while len(order) < sessions * turns:
+        session = rng.randrange(sessions)
+        if progress[session] < turns:
+            order.append((session, progress[session]))
+            progress[session] += 1
+    return order
+
+
+def run(mode: str, backend_count: int, order, cache_slots: int):
+    call_patch_proxy.fix_engine.settings['routing_mode'] = mode
+    pool = BackendPool()
+    pool.configure([f"http://replica-{i}" for i in range(backend_count)])
+    caches = {url: OrderedDict() for url in pool.urls()}
+    in_flight = deque()
+    hits = 0
+    prefill = 0
+    ttft = 0.0
+    select_time = 0.0
+
+    for session, turn in order:
+        body = request_body(session, turn)
+        started = time.perf_counter()
+        backend = pool.select(affinity_key=pool.affinity_key(body))
+        select_time += time.perf_counter() - started
+        pool.acquire(backend)
+        in_flight.append(backend)
+        if len(in_flight) > IN_FLIGHT:
+            pool.release(in_flight.popleft())
+
+        cache = caches[backend.url]
+        context = SYSTEM_TOKENS + TURN_TOKENS * (turn + 1)
+        if session in cache:
+            hits += 1
+            tokens = TURN_TOKENS
+            cache.move_to_end(session)
+        else:
+            tokens = context
+            cache[session] = True
+            if len(cache) > cache_slots:
+                cache.popitem(last=False)
+        prefill += tokens
+        ttft += tokens / PREFILL_RATE
+
+    requests = len(order)
+    return {
+        'hit_rate': hits / requests,
+        'prefill': prefill,
+        'ttft': ttft / requests,
+        'select_us': select_time / requests * 1e6,
+    }
+
+
+def main():
+    backend_count = int(sys.argv[1]) if len(sys.argv) > 1 else 4
+    sessions = int(sys.argv[2]) if len(sys.argv) > 2 else 16
+    turns = int(sys.argv[3]) if len(sys.argv) > 3 else 20
+    cache_slots = int(sys.argv[4]) if len(sys.argv) > 4 else 4
+    order = schedule(sessions, turns)
+
+    print(f"{backend_count} backends x {cache_slots} cache slots, {sessions} sessions x {turns} turns")
+    for mode in ("least_outstanding", "prefix_affinity"):
+        result = run(mode, backend_count, order, cache_slots)
+        print(f"  {mode:18} cache hits {result['hit_rate']:6.1%}  prefill {result['prefill'] / 1e6:6.2f}M tokens  "
+              f"mean TTFT {result['ttft'] * 1000:7.1f}ms  select {result['select_us']:5.1f}us")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,74 @@
+#!/usr/bin/env python3
+"""
+Compare how a large write call reaches the client with and without progressive streaming
+
+Feeds a header plus N argument fragments through process_sse_event() and reports
+the event at which the client receives its first argument byte, the largest single
+burst, and the proxy time spent per event.
+
+Usage:
+    python benchmarks/bench_progressive_arguments.py [content_kb] [fragment_chars]
+"""
+import sys
+import os
+import asyncio
+import json
+import logging
+import time
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import call_patch_proxy
+from call_patch_proxy import RequestState, request_states, process_sse_event
+
+LINE = "    result = compute(values[index], scale=2.0)  # keep going\n"
+
+
+def build_events(content_size: int, fragment_chars: int):
+    content = (LINE * (content_size // len(LINE) + 1))[:content_size]
+    args = json.dumps({"filePath": "/src/generated.py", "content": content})
+    events = [{"choices": [{"index": 0, "delta": {"tool_calls": [{
+        "index": 0, "id": "call_bench", "type": "function",
+        "function": {"name": "write", "arguments": ""}}]}, "finish_reason": None}]}]
+    for i in range(0, len(args), fragment_chars):
+        events.append({"choices": [{"index": 0, "delta": {"tool_calls": [{
+            "index": 0, "function": {"arguments": args[i:i + fragment_chars]}}]}, "finish_reason": None}]})
+    return events, len(args)
+
+
+async def run(events, progressive_tools):
+    call_patch_proxy.fix_engine.settings['progressive_tools'] = progressive_tools
+    request_states["bench"] = RequestState(request_id="bench")
+    first_event = None
+    largest = 0
+    total = 0
+    start = time.perf_counter()
+    for number, event in enumerate(events):
+        result = await process_sse_event(json.loads(json.dumps(event)), "bench")
+        sent = sum(len(tool_call["function"]["arguments"])
+                   for tool_call in result["choices"][0]["delta"].get("tool_calls", []))
+        if sent and first_event is None:
+            first_event = number
+        largest = max(largest, sent)
+        total += sent
+    elapsed = time.perf_counter() - start
+    request_states.pop("bench", None)
+    return first_event, largest, total, elapsed
+
+
+def main():
+    content_kb = int(sys.argv[1]) if len(sys.argv) > 1 else 300
+    fragment_chars = int(sys.argv[2]) if len(sys.argv) > 2 else 16
+    call_patch_proxy.logger.setLevel(logging.WARNING)
+    call_patch_proxy.console_logger.setLevel(logging.WARNING)
+
+    events, args_size = build_events(content_kb * 1024, fragment_chars)
+    print(f"Stream: write call with {args_size} argument chars in {len(events) - 1} fragments")
+    for label, tools in (("buffered", []), ("progressive", ["write"])):
+        first_event, largest, total, elapsed = asyncio.run(run(events, tools))
+        print(f"  {label:12s} first byte at event {first_event:6d}/{len(events) - 1}"
+              f"  largest burst {largest:8d} chars  sent {total:8d} chars"
+              f"  {elapsed / len(events) * 1e6:6.1f} µs/event")
+
+
+if __name__ == "__main__":
+    main()
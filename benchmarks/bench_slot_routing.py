@@ -0,0 +1,93 @@
+#!/usr/bin/env python3
+"""
+Measure request latency with and without llama.cpp /slots-aware routing
+
+Two mock llama.cpp replicas with a few decoding slots each sit behind the proxy.
+Clients outside the proxy keep one replica saturated with long generations, which
+the proxy's own outstanding counts cannot see. Proxied requests are then sent in
+waves, and their mean and p95 latency are reported for plain least-outstanding
+selection and for slot-aware routing with the in-proxy queue.
+
+Usage:
+    python benchmarks/bench_slot_routing.py [slots_per_backend] [requests]
+"""
+import sys
+import os
+import asyncio
+import logging
+import time
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'tests'))
+
+import aiohttp
+from aiohttp import web
+from aiohttp.test_utils import TestServer, TestClient
+
+import call_patch_proxy
+from call_patch_proxy import backend_pool, backend_health_ctx, handle_request, upstream_pool_ctx
+from mock_backends import MockBackend
+
+CHUNK_DELAY = 0.01
+REQUEST_CHUNKS = 10       # ~0.1s generation per proxied request
+EXTERNAL_CHUNKS = 400     # ~4s generations from clients that bypass the proxy
+
+
+async def run(slot_aware: bool, slots: int, requests: int):
+    settings = call_patch_proxy.fix_engine.settings
+    settings.update({'slot_aware_routing': slot_aware, 'slots_poll_interval': 0.05,
+                     'queue_timeout': 30, 'health_check_interval': 0})
+    saturated = await MockBackend("saturated", slots=slots, delay=CHUNK_DELAY).start()
+    idle = await MockBackend("idle", slots=slots, delay=CHUNK_DELAY).start()
+    backend_pool.configure([saturated.url, idle.url])
+
+    app = web.Application()
+    app.cleanup_ctx.append(upstream_pool_ctx)
+    app.cleanup_ctx.append(backend_health_ctx)
+    app.router.add_route("*", "/{tail:.*}", handle_request)
+    client = TestClient(TestServer(app))
+    await client.start_server()
+
+    async with aiohttp.ClientSession() as direct:
+        async def external():
+            async with direct.post(f"{saturated.url}/v1/chat/completions",
+                                   json={"mock_chunks": EXTERNAL_CHUNKS}) as resp:
+                await resp.read()
+
+        background = [asyncio.ensure_future(external()) for _ in range(slots)]
+        await asyncio.sleep(0.2)
+
+        latencies = []
+
+        async def one_request():
+            started = time.perf_counter()
+            resp = await client.post('/v1/chat/completions', json={"model": "bench", "mock_chunks": REQUEST_CHUNKS})
+            await resp.read()
+            latencies.append(time.perf_counter() - started)
+
+        for _ in range(requests // slots):
+            await asyncio.gather(*(one_request() for _ in range(slots)))
+
+        for task in background:
+            task.cancel()
+        await asyncio.gather(*background, return_exceptions=True)
+
+    await client.close()
+    await saturated.close()
+    await idle.close()
+    latencies.sort()
+    return sum(latencies) / len(latencies), latencies[int(len(latencies) * 0.95)]
+
+
+def main():
+    slots = int(sys.argv[1]) if len(sys.argv) > 1 else 2
+    requests = int(sys.argv[2]) if len(sys.argv) > 2 else 20
+    logging.disable(logging.INFO)
+
+    print(f"2 backends x {slots} slots, one saturated by external clients, {requests} proxied requests")
+    for label, slot_aware in (("least-outstanding", False), ("slot-aware", True)):
+        mean, p95 = asyncio.run(run(slot_aware, slots, requests))
+        print(f"  {label:18} mean {mean * 1000:7.1f}ms  p95 {p95 * 1000:7.1f}ms")
+
+
+if __name__ == "__main__":
+    main()
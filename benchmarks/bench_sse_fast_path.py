@@ -0,0 +1,74 @@
+#!/usr/bin/env python3
+"""
+Benchmark per-event cost of plain content deltas with and without the SSE fast path
+
+Runs a recorded-style stream of chat token events through forward_sse_line() with
+the fast path disabled (decode -> json.loads -> process_sse_event -> json.dumps and
+debug logging) and enabled (raw bytes written straight through).
+
+Usage:
+    python benchmarks/bench_sse_fast_path.py [events]
+"""
+import sys
+import os
+import asyncio
+import json
+import time
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import call_patch_proxy
+from call_patch_proxy import RequestState, request_states, forward_sse_line
+
+TOKENS = ["I", "'ll", " start", " by", " reading", " the", " configuration", " file", ",", " then",
+          " update", " the", " parser", " so", " that", " it", " handles", " unicode", " — ", "ok", ".\n"]
+
+
+class NullResponse:
+    async def write(self, data: bytes):
+        pass
+
+
+def build_lines(count: int):
+    lines = []
+    for i in range(count):
+        event = {
+            "id": "chatcmpl-bench",
+            "object": "chat.completion.chunk",
+            "created": 1755026110,
+            "model": "unsloth/Qwen3-Coder-30B-A3B-Instruct",
+            "choices": [{"index": 0, "delta": {"content": TOKENS[i % len(TOKENS)]},
+                         "logprobs": None, "finish_reason": None}]
+        }
+        lines.append(f"data: {json.dumps(event, ensure_ascii=False)}\n".encode("utf-8"))
+        lines.append(b"\n")
+    return lines
+
+
+async def run(lines, fast_path: bool) -> float:
+    call_patch_proxy.fix_engine.settings['sse_fast_path'] = fast_path
+    request_id = "bench-fast" if fast_path else "bench-slow"
+    request_states[request_id] = RequestState(request_id=request_id)
+    response = NullResponse()
+    start = time.perf_counter()
+    for raw_line in lines:
+        await forward_sse_line(raw_line, request_id, response)
+    elapsed = time.perf_counter() - start
+    request_states.pop(request_id, None)
+    return elapsed
+
+
+async def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    lines = build_lines(count)
+
+    slow = await run(lines, fast_path=False)
+    fast = await run(lines, fast_path=True)
+
+    print(f"Plain content events: {count}")
+    print(f"  full parse path: {count / slow:12.0f} events/s ({slow / count * 1e6:7.2f} us/event)")
+    print(f"  raw fast path:   {count / fast:12.0f} events/s ({fast / count * 1e6:7.2f} us/event)")
+    print(f"  speedup: {slow / fast:.1f}x")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
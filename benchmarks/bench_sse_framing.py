@@ -0,0 +1,112 @@
+#!/usr/bin/env python3
+"""
+Upstream read loop throughput: line iteration vs chunk reads and SSE framing
+
+A recorded-style token stream is fed into an aiohttp StreamReader, as the client
+connection would, one read per event loop iteration: one event per read (a slow
+stream) and 64KB reads (a backlog arriving at once). It is consumed the previous
+way, `async for raw_line in resp.content` with a forward call for every line
+including the blank ones, and the current way, iter_any() framed by SSEFramer
+with a forward call per event. The forward call is a stub coroutine, so the numbers are the cost of the
+read loop itself.
+
+Usage:
+    python benchmarks/bench_sse_framing.py [events] [rounds]
+"""
+import sys
+import os
+import asyncio
+import json
+import logging
+import time
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from aiohttp.base_protocol import BaseProtocol
+from aiohttp.streams import StreamReader
+
+from call_patch_proxy import sse_batches
+
+
+def token_events(count: int):
+    events = []
+    for i in range(count):
+        body = {"id": "chatcmpl-1", "object": "chat.completion.chunk", "model": "qwen3-coder",
+                "choices": [{"index": 0, "delta": {"content": f" token{i}"}, "finish_reason": None}]}
+        events.append(f"data: {json.dumps(body)}\n\n".encode())
+    return events + [b"data: [DONE]\n\n"]
+
+
+async def feed(reader: StreamReader, reads):
+    for data in reads:
+        reader.feed_data(data)
+        await asyncio.sleep(0)
+    reader.feed_eof()
+
+
+async def consume(read_loop, reads) -> int:
+    loop = asyncio.get_running_loop()
+    protocol = BaseProtocol(loop)
+    protocol.transport = asyncio.Transport()  # The reader only checks that the connection is open
+    reader = StreamReader(protocol, 2 ** 30, loop=loop)
+    feeder = loop.create_task(feed(reader, reads))
+    forwarded = await read_loop(reader)
+    await feeder
+    return forwarded
+
+
+async def forward(data: bytes) -> bool:
+    return True
+
+
+async def previous_loop(reader: StreamReader) -> int:
+    forwarded = 0
+    async for raw_line in reader:
+        if raw_line.startswith(b"data:"):
+            forwarded += 1
+        if not await forward(raw_line):
+            break
+    return forwarded
+
+
+async def current_loop(reader: StreamReader) -> int:
+    forwarded = 0
+    async for events in sse_batches(reader.iter_any()):
+        for sse_event in events:
+            if sse_event.has_data:
+                forwarded += 1
+            if not await forward(sse_event.line):
+                break
+    return forwarded
+
+
+async def measure(read_loop, reads, rounds: int) -> float:
+    best = float('inf')
+    for _ in range(rounds):
+        started = time.perf_counter()
+        await consume(read_loop, reads)
+        best = min(best, time.perf_counter() - started)
+    return best
+
+
+async def run(count: int, rounds: int):
+    events = token_events(count)
+    body = b"".join(events)
+    for label, reads in (("one event per read", events),
+                         ("64KB reads", [body[i:i + 65536] for i in range(0, len(body), 65536)])):
+        assert await consume(previous_loop, reads) == await consume(current_loop, reads) == len(events)
+        previous = await measure(previous_loop, reads, rounds)
+        current = await measure(current_loop, reads, rounds)
+        print(f"  {label:20} previous {len(events) / previous / 1e3:7.1f}k events/s  "
+              f"current {len(events) / current / 1e3:7.1f}k events/s  ({previous / current:4.1f}x)")
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    rounds = int(sys.argv[2]) if len(sys.argv) > 2 else 5
+    logging.disable(logging.INFO)
+    print(f"{count} token events, best of {rounds} rounds")
+    asyncio.run(run(count, rounds))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,125 @@
+#!/usr/bin/env python3
+"""
+Per-stream memory footprint at 1k and 10k concurrent simulated streams
+
+Each simulated stream is a RequestState with one open ToolBuffer that has received
+a partial tool call in 16-character fragments, which is what the proxy holds per
+request while a call is being generated. Memory is measured with tracemalloc for
+the current slotted classes and for the previous dataclass layout (datetime
+stamps, str += accumulation), reproduced below.
+
+Usage:
+    python benchmarks/bench_stream_memory.py [args_bytes] [stream_counts...]
+"""
+import sys
+import os
+import gc
+import json
+import logging
+import time
+import tracemalloc
+from dataclasses import dataclass, field
+from datetime import datetime
+from typing import Dict
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import call_patch_proxy
+from call_patch_proxy import JSONCompletenessScanner, XMLToolCallLexer, RequestState, ToolBuffer
+
+
+@dataclass
+class PreviousToolBuffer:
+    call_id: str
+    content: str = ""
+    created_at: datetime = field(default_factory=datetime.now)
+    last_updated: datetime = field(default_factory=datetime.now)
+    request_id: str = ""
+    tool_name: str = ""
+    index: int = 0
+    stream_id: str = ""
+    streamed: int = 0
+    scanner: JSONCompletenessScanner = field(default_factory=JSONCompletenessScanner, repr=False)
+
+    def update_content(self, new_content: str):
+        self.content += new_content
+        self.scanner.feed(new_content)
+        self.last_updated = datetime.now()
+
+
+@dataclass
+class PreviousRequestState:
+    request_id: str
+    tool_buffers: Dict[str, PreviousToolBuffer] = field(default_factory=dict)
+    created_at: datetime = field(default_factory=datetime.now)
+    xml_lexer: XMLToolCallLexer = field(default_factory=XMLToolCallLexer)
+    held_content: str = ""
+    held_since: float = 0.0
+    last_fragment_key: str = ""
+    next_tool_index: int = 0
+
+
+def fragments(args_bytes: int):
+    args = json.dumps({"filePath": "/src/module.py", "content": "x = compute(y)\n" * (args_bytes // 15)})
+    partial = args[:args_bytes]
+    return [partial[i:i + 16] for i in range(0, len(partial), 16)]
+
+
+def build(state_cls, buffer_cls, count: int, pieces):
+    states = []
+    for i in range(count):
+        state = state_cls(request_id=f"{i:08x}")
+        buffer = buffer_cls(call_id="index:0:0", request_id=state.request_id, tool_name="write")
+        for piece in pieces:
+            buffer.update_content(piece)
+        state.tool_buffers["index:0:0"] = buffer
+        states.append(state)
+    return states
+
+
+def measure(state_cls, buffer_cls, count: int, pieces) -> float:
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    states = build(state_cls, buffer_cls, count, pieces)
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del states
+    return (after - before) / count
+
+
+def append_time(buffer_cls, pieces, size) -> float:
+    """Feed one large call, checking the size limit after every fragment as the proxy does"""
+    buffer = buffer_cls(call_id="index:0:0", tool_name="write")
+    start = time.perf_counter()
+    for piece in pieces:
+        buffer.update_content(piece)
+        if size(buffer) > 1048576:
+            break
+    return time.perf_counter() - start
+
+
+def main():
+    args_bytes = int(sys.argv[1]) if len(sys.argv) > 1 else 2048
+    counts = [int(arg) for arg in sys.argv[2:]] or [1000, 10000]
+    call_patch_proxy.logger.setLevel(logging.WARNING)
+    pieces = fragments(args_bytes)
+
+    print(f"Open tool call per stream: {sum(len(p) for p in pieces)} argument chars in {len(pieces)} fragments")
+    for count in counts:
+        previous = measure(PreviousRequestState, PreviousToolBuffer, count, pieces)
+        current = measure(RequestState, ToolBuffer, count, pieces)
+        print(f"  {count:6d} streams: previous {previous:8.0f} B/stream ({previous * count / 2**20:7.1f} MiB)"
+              f"  slotted {current:8.0f} B/stream ({current * count / 2**20:7.1f} MiB)")
+    empty_previous = measure(PreviousRequestState, PreviousToolBuffer, counts[0], [])
+    empty_current = measure(RequestState, ToolBuffer, counts[0], [])
+    print(f"  state with an empty buffer: previous {empty_previous:.0f} B, slotted {empty_current:.0f} B")
+
+    large = fragments(300 * 1024)
+    previous = append_time(PreviousToolBuffer, large, lambda b: len(b.content.encode('utf-8')))
+    current = append_time(ToolBuffer, large, ToolBuffer.size)
+    print(f"  300 KB call in {len(large)} fragments with a size check each: "
+          f"previous {previous * 1000:.1f} ms, slotted {current * 1000:.1f} ms")
+
+
+if __name__ == "__main__":
+    main()
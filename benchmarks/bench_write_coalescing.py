@@ -0,0 +1,91 @@
+#!/usr/bin/env python3
+"""
+Client writes and throughput with and without write coalescing
+
+A mock backend streams token events in bursts: each upstream write carries several
+small deltas, as a fast model does when the proxy or network lags a little.
+Streaming requests are sent one at a time through the proxy. The events per client
+write and the events per second delivered to the client are reported with
+coalescing off, with per-read coalescing, and with a 2ms window.
+
+Usage:
+    python benchmarks/bench_write_coalescing.py [requests] [events] [events_per_read]
+"""
+import sys
+import os
+import asyncio
+import json
+import logging
+import time
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from aiohttp import web
+from aiohttp.test_utils import TestServer, TestClient
+
+import call_patch_proxy
+from call_patch_proxy import backend_pool, handle_request, proxy_metrics, upstream_pool_ctx
+
+
+def token_stream(events: int, per_read: int):
+    lines = []
+    for i in range(events):
+        event = {"id": "chatcmpl-1", "object": "chat.completion.chunk", "model": "qwen3-coder",
+                 "choices": [{"index": 0, "delta": {"content": f" token{i}"}, "finish_reason": None}]}
+        lines.append(f"data: {json.dumps(event)}\n\n".encode())
+    reads = [b"".join(lines[i:i + per_read]) for i in range(0, len(lines), per_read)]
+    return reads + [b"data: [DONE]\n\n"]
+
+
+async def run(settings: dict, requests: int, events: int, per_read: int):
+    call_patch_proxy.fix_engine.settings.update(settings)
+    reads = token_stream(events, per_read)
+
+    async def completion(request: web.Request):
+        response = web.StreamResponse(headers={'Content-Type': 'text/event-stream'})
+        await response.prepare(request)
+        for data in reads:
+            await response.write(data)
+            await asyncio.sleep(0)
+        return response
+
+    backend_app = web.Application()
+    backend_app.router.add_post('/v1/chat/completions', completion)
+    backend = TestServer(backend_app)
+    await backend.start_server()
+    backend_pool.configure([str(backend.make_url('')).rstrip('/')])
+    app = web.Application()
+    app.cleanup_ctx.append(upstream_pool_ctx)
+    app.router.add_route("*", "/{tail:.*}", handle_request)
+    client = TestClient(TestServer(app))
+    await client.start_server()
+
+    writes = proxy_metrics.client_writes
+    started = time.perf_counter()
+    for _ in range(requests):
+        resp = await client.post('/v1/chat/completions', json={"model": "bench", "stream": True})
+        await resp.read()
+    elapsed = time.perf_counter() - started
+
+    await client.close()
+    await backend.close()
+    total = requests * (events + 1)
+    return total / (proxy_metrics.client_writes - writes), total / elapsed
+
+
+def main():
+    requests = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+    events = int(sys.argv[2]) if len(sys.argv) > 2 else 1000
+    per_read = int(sys.argv[3]) if len(sys.argv) > 3 else 4
+    logging.disable(logging.INFO)
+
+    print(f"{requests} streams of {events} token events, {per_read} events per upstream read")
+    for label, settings in (("no coalescing", {'write_coalescing': False}),
+                            ("per upstream read", {'write_coalescing': True, 'write_coalesce_window': 0}),
+                            ("2ms window", {'write_coalescing': True, 'write_coalesce_window': 0.002,
+                                            'write_flush_deadline': 0.01})):
+        per_write, rate = asyncio.run(run(settings, requests, events, per_read))
+        print(f"  {label:18} {per_write:7.1f} events per client write  {rate / 1e3:7.1f}k events/s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,98 @@
+#!/usr/bin/env python3
+"""
+Benchmark the streaming XML tool call lexer against the previous regex re-scan
+
+Simulates a long reasoning-heavy response streamed as small content deltas,
+followed by an XML tool call. The regex path re-runs both patterns over the
+whole accumulated text on every delta, as the proxy used to do.
+
+Usage:
+    python benchmarks/bench_xml_lexer.py [prose_kb] [delta_chars]
+"""
+import sys
+import os
+import re
+import time
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from call_patch_proxy import XMLToolCallLexer
+
+MAX_BUFFER_SIZE = 1048576
+
+PROSE = (
+    "Looking at the implementation, the loop compares i < n and then calls "
+    "helper(x) for every element; that is fine for small inputs but we should "
+    "check the <b>edge</b> cases as well.\n"
+)
+XML_CALL = (
+    "<tool_call>\n<function=write>\n<parameter=filePath>\n/tmp/out.py\n</parameter>\n"
+    "<parameter=content>\nprint('done')\n</parameter>\n</function>\n</tool_call>"
+)
+
+
+def regex_detect(content: str):
+    """The previous full-buffer detection"""
+    function_match = re.search(r'<function=([^>]+)>', content)
+    if not function_match:
+        return None
+    param_matches = re.findall(r'<parameter=([^>]+)>\s*([^<]*?)\s*</parameter>', content, re.DOTALL)
+    if not param_matches:
+        return None
+    return {
+        "function_name": function_match.group(1).strip(),
+        "arguments": {name.strip(): value.strip() for name, value in param_matches}
+    }
+
+
+def build_deltas(prose_size: int, delta_chars: int):
+    text = (PROSE * (prose_size // len(PROSE) + 1))[:prose_size] + XML_CALL
+    return [text[i:i + delta_chars] for i in range(0, len(text), delta_chars)]
+
+
+def bench_regex(deltas):
+    start = time.perf_counter()
+    buffer = ""
+    found = None
+    for delta in deltas:
+        buffer += delta
+        result = regex_detect(buffer)
+        if result:
+            found = result
+            buffer = ""
+        elif len(buffer) > MAX_BUFFER_SIZE:
+            buffer = ""
+    return time.perf_counter() - start, found
+
+
+def bench_lexer(deltas):
+    start = time.perf_counter()
+    lexer = XMLToolCallLexer()
+    found = None
+    for delta in deltas:
+        completed = lexer.feed(delta)
+        if completed:
+            found = completed[0]
+    return time.perf_counter() - start, found
+
+
+def main():
+    prose_kb = int(sys.argv[1]) if len(sys.argv) > 1 else 300
+    delta_chars = int(sys.argv[2]) if len(sys.argv) > 2 else 4
+
+    deltas = build_deltas(prose_kb * 1024, delta_chars)
+    total = sum(len(d) for d in deltas)
+    print(f"Stream: {total} chars in {len(deltas)} deltas of {delta_chars} chars")
+
+    regex_time, regex_found = bench_regex(deltas)
+    lexer_time, lexer_found = bench_lexer(deltas)
+
+    print(f"  regex re-scan:  {regex_time:8.3f} s ({len(deltas) / regex_time:12.0f} deltas/s)")
+    print(f"  streaming lexer:{lexer_time:8.3f} s ({len(deltas) / lexer_time:12.0f} deltas/s)")
+    print(f"  speedup: {regex_time / lexer_time:.1f}x")
+    # The regex path fires on the first closed parameter; the lexer waits for </function>
+    print(f"  regex result: {regex_found and regex_found['arguments']}")
+    print(f"  lexer result: {lexer_found and lexer_found['arguments']}")
+
+
+if __name__ == "__main__":
+    main()
@@ -19,16 +19,40 @@ Repository: https://github.com/yourusername/qwen3-call-patch-proxy
 
 import aiohttp
 from aiohttp import web
+from multidict import CIMultiDict
+from yarl import URL
 import json
 import logging
+import logging.handlers
+import gzip
+import shutil
+import atexit
+import queue
+import random
 import re
 import yaml
 import asyncio
 import ssl
-from datetime import datetime, timedelta
-from typing import Dict, Any, Optional, List
-from dataclasses import dataclass, field
+import time
+from typing import Dict, Any, Optional, List, Callable
+from dataclasses import dataclass
 import uuid
+from bisect import bisect_left
+from collections import OrderedDict
+import hashlib
+import heapq
+import itertools
+import math
+
+# Optional fast JSON backends, used by JSONCodec when installed
+try:
+    import orjson
+except ImportError:
+    orjson = None
+try:
+    import ujson
+except ImportError:
+    ujson = None
 
 # === CONFIGURATION ===
 # Target server running your Qwen3-Coder model
@@ -50,69 +74,725 @@ console_handler.setLevel(logging.INFO)
 console_formatter = logging.Formatter("%(asctime)s [%(levelname)s] %(message)s")
 console_handler.setFormatter(console_formatter)
 
+def gzip_rotator(source: str, dest: str):
+    """Compress a rotated log file (runs on the log listener thread)"""
+    with open(source, 'rb') as f_in, gzip.open(dest, 'wb') as f_out:
+        shutil.copyfileobj(f_in, f_out)
+    os.remove(source)
+
+def build_file_handler(path: str, max_bytes: int = 50 * 1024 * 1024, backup_count: int = 5) -> logging.Handler:
+    """Size-rotated log file whose old generations are gzip-compressed"""
+    handler = logging.handlers.RotatingFileHandler(path, maxBytes=max_bytes, backupCount=backup_count,
+                                                   encoding='utf-8')
+    handler.namer = lambda name: name + ".gz"
+    handler.rotator = gzip_rotator
+    return handler
+
 # File logger - for all detailed communication
-file_handler = logging.FileHandler("logs/proxy_detailed.log")
-file_handler.setLevel(logging.DEBUG)
+file_handler = build_file_handler("logs/proxy_detailed.log")
+file_handler.setLevel(LOG_LEVEL)
 file_formatter = logging.Formatter("%(asctime)s [%(levelname)s] [%(name)s] [%(funcName)s:%(lineno)d] %(message)s")
 file_handler.setFormatter(file_formatter)
+# Console-logger records stay off the file, as when it had only the console handler
+file_handler.addFilter(lambda record: record.name != "console")
+
+class DeferredQueueHandler(logging.handlers.QueueHandler):
+    """
+    QueueHandler that leaves all formatting to the listener thread.
+
+    The stock prepare() formats the message, merges the args and copies the record
+    on the calling thread. The queue never leaves the process, so the record can be
+    enqueued as is and the listener's handlers format it when they write it.
+    """
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        return record
+
+# Records are queued on the event loop and written by a background thread, so
+# console and disk I/O never block request handling
+log_queue = queue.SimpleQueue()
+queue_handler = DeferredQueueHandler(log_queue)
+log_listener = logging.handlers.QueueListener(log_queue, console_handler, file_handler, respect_handler_level=True)
+log_listener.start()
+atexit.register(log_listener.stop)
 
 # Main logger
 logger = logging.getLogger(__name__)
-logger.setLevel(logging.DEBUG)
-logger.addHandler(console_handler)
-logger.addHandler(file_handler)
+logger.setLevel(LOG_LEVEL)
+logger.addHandler(queue_handler)
 
 # Console-only logger for important events
 console_logger = logging.getLogger("console")
 console_logger.setLevel(logging.INFO)
-console_logger.addHandler(console_handler)
+console_logger.addHandler(queue_handler)
 console_logger.propagate = False
 
-@dataclass
+class JSONCodec:
+    """
+    JSON encoder/decoder used on the streaming hot path.
+
+    Wraps orjson or ujson when installed and falls back to the standard library.
+    Every backend accepts str or bytes, keeps non-ASCII text unescaped as UTF-8 and
+    raises json.JSONDecodeError on bad input, so callers can stay on bytes end to end.
+    """
+
+    BACKENDS = ('orjson', 'ujson', 'stdlib')
+
+    def __init__(self, backend: str = 'auto'):
+        if backend == 'auto':
+            backend = 'orjson' if orjson else 'ujson' if ujson else 'stdlib'
+        elif backend not in self.BACKENDS:
+            logger.warning(f"Unknown JSON backend {backend!r}, using stdlib")
+            backend = 'stdlib'
+        elif (backend == 'orjson' and orjson is None) or (backend == 'ujson' and ujson is None):
+            logger.warning(f"JSON backend {backend} is not installed, using stdlib")
+            backend = 'stdlib'
+        self.backend = backend
+
+    def loads(self, data):
+        """Decode JSON from str or bytes"""
+        try:
+            if self.backend == 'orjson':
+                return orjson.loads(data)
+            if self.backend == 'ujson':
+                return ujson.loads(data)
+            return json.loads(data)
+        except json.JSONDecodeError:
+            if self.backend == 'stdlib':
+                raise
+        except ValueError as e:
+            # Invalid UTF-8 from the stdlib, or a ujson error
+            if self.backend == 'stdlib':
+                raise json.JSONDecodeError(str(e), self._as_text(data), 0) from e
+        # Fast backends are stricter (e.g. NaN); let the stdlib decide
+        try:
+            return json.loads(data)
+        except json.JSONDecodeError:
+            raise
+        except ValueError as e:
+            raise json.JSONDecodeError(str(e), self._as_text(data), 0) from e
+
+    def dumps(self, obj) -> str:
+        """Encode to a str with non-ASCII characters left unescaped"""
+        if self.backend == 'stdlib':
+            return json.dumps(obj, ensure_ascii=False)
+        return self.dumps_bytes(obj).decode('utf-8')
+
+    def dumps_bytes(self, obj) -> bytes:
+        """Encode to UTF-8 bytes with non-ASCII characters left unescaped"""
+        try:
+            if self.backend == 'orjson':
+                return orjson.dumps(obj)
+            if self.backend == 'ujson':
+                return ujson.dumps(obj, ensure_ascii=False, escape_forward_slashes=False).encode('utf-8')
+        except (TypeError, OverflowError, ValueError):
+            # Objects the fast backend cannot encode (e.g. huge ints, non-str keys)
+            pass
+        return json.dumps(obj, ensure_ascii=False).encode('utf-8')
+
+    @staticmethod
+    def _as_text(data) -> str:
+        if isinstance(data, (bytes, bytearray, memoryview)):
+            return bytes(data).decode('utf-8', errors='replace')
+        return data
+
+# Characters that can change the bracket/string state of a JSON document
+_JSON_STRUCTURAL_CHARS = re.compile(r'[\\"{}\[\]]')
+
+class JSONCompletenessScanner:
+    """
+    Resumable bracket scanner for JSON text that arrives in fragments.
+
+    Keeps the bracket stack, in-string and escape state between calls to feed(), so
+    checking completeness after each fragment costs O(len(fragment)) instead of a
+    rescan of the whole buffer. Gives the same answers as is_json_complete() on the
+    concatenated text.
+    """
+
+    __slots__ = ('_stack', '_in_string', '_escape_next', '_started', '_invalid')
+
+    def __init__(self):
+        self._stack: List[str] = []
+        self._in_string = False
+        self._escape_next = False
+        self._started = False
+        self._invalid = False
+
+    def feed(self, fragment: str):
+        """Advance the scanner over the next fragment of text"""
+        if self._invalid or not fragment:
+            return
+
+        if not self._started:
+            # Leading whitespace is ignored; the first real character must open the document
+            fragment = fragment.lstrip()
+            if not fragment:
+                return
+            if fragment[0] not in '{[':
+                self._invalid = True
+                return
+            self._started = True
+
+        stack = self._stack
+        in_string = self._in_string
+        # Position of the character consumed by a pending backslash escape
+        escaped_pos = 0 if self._escape_next else -1
+
+        for match in _JSON_STRUCTURAL_CHARS.finditer(fragment):
+            pos = match.start()
+            if escaped_pos >= 0:
+                if pos == escaped_pos:
+                    escaped_pos = -1
+                    continue
+                # The escaped character was an ordinary one we skipped over
+                escaped_pos = -1
+
+            char = match.group()
+            if char == '\\':
+                escaped_pos = pos + 1
+                continue
+
+            if char == '"':
+                in_string = not in_string
+                continue
+
+            if in_string:
+                continue
+
+            if char in '{[':
+                stack.append(char)
+            else:
+                if not stack:
+                    self._invalid = True
+                    return
+                last = stack.pop()
+                if (char == '}' and last != '{') or (char == ']' and last != '['):
+                    self._invalid = True
+                    return
+
+        self._in_string = in_string
+        self._escape_next = escaped_pos == len(fragment)
+
+    def is_complete(self) -> bool:
+        """True if all text fed so far forms a bracket-balanced JSON document"""
+        return self._started and not self._invalid and not self._stack and not self._in_string
+
+    def closing(self) -> Optional[str]:
+        """
+        Characters that close the text fed so far: the open string, then the open
+        containers innermost first. None when appending cannot make it balanced.
+        """
+        if self._invalid or not self._started:
+            return None
+        # A pending backslash is completed as an escaped backslash before the quote
+        tail = (('\\' if self._escape_next else '') + '"') if self._in_string else ''
+        return tail + ''.join('}' if bracket == '{' else ']' for bracket in reversed(self._stack))
+
 class ToolBuffer:
-    """Enhanced buffer for tracking tool call state"""
-    call_id: str
-    content: str = ""
-    created_at: datetime = field(default_factory=datetime.now)
-    last_updated: datetime = field(default_factory=datetime.now)
-    request_id: str = ""
-    tool_name: str = ""
-    
-    def is_expired(self, timeout_seconds: int) -> bool:
-        # Use last_updated instead of created_at for more accurate timeout
-        return datetime.now() - self.last_updated > timedelta(seconds=timeout_seconds)
-    
+    """
+    Enhanced buffer for tracking tool call state.
+
+    Fragments are kept in a list and joined only when the full content is read, and
+    the character and UTF-8 byte counts are updated per fragment, so appending stays
+    O(fragment) however large the call grows. Every COMPACT_EVERY fragments are merged
+    into one chunk to bound the per-object overhead of many small strings.
+    """
+    __slots__ = ('call_id', 'request_id', 'tool_name', 'index', 'stream_id', 'streamed',
+                 'created_at', 'last_activity', 'length', 'byte_size', 'scanner', '_parts', '_loose')
+
+    COMPACT_EVERY = 64
+
+    def __init__(self, call_id: str, content: str = "", request_id: str = "",
+                 tool_name: str = "", index: int = 0):
+        self.call_id = call_id
+        self.request_id = request_id
+        self.tool_name = tool_name
+        self.index = index  # Original tool_calls index from the stream
+        self.stream_id = ""  # Call ID sent to the client once arguments stream progressively
+        self.streamed = 0  # Characters of content already forwarded to the client
+        self.created_at = self.last_activity = time.monotonic()  # last_activity drives expiry
+        self.length = 0  # Characters buffered
+        self.byte_size = 0  # UTF-8 bytes buffered
+        self.scanner = JSONCompletenessScanner()
+        self._parts: List[str] = []
+        self._loose = 0  # Fragments appended since the last compaction
+        if content:
+            self.update_content(content)
+
+    def __repr__(self) -> str:
+        return (f"ToolBuffer(call_id={self.call_id!r}, tool_name={self.tool_name!r}, "
+                f"index={self.index}, length={self.length})")
+
+    @property
+    def content(self) -> str:
+        parts = self._parts
+        if len(parts) > 1:
+            parts[:] = ["".join(parts)]
+            self._loose = 0
+        return parts[0] if parts else ""
+
     def update_content(self, new_content: str):
-        """Update content and refresh last_updated timestamp"""
-        self.content += new_content
-        self.last_updated = datetime.now()
-    
+        """Append a fragment and refresh last_activity"""
+        if new_content:
+            parts = self._parts
+            parts.append(new_content)
+            self._loose += 1
+            if self._loose >= self.COMPACT_EVERY:
+                parts[-self._loose:] = ["".join(parts[-self._loose:])]
+                self._loose = 0
+            self.length += len(new_content)
+            self.byte_size += len(new_content) if new_content.isascii() else len(new_content.encode('utf-8'))
+            self.scanner.feed(new_content)
+        self.last_activity = time.monotonic()
+
+    def tail(self, start: int) -> str:
+        """Content from character offset start, joining only the fragments it spans"""
+        wanted = self.length - start
+        if wanted <= 0:
+            return ""
+        collected = []
+        for part in reversed(self._parts):
+            collected.append(part)
+            wanted -= len(part)
+            if wanted <= 0:
+                break
+        text = "".join(reversed(collected))
+        return text[len(text) - (self.length - start):]
+
+    def is_json_complete(self) -> bool:
+        """Check completeness incrementally from the fragments seen so far"""
+        return self.scanner.is_complete()
+
     def size(self) -> int:
-        return len(self.content.encode('utf-8'))
+        return self.byte_size
+
+def partial_tag_suffix(text: str, tags) -> str:
+    """Return the longest suffix of text that is a proper prefix of one of the tags"""
+    longest = max(len(tag) for tag in tags)
+    idx = text.find('<', max(0, len(text) - longest + 1))
+    while idx >= 0:
+        suffix = text[idx:]
+        if any(tag.startswith(suffix) for tag in tags):
+            return suffix
+        idx = text.find('<', idx + 1)
+    return ""
+
+# Qwen3 may wrap a call in <tool_call> tags; seen next to it, they are part of the call
+_TOOL_CALL_WRAPPER_OPEN = re.compile(r'<tool_call>\s*$')
+
+class XMLToolCallLexer:
+    """
+    Incremental lexer for Qwen3 XML tool calls in streamed assistant content.
+
+    Recognises <function=NAME>, <parameter=NAME>VALUE</parameter> and </function>
+    across delta boundaries without rescanning earlier text. Only text from a
+    candidate "<function=" onward is kept; prose is dropped as soon as it cannot
+    start a tag. feed() returns each converted call the moment </function> (or a
+    bare </tool_call>) closes it, in the same shape as detect_and_convert_xml_tool_call(),
+    with "span" holding the call's [start, end) stream offsets. A <tool_call> opener
+    right before the call is part of its span; the closer after it is reported in
+    wrapper_spans, as it may only arrive with a later delta.
+    """
+
+    FUNCTION_OPEN = '<function='
+    FUNCTION_CLOSE = '</function>'
+    TOOL_CALL_OPEN = '<tool_call>'
+    TOOL_CALL_CLOSE = '</tool_call>'
+    PARAMETER_OPEN = '<parameter='
+    PARAMETER_CLOSE = '</parameter>'
+    BODY_TAGS = (PARAMETER_OPEN, FUNCTION_CLOSE, TOOL_CALL_CLOSE)
+    # Longer "names" mean the text was not a tool call after all
+    MAX_NAME_LENGTH = 256
+
+    # Lexer states
+    SEARCH, FUNCTION_NAME, BODY, PARAMETER_NAME, PARAMETER_VALUE = range(5)
+
+    __slots__ = ('_state', '_buf', '_function_name', '_arguments', '_parameter_name',
+                 '_value_parts', '_held', '_pos', '_call_start', '_after_call', 'wrapper_spans')
+
+    def __init__(self):
+        self._pos = 0
+        self.wrapper_spans: List[tuple] = []
+        self.reset()
+
+    def reset(self):
+        """Drop any partially lexed tool call and start searching again"""
+        self._state = self.SEARCH
+        self._buf = ""
+        self._function_name = ""
+        self._arguments: Dict[str, str] = {}
+        self._parameter_name = ""
+        self._value_parts: List[str] = []
+        self._held = 0
+        self._call_start = self._pos
+        self._after_call = False
+
+    @property
+    def in_tool_call(self) -> bool:
+        """True once "<function=" has been seen and the call is not closed yet"""
+        return self._state != self.SEARCH
+
+    @property
+    def position(self) -> int:
+        """Total number of characters fed so far"""
+        return self._pos
+
+    def safe_offset(self) -> int:
+        """
+        Stream offset before which no text can belong to a tool call.
+
+        Everything fed before this offset is plain content; everything after it is
+        either a possible "<function=" prefix or part of an unclosed call.
+        """
+        if self._state != self.SEARCH:
+            return self._call_start
+        return self._pos - len(self._buf)
+
+    def held_size(self) -> int:
+        """Number of characters currently retained by the lexer"""
+        return len(self._buf) + self._held
+
+    def feed(self, text: str) -> List[Dict[str, Any]]:
+        """
+        Consume the next content delta and return any tool calls it completed.
+        wrapper_spans lists the stray </tool_call> closers this delta contained.
+        """
+        completed = []
+        self.wrapper_spans = []
+        self._buf += text
+        self._pos += len(text)
+
+        while True:
+            state = self._state
+            buf = self._buf
+
+            if state == self.SEARCH:
+                if self._after_call:
+                    rest = buf.lstrip()
+                    if rest.startswith(self.TOOL_CALL_CLOSE):
+                        # The </tool_call> closing the wrapper of the call just emitted
+                        end = len(buf) - len(rest) + len(self.TOOL_CALL_CLOSE)
+                        self.wrapper_spans.append((self._pos - len(buf), self._pos - len(buf) + end))
+                        self._buf = buf[end:]
+                        self._after_call = False
+                        continue
+                    if self.TOOL_CALL_CLOSE.startswith(rest):
+                        break  # Whitespace or part of the closer so far
+                    self._after_call = False
+                idx = buf.find(self.FUNCTION_OPEN)
+                if idx < 0:
+                    partial = partial_tag_suffix(buf, (self.FUNCTION_OPEN, self.TOOL_CALL_OPEN))
+                    # Keep a <tool_call> opener that may still be followed by "<function="
+                    wrapper = _TOOL_CALL_WRAPPER_OPEN.search(buf, 0, len(buf) - len(partial))
+                    self._buf = buf[wrapper.start():] if wrapper else partial
+                    break
+                self._call_start = self._pos - len(buf) + idx
+                wrapper = _TOOL_CALL_WRAPPER_OPEN.search(buf, 0, idx)
+                if wrapper:
+                    # The <tool_call> opener in front belongs to the call, not to the prose
+                    self._call_start -= idx - wrapper.start()
+                self._buf = buf[idx + len(self.FUNCTION_OPEN):]
+                self._state = self.FUNCTION_NAME
+
+            elif state == self.FUNCTION_NAME or state == self.PARAMETER_NAME:
+                idx = buf.find('>')
+                if idx < 0:
+                    if len(buf) > self.MAX_NAME_LENGTH:
+                        # Not a tag after all - resume searching after the bogus opener
+                        self.reset()
+                        self._buf = buf
+                        continue
+                    break
+                name = buf[:idx].strip()
+                self._buf = buf[idx + 1:]
+                if state == self.FUNCTION_NAME:
+                    self._function_name = name
+                    self._state = self.BODY
+                else:
+                    self._parameter_name = name
+                    self._state = self.PARAMETER_VALUE
+
+            elif state == self.BODY:
+                found = [(buf.find(tag), tag) for tag in self.BODY_TAGS]
+                found = [(idx, tag) for idx, tag in found if idx >= 0]
+                if not found:
+                    self._buf = partial_tag_suffix(buf, self.BODY_TAGS)
+                    break
+                idx, tag = min(found)
+                self._buf = buf[idx + len(tag):]
+                if tag == self.PARAMETER_OPEN:
+                    self._state = self.PARAMETER_NAME
+                else:
+                    remaining = self._buf
+                    completed.append({
+                        "function_name": self._function_name,
+                        "arguments": self._arguments,
+                        "span": (self._call_start, self._pos - len(remaining))
+                    })
+                    self.reset()
+                    self._buf = remaining
+                    self._after_call = tag == self.FUNCTION_CLOSE
+
+            else:  # PARAMETER_VALUE
+                idx = buf.find(self.PARAMETER_CLOSE)
+                if idx < 0:
+                    # Move the settled part of the value out of the search window
+                    keep = len(self.PARAMETER_CLOSE) - 1
+                    if len(buf) > keep:
+                        self._value_parts.append(buf[:-keep])
+                        self._held += len(buf) - keep
+                        self._buf = buf[-keep:]
+                    break
+                self._value_parts.append(buf[:idx])
+                self._held += idx
+                self._arguments[self._parameter_name] = ''.join(self._value_parts).strip()
+                self._value_parts = []
+                self._buf = buf[idx + len(self.PARAMETER_CLOSE):]
+                self._state = self.BODY
+
+        return completed
+
+# Two consecutive line endings (CRLF, LF or a lone CR) end an SSE event
+_SSE_EVENT_END = re.compile(rb'(?:\r\n|\r(?!\n)|\n)(?:\r\n|\r(?!\n)|\n)')
+_SSE_FORWARDED_FIELDS = (b"event", b"id", b"retry")
+
+class SSEEvent:
+    """
+    One upstream server-sent event.
+
+    `line` is what the processing stage works on: for an event with data, its data
+    lines as `data: ...` with LF endings and a blank line, which is byte-for-byte
+    the upstream event in the usual single-line case. For events without data
+    (comments, keep-alives, a lone retry:) it is the upstream bytes, forwarded as
+    they are. `fields` holds the event:, id: and retry: lines of a data event,
+    written to the client ahead of it.
+    """
+    __slots__ = ('line', 'has_data', 'fields')
+
+    def __init__(self, line: bytes, has_data: bool = True, fields: bytes = b""):
+        self.line = line
+        self.has_data = has_data
+        self.fields = fields
+
+class SSEFramer:
+    """
+    Incremental parser for the event stream format of server-sent events.
+
+    feed() takes the upstream body in reads of any size and returns the events they
+    completed. Events end at a blank line; lines end with CRLF, LF or a lone CR.
+    Multi-line data fields stay together in one event, comment lines are dropped
+    from data events, and only the bytes appended since the last read are searched
+    for the end of an event. An unterminated event left at the end of the body is
+    returned by close() instead of being dropped, for backends that end a stream
+    without the final blank line.
+    """
+    __slots__ = ('_buffer', '_scanned')
+
+    def __init__(self):
+        self._buffer = bytearray()
+        self._scanned = 0
+
+    def feed(self, data: bytes) -> List[SSEEvent]:
+        buffer = self._buffer
+        if not buffer and b"\r" not in data:
+            # LF-only framing with nothing pending, the usual case: split on blank lines directly
+            parts = data.split(b"\n\n")
+            buffer += parts.pop()
+            self._scanned = len(buffer)
+            events = [self._event(part + b"\n\n", len(part)) for part in parts]
+            return [event for event in events if event is not None]
+        buffer += data
+        events = []
+        start = 0
+        # An event end not found before can only start in the last 3 bytes already searched
+        for match in _SSE_EVENT_END.finditer(buffer, max(0, self._scanned - 3)):
+            end = match.end()
+            if end == len(buffer) and buffer[end - 1] == 0x0d:
+                break  # The CR may be the first half of a CRLF still to come
+            event = self._event(bytes(buffer[start:end]), match.start() - start)
+            if event is not None:
+                events.append(event)
+            start = end
+        if start:
+            del buffer[:start]
+        self._scanned = len(buffer)
+        return events
+
+    def close(self) -> List[SSEEvent]:
+        """The event left unterminated at the end of the body, if any"""
+        raw = bytes(self._buffer)
+        self._buffer.clear()
+        self._scanned = 0
+        event = self._event(raw, len(raw.rstrip(b"\r\n"))) if raw else None
+        return [event] if event is not None else []
+
+    @staticmethod
+    def _event(raw: bytes, size: int) -> Optional[SSEEvent]:
+        """Build the event from its raw bytes, of which the first `size` are its lines"""
+        if not size:
+            return None
+        if raw.startswith(b"data:") and raw.find(b"\n", 0, size) < 0 and raw.find(b"\r", 0, size) < 0:
+            # The usual event: a single data line
+            if size <= 6 and raw[5:size] in (b"", b" "):
+                return SSEEvent(raw, has_data=False)
+            return SSEEvent(raw if len(raw) == size + 2 and raw.endswith(b"\n\n") else raw[:size] + b"\n\n")
+
+        data_lines = []
+        fields = []
+        for line in raw[:size].splitlines():
+            if not line or line.startswith(b":"):
+                continue
+            name, _, value = line.partition(b":")
+            if value.startswith(b" "):
+                value = value[1:]
+            if name == b"data":
+                data_lines.append(value)
+            elif name in _SSE_FORWARDED_FIELDS:
+                if name == b"retry" and not value.isdigit() or name == b"id" and b"\0" in value:
+                    continue
+                fields.append(name + b": " + value + b"\n")
+        if not data_lines or data_lines == [b""]:
+            # Nothing to dispatch: pass the event through untouched
+            return SSEEvent(raw, has_data=False)
+        return SSEEvent(b"data: " + b"\ndata: ".join(data_lines) + b"\n\n", fields=b"".join(fields))
+
+def sse_data(raw_line: bytes) -> bytes:
+    """The data of a `data:` event, multi-line data joined with LF as the SSE spec does"""
+    payload = raw_line[len(b"data:"):].strip()
+    if b"\n" not in payload:
+        return payload
+    values = []
+    for line in raw_line.strip().split(b"\n"):
+        value = line[len(b"data:"):]
+        values.append(value[1:] if value.startswith(b" ") else value)
+    return b"\n".join(values)
+
+class StreamTranscript:
+    """
+    What the backend generated so far in a stream that may have to be continued.
+
+    Data lines of the current upstream segment are only stored while streaming and
+    parsed when the stream breaks. absorb() folds them into the assistant output
+    accumulated over all segments: content, reasoning and the tool calls whose
+    arguments completed. A call still streaming its arguments is left out, and the
+    continuation generates it again.
+    """
+    __slots__ = ('lines', 'content', 'reasoning', 'tool_calls', 'finished')
+
+    def __init__(self):
+        self.lines: List[bytes] = []
+        self.content: List[str] = []
+        self.reasoning: List[str] = []
+        self.tool_calls: List[Dict[str, Any]] = []
+        self.finished = False  # finish_reason or [DONE] already received
+
+    def record(self, raw_line: bytes):
+        self.lines.append(raw_line)
+
+    def absorb(self):
+        """Parse the data events of the segment that just ended"""
+        calls: Dict[int, Dict[str, Any]] = {}
+        for raw_line in self.lines:
+            payload = sse_data(raw_line)
+            if payload == b"[DONE]":
+                self.finished = True
+                continue
+            try:
+                event = json_codec.loads(payload)
+            except (json.JSONDecodeError, ValueError):
+                continue
+            for choice in event.get("choices") or ():
+                delta = choice.get("delta") or {}
+                if delta.get("content"):
+                    self.content.append(delta["content"])
+                if delta.get("reasoning_content"):
+                    self.reasoning.append(delta["reasoning_content"])
+                for tool in delta.get("tool_calls") or ():
+                    call = calls.setdefault(tool.get("index", 0), {"id": "", "name": "", "arguments": []})
+                    func = tool.get("function") or {}
+                    call["id"] = tool.get("id") or call["id"]
+                    call["name"] = func.get("name") or call["name"]
+                    if func.get("arguments"):
+                        call["arguments"].append(func["arguments"])
+                if choice.get("finish_reason"):
+                    self.finished = True
+        self.lines = []
+
+        for index in sorted(calls):
+            call = calls[index]
+            arguments = "".join(call["arguments"])
+            if call["name"] and arguments.strip() and is_json_complete(arguments):
+                self.tool_calls.append({
+                    "id": call["id"] or f"call_{uuid.uuid4().hex[:24]}",
+                    "type": "function",
+                    "function": {"name": call["name"], "arguments": arguments},
+                })
+
+    def assistant_message(self) -> Dict[str, Any]:
+        """The output so far as an assistant message to continue from"""
+        message = {"role": "assistant", "content": "".join(self.content)}
+        if self.reasoning:
+            message["reasoning_content"] = "".join(self.reasoning)
+        if self.tool_calls:
+            message["tool_calls"] = self.tool_calls
+        return message
 
-@dataclass 
 class RequestState:
     """Per-request state management"""
-    request_id: str
-    tool_buffers: Dict[str, ToolBuffer] = field(default_factory=dict)
-    created_at: datetime = field(default_factory=datetime.now)
-    content_buffer: str = ""  # Buffer for accumulating XML content
+    __slots__ = ('request_id', 'tool_buffers', 'created_at', 'last_activity', '_xml_lexer',
+                 'held_content', 'held_since', 'last_fragment_key', 'next_tool_index',
+                 'tool_index_offset', 'transcript', 'trace', 'trace_event')
+
+    def __init__(self, request_id: str, trace: bool = False):
+        self.request_id = request_id
+        self.tool_buffers: Dict[str, ToolBuffer] = {}
+        self.created_at = self.last_activity = time.monotonic()  # last_activity: last upstream line, for reaping
+        self._xml_lexer: Optional[XMLToolCallLexer] = None
+        self.held_content = ""  # Content held back because it may start an XML tool call
+        self.held_since = 0.0  # Monotonic time the oldest held character arrived
+        self.last_fragment_key = ""  # Buffer that received the latest argument fragment
+        self.next_tool_index = 0  # tool_calls index for calls the stream did not number
+        self.tool_index_offset = 0  # Added to tool_calls indices of a continued stream
+        self.transcript: Optional[StreamTranscript] = None  # Set when the stream may be continued
+        self.trace = trace  # Client asked for a full per-event trace (X-Proxy-Trace header)
+        self.trace_event = False  # The event being processed is traced
+
+    def __repr__(self) -> str:
+        return f"RequestState(request_id={self.request_id!r}, tool_buffers={list(self.tool_buffers)})"
+
+    @property
+    def xml_lexer(self) -> XMLToolCallLexer:
+        """Streams XML-format tool calls; created on first content that needs scanning"""
+        if self._xml_lexer is None:
+            self._xml_lexer = XMLToolCallLexer()
+        return self._xml_lexer
     
-    def cleanup_expired_buffers(self, timeout_seconds: int):
-        expired_ids = [
-            call_id for call_id, buffer in self.tool_buffers.items() 
-            if buffer.is_expired(timeout_seconds)
-        ]
-        for call_id in expired_ids:
-            logger.warning(f"[{self.request_id}] Cleaning up expired buffer: {call_id}")
-            del self.tool_buffers[call_id]
+    def add_buffer(self, buffer_key: str, buffer: ToolBuffer) -> ToolBuffer:
+        """Store a new tool buffer and register it for expiry"""
+        self.tool_buffers[buffer_key] = buffer
+        expiry_scheduler.track_buffer(self.request_id, buffer_key, buffer)
+        return buffer
+
+@dataclass(frozen=True)
+class CompiledFix:
+    """A fix rule from tool_fixes.yaml bound to its condition and action callables"""
+    name: str
+    parameter: str
+    condition: Callable[[Dict[str, Any], str, Dict[str, Any]], bool]
+    action: Callable[[Dict[str, Any], str, Dict[str, Any], str], Any]
+    rule: Dict[str, Any]  # The original rule, for default/fallback/valid values
+    append_safe: bool  # Only ever adds a parameter that is not present yet
+
+# Dispatch table entry for tools without rules
+NO_FIXES: tuple = ()
 
 class ToolFixEngine:
     """
     Configurable tool fix engine that applies transformations to tool call arguments.
     
     Loads fix rules from a YAML configuration file and applies them to incoming tool calls
-    based on parameter conditions and desired actions.
+    based on parameter conditions and desired actions. Rules are compiled at load time into
+    per-tool tuples of bound condition/action callables (fix_table).
     
     Supported fix actions:
     - parse_json_array: Convert JSON string to array
@@ -131,6 +811,10 @@ class ToolFixEngine:
         """Initialize the fix engine with configuration from YAML file."""
         self.config = self._load_config(config_file)
         self.settings = self.config.get('settings', {})
+        self.fix_table = self._compile_fixes(self.config.get('tools', {}))
+        self._progressive_source = None
+        self._progressive_tools = frozenset()
+        self._resolve_progressive_tools()
         logger.info(f"Loaded tool fix configuration with {len(self.config.get('tools', {}))} tools")
     
     def _load_config(self, config_file: str) -> Dict[str, Any]:
@@ -186,110 +870,220 @@ class ToolFixEngine:
     def get_setting(self, key: str, default=None):
         return self.settings.get(key, default)
     
-    def apply_fixes(self, tool_name: str, args_obj: Dict[str, Any], request_id: str) -> tuple[str, Dict[str, Any]]:
-        """Apply configured fixes to tool arguments. Returns (possibly_changed_tool_name, fixed_args)"""
-        if not self.settings.get('case_sensitive_tools', False):
-            tool_name = tool_name.lower()
-        
-        tool_config = self.config.get('tools', {}).get(tool_name, {})
-        fixes = tool_config.get('fixes', [])
+    def _compile_fixes(self, tools: Dict[str, Any]) -> Dict[str, tuple]:
+        """Compile the tools section into per-tool tuples of bound fix rules"""
+        conditions = {
+            'is_string': self._condition_is_string,
+            'missing_or_empty': self._condition_missing_or_empty,
+            'missing': self._condition_missing,
+            'exists': self._condition_exists,
+            'invalid_enum': self._condition_invalid_enum,
+        }
+        actions = {
+            'parse_json_array': self._action_parse_json_array,
+            'set_default': self._action_set_default,
+            'parse_json_object': self._action_parse_json_object,
+            'convert_string_to_boolean': self._action_convert_string_to_boolean,
+            'remove_parameter': self._action_remove_parameter,
+            'convert_tool_to_write': self._action_convert_tool_to_write,
+        }
         
+        fix_table = {}
+        for tool_name, tool_config in (tools or {}).items():
+            compiled = []
+            for fix in (tool_config or {}).get('fixes') or []:
+                condition = conditions.get(fix['condition'])
+                if condition is None:
+                    # An unknown condition never matches
+                    logger.warning(f"Unknown condition {fix['condition']!r} in fix {fix['name']} for {tool_name}, skipping")
+                    continue
+                action = actions.get(fix['action'])
+                if action is None:
+                    logger.warning(f"Unknown action {fix['action']!r} in fix {fix['name']} for {tool_name}")
+                    action = self._action_none
+                compiled.append(CompiledFix(
+                    name=fix['name'],
+                    parameter=fix['parameter'],
+                    condition=condition,
+                    action=action,
+                    rule=fix,
+                    append_safe=fix['action'] == 'set_default' and fix['condition'] == 'missing'
+                ))
+            fix_table[tool_name] = tuple(compiled) or NO_FIXES
+        return fix_table
+    
+    def normalize_tool_name(self, tool_name: str) -> str:
+        if not self.settings.get('case_sensitive_tools', False):
+            return tool_name.lower()
+        return tool_name
+    
+    def get_fixes(self, tool_name: str) -> tuple:
+        """Compiled fix rules for a tool, NO_FIXES when it has none"""
+        return self.fix_table.get(self.normalize_tool_name(tool_name), NO_FIXES)
+    
+    def has_fixes(self, tool_name: str) -> bool:
+        return bool(self.get_fixes(tool_name))
+    
+    def is_append_safe(self, tool_name: str) -> bool:
+        """
+        Check whether a tool's fixes can only add parameters that are not present yet.
+
+        Such fixes never change bytes the model already produced, so the fixed call
+        equals the original arguments with extra members appended before the final brace.
+        """
+        return all(fix.append_safe for fix in self.get_fixes(tool_name))
+    
+    def _resolve_progressive_tools(self) -> frozenset:
+        """
+        Resolve the progressive_tools setting into the tools that can really stream.
+
+        Done once per setting value rather than per fragment, so a listed tool whose
+        fixes rewrite arguments is reported a single time.
+        """
+        listed = self.settings.get('progressive_tools') or ()
+        if listed is self._progressive_source:
+            return self._progressive_tools
+        progressive_tools = set()
+        for name in listed:
+            tool_name = self.normalize_tool_name(name)
+            if self.is_append_safe(tool_name):
+                progressive_tools.add(tool_name)
+            else:
+                logger.warning(f"Tool {tool_name} has fixes that rewrite arguments, not streaming it progressively")
+        self._progressive_source = listed
+        self._progressive_tools = frozenset(progressive_tools)
+        return self._progressive_tools
+    
+    def streams_progressively(self, tool_name: str) -> bool:
+        """Check whether arguments of this tool are streamed to the client as they arrive"""
+        if not tool_name:
+            return False
+        return self.normalize_tool_name(tool_name) in self._resolve_progressive_tools()
+    
+    def apply_fixes(self, tool_name: str, args_obj: Dict[str, Any], request_id: str) -> tuple[str, Dict[str, Any]]:
+        """Apply configured fixes to tool arguments in place. Returns (possibly_changed_tool_name, fixed_args)"""
+        tool_name = self.normalize_tool_name(tool_name)
+        return self.run_fixes(tool_name, self.fix_table.get(tool_name, NO_FIXES), args_obj, request_id)
+    
+    def run_fixes(self, tool_name: str, fixes: tuple, args_obj: Dict[str, Any], request_id: str) -> tuple[str, Dict[str, Any]]:
+        """
+        Apply already looked-up compiled fixes to args_obj in place.
+
+        Callers that parsed the arguments themselves own the dict, so no copy is made;
+        callers that still need the original must pass a copy.
+        """
         if not fixes:
             logger.debug(f"[{request_id}] No fixes configured for tool: {tool_name}")
             return tool_name, args_obj
         
-        result = args_obj.copy()
         applied_fixes = []
         final_tool_name = tool_name
         
         for fix in fixes:
-            result_or_tuple = self._apply_single_fix(result, fix, request_id)
-            if isinstance(result_or_tuple, tuple):
+            param = fix.parameter
+            if not fix.condition(args_obj, param, fix.rule):
+                continue
+            try:
+                outcome = fix.action(args_obj, param, fix.rule, request_id)
+            except Exception as e:
+                logger.warning(f"[{request_id}] Fix {fix.name} failed: {e}")
+                # Use fallback if available
+                if 'fallback_value' not in fix.rule:
+                    continue
+                args_obj[param] = fix.rule['fallback_value']
+                outcome = True
+            if outcome is True:
+                applied_fixes.append(fix.name)
+            elif outcome:
                 # Tool conversion happened
-                final_tool_name, applied = result_or_tuple
+                final_tool_name, applied = outcome
                 if applied:
-                    applied_fixes.append(fix['name'])
-            elif result_or_tuple:
-                applied_fixes.append(fix['name'])
+                    applied_fixes.append(fix.name)
         
         if applied_fixes:
+            fix_list = ', '.join(applied_fixes)
             if final_tool_name != tool_name:
-                console_logger.info(f"[{request_id}] 🔄 Converted {tool_name}→{final_tool_name}: {', '.join(applied_fixes)}")
+                console_logger.info(f"[{request_id}] 🔄 Converted {tool_name}→{final_tool_name}: {fix_list}")
             else:
-                console_logger.info(f"[{request_id}] 🔧 Fixed {tool_name}: {', '.join(applied_fixes)}")
+                console_logger.info(f"[{request_id}] 🔧 Fixed {tool_name}: {fix_list}")
             logger.info(f"[{request_id}] Applied fixes to {tool_name}: {applied_fixes}")
+            proxy_metrics.record_fixes(tool_name, applied_fixes)
         
-        return final_tool_name, result
+        return final_tool_name, args_obj
     
-    def _apply_single_fix(self, args_obj: Dict[str, Any], fix: Dict[str, Any], request_id: str):
-        """Apply a single fix rule. Returns bool or (new_tool_name, bool) for tool conversions"""
-        param = fix['parameter']
-        condition = fix['condition']
-        action = fix['action']
-        
-        # Check condition
-        if not self._check_condition(args_obj, param, condition, fix):
-            return False
-        
-        # Apply action
-        try:
-            if action == 'parse_json_array':
-                if isinstance(args_obj.get(param), str):
-                    try:
-                        args_obj[param] = json.loads(args_obj[param])
-                    except json.JSONDecodeError:
-                        # Try to fix common JSON issues like single quotes
-                        fixed_json = self._fix_malformed_json(args_obj[param])
-                        args_obj[param] = json.loads(fixed_json)
-                        console_logger.info(f"[{request_id}] 🔧 Fixed malformed JSON for {param}")
-                        logger.debug(f"[{request_id}] Fixed malformed JSON for {param}: {str(args_obj[param])[:100]}...")
-            elif action == 'set_default':
-                args_obj[param] = fix['default_value']
-            elif action == 'parse_json_object':
-                if isinstance(args_obj.get(param), str):
-                    args_obj[param] = json.loads(args_obj[param])
-            elif action == 'convert_string_to_boolean':
-                if isinstance(args_obj.get(param), str):
-                    value = args_obj[param].lower().strip()
-                    args_obj[param] = value in ('true', '1', 'yes', 'on')
-            elif action == 'remove_parameter':
-                if param in args_obj:
-                    del args_obj[param]
-            elif action == 'convert_tool_to_write':
-                # Convert read+content to write tool call
-                if 'filePath' in args_obj and 'content' in args_obj:
-                    # Keep both filePath and content for write tool
-                    return ('write', True)
-                else:
-                    logger.warning(f"[{request_id}] Cannot convert to write: missing filePath or content")
-                    return False
-            return True
-        except Exception as e:
-            logger.warning(f"[{request_id}] Fix {fix['name']} failed: {e}")
-            # Use fallback if available
-            if 'fallback_value' in fix:
-                args_obj[param] = fix['fallback_value']
-                return True
-        return False
+    # Fix conditions: (args_obj, param, rule) -> bool
     
-    def _check_condition(self, args_obj: Dict[str, Any], param: str, condition: str, fix: Dict[str, Any]) -> bool:
-        """Check if condition is met for applying fix"""
-        value = args_obj.get(param)
-        
-        if condition == 'is_string':
-            return isinstance(value, str)
-        elif condition == 'missing_or_empty':
-            return not value
-        elif condition == 'missing':
-            return param not in args_obj
-        elif condition == 'exists':
-            return param in args_obj
-        elif condition == 'invalid_enum':
-            valid_values = fix.get('valid_values', [])
-            return value not in valid_values
-        
+    @staticmethod
+    def _condition_is_string(args_obj: Dict[str, Any], param: str, rule: Dict[str, Any]) -> bool:
+        return isinstance(args_obj.get(param), str)
+    
+    @staticmethod
+    def _condition_missing_or_empty(args_obj: Dict[str, Any], param: str, rule: Dict[str, Any]) -> bool:
+        return not args_obj.get(param)
+    
+    @staticmethod
+    def _condition_missing(args_obj: Dict[str, Any], param: str, rule: Dict[str, Any]) -> bool:
+        return param not in args_obj
+    
+    @staticmethod
+    def _condition_exists(args_obj: Dict[str, Any], param: str, rule: Dict[str, Any]) -> bool:
+        return param in args_obj
+    
+    @staticmethod
+    def _condition_invalid_enum(args_obj: Dict[str, Any], param: str, rule: Dict[str, Any]) -> bool:
+        return args_obj.get(param) not in rule.get('valid_values', [])
+    
+    # Fix actions: (args_obj, param, rule, request_id) -> bool or (new_tool_name, bool)
+    
+    def _action_parse_json_array(self, args_obj: Dict[str, Any], param: str, rule: Dict[str, Any], request_id: str):
+        if isinstance(args_obj.get(param), str):
+            try:
+                args_obj[param] = json_codec.loads(args_obj[param])
+            except json.JSONDecodeError:
+                # Try to fix common JSON issues like single quotes
+                fixed_json = self._fix_malformed_json(args_obj[param])
+                args_obj[param] = json_codec.loads(fixed_json)
+                console_logger.info(f"[{request_id}] 🔧 Fixed malformed JSON for {param}")
+                logger.debug(f"[{request_id}] Fixed malformed JSON for {param}: {str(args_obj[param])[:100]}...")
+        return True
+    
+    @staticmethod
+    def _action_set_default(args_obj: Dict[str, Any], param: str, rule: Dict[str, Any], request_id: str):
+        args_obj[param] = rule['default_value']
+        return True
+    
+    @staticmethod
+    def _action_parse_json_object(args_obj: Dict[str, Any], param: str, rule: Dict[str, Any], request_id: str):
+        if isinstance(args_obj.get(param), str):
+            args_obj[param] = json_codec.loads(args_obj[param])
+        return True
+    
+    @staticmethod
+    def _action_convert_string_to_boolean(args_obj: Dict[str, Any], param: str, rule: Dict[str, Any], request_id: str):
+        if isinstance(args_obj.get(param), str):
+            value = args_obj[param].lower().strip()
+            args_obj[param] = value in ('true', '1', 'yes', 'on')
+        return True
+    
+    @staticmethod
+    def _action_remove_parameter(args_obj: Dict[str, Any], param: str, rule: Dict[str, Any], request_id: str):
+        if param in args_obj:
+            del args_obj[param]
+        return True
+    
+    @staticmethod
+    def _action_convert_tool_to_write(args_obj: Dict[str, Any], param: str, rule: Dict[str, Any], request_id: str):
+        # Convert read+content to write tool call
+        if 'filePath' in args_obj and 'content' in args_obj:
+            # Keep both filePath and content for write tool
+            return ('write', True)
+        logger.warning(f"[{request_id}] Cannot convert to write: missing filePath or content")
         return False
     
+    @staticmethod
+    def _action_none(args_obj: Dict[str, Any], param: str, rule: Dict[str, Any], request_id: str):
+        return True
+    
     def _fix_malformed_json(self, json_str: str) -> str:
         """Fix common JSON formatting issues from LLMs"""
         if not json_str:
@@ -311,11 +1105,1152 @@ class ToolFixEngine:
         
         return fixed
 
+class UpstreamPool:
+    """
+    App-lifetime HTTP client session shared by all proxied requests.
+
+    A single ClientSession/TCPConnector pair keeps TCP (and TLS) connections to the
+    backend alive between agent turns, so consecutive requests skip the connect and
+    handshake. Connection reuse is counted through aiohttp tracing hooks and reported
+    in /_health as pool hits (reused connection) and misses (new connection).
+    """
+
+    def __init__(self):
+        self.session: Optional[aiohttp.ClientSession] = None
+        self.hits = 0
+        self.misses = 0
+        self.warmed = 0
+        self._warmup_task: Optional[asyncio.Task] = None
+
+    async def _on_connection_reuse(self, session, ctx, params):
+        self.hits += 1
+
+    async def _on_connection_create(self, session, ctx, params):
+        self.misses += 1
+
+    async def start(self):
+        """Create the shared session using pool settings from the config"""
+        if self.session is not None and not self.session.closed:
+            return
+
+        # Disable certificate verification for backends with self-signed or custom certificates
+        ssl_context = ssl.create_default_context()
+        ssl_context.check_hostname = False
+        ssl_context.verify_mode = ssl.CERT_NONE
+
+        trace_config = aiohttp.TraceConfig()
+        trace_config.on_connection_reuseconn.append(self._on_connection_reuse)
+        trace_config.on_connection_create_end.append(self._on_connection_create)
+
+        connector = aiohttp.TCPConnector(
+            ssl=ssl_context,
+            limit=fix_engine.get_setting('upstream_pool_limit', 100),
+            limit_per_host=fix_engine.get_setting('upstream_limit_per_host', 0),
+            ttl_dns_cache=fix_engine.get_setting('upstream_dns_cache_ttl', 300),
+            keepalive_timeout=fix_engine.get_setting('upstream_keepalive_timeout', 60),
+        )
+        self.session = aiohttp.ClientSession(connector=connector, trace_configs=[trace_config])
+        logger.debug("Upstream connection pool started")
+
+    async def get_session(self) -> aiohttp.ClientSession:
+        """Return the shared session, starting it lazily if the app did not"""
+        if self.session is None or self.session.closed:
+            await self.start()
+        return self.session
+
+    async def warm_up(self, host: str, count: int, path: str):
+        """Open `count` keep-alive connections to the backend ahead of the first request"""
+        session = await self.get_session()
+        timeout = aiohttp.ClientTimeout(total=10)
+
+        async def _connect():
+            try:
+                async with session.get(f"{host}{path}", timeout=timeout) as resp:
+                    await resp.read()
+                    return True
+            except Exception as e:
+                logger.debug(f"Upstream warm-up connection to {host}{path} failed: {e}")
+                return False
+
+        results = await asyncio.gather(*(_connect() for _ in range(count)))
+        self.warmed += sum(results)
+        logger.info(f"Upstream pool warmed with {sum(results)}/{count} connections to {host}")
+
+    def start_warm_up(self, *hosts: str):
+        """Schedule configured warm pre-connects to each backend without blocking startup"""
+        count = fix_engine.get_setting('upstream_warm_connections', 0)
+        if count > 0 and hosts:
+            path = fix_engine.get_setting('upstream_warmup_path', '/health')
+            self._warmup_task = asyncio.ensure_future(
+                asyncio.gather(*(self.warm_up(host, count, path) for host in hosts)))
+
+    async def close(self):
+        if self._warmup_task and not self._warmup_task.done():
+            self._warmup_task.cancel()
+        if self.session is not None and not self.session.closed:
+            await self.session.close()
+        self.session = None
+        logger.debug("Upstream connection pool closed")
+
+    def stats(self) -> Dict[str, Any]:
+        connector = self.session.connector if self.session is not None else None
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'warmed': self.warmed,
+            'limit': connector.limit if connector else None,
+            'limit_per_host': connector.limit_per_host if connector else None,
+        }
+
+def _hash64(data: bytes) -> int:
+    """Stable 64-bit hash for the affinity ring (the builtin hash() is salted per process)"""
+    return int.from_bytes(hashlib.blake2b(data, digest_size=8).digest(), 'big')
+
+# Circuit breaker states, in the order exported by the breaker state gauge
+BREAKER_CLOSED = 'closed'
+BREAKER_HALF_OPEN = 'half_open'
+BREAKER_OPEN = 'open'
+BREAKER_STATES = (BREAKER_CLOSED, BREAKER_HALF_OPEN, BREAKER_OPEN)
+
+class Backend:
+    """One upstream replica, its live request accounting and circuit breaker"""
+    __slots__ = ('url', 'weight', 'outstanding', 'requests', 'errors',
+                 'state', 'consecutive_failures', 'opened_at', 'trials', 'transitions',
+                 'last_error', 'last_probe_at', 'last_probe_ok', 'probe_failures',
+                 'slots_total', 'slots_busy', 'slots_polled_at', 'max_concurrency')
+
+    def __init__(self, url: str, weight: float = 1.0):
+        self.url = url.rstrip('/')
+        self.weight = float(weight) if weight and weight > 0 else 1.0
+        self.outstanding = 0  # Requests currently streaming from this backend
+        self.requests = 0
+        self.errors = 0
+        self.state = BREAKER_CLOSED
+        self.consecutive_failures = 0
+        self.opened_at = 0.0
+        self.trials = 0  # Trial requests in flight while half-open
+        self.transitions = {state: 0 for state in BREAKER_STATES}
+        self.last_error = None
+        self.last_probe_at = None
+        self.last_probe_ok = None
+        self.probe_failures = 0
+        self.slots_total = None  # Decoding slots reported by /slots; None = unknown, not limited
+        self.slots_busy = 0
+        self.slots_polled_at = None
+        self.max_concurrency = 0  # Per-backend admission limit; 0 = backend_max_concurrency
+
+    def has_free_slot(self) -> bool:
+        return self.slots_total is None or self.slots_busy < self.slots_total
+
+    def __repr__(self) -> str:
+        return f"Backend({self.url!r}, weight={self.weight}, outstanding={self.outstanding}, state={self.state})"
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            'url': self.url,
+            'weight': self.weight,
+            'outstanding': self.outstanding,
+            'requests': self.requests,
+            'errors': self.errors,
+            'state': self.state,
+            'consecutive_failures': self.consecutive_failures,
+            'last_error': self.last_error,
+            'last_probe_ok': self.last_probe_ok,
+            'last_probe_age': (round(time.monotonic() - self.last_probe_at, 1)
+                               if self.last_probe_at is not None else None),
+            'probe_failures': self.probe_failures,
+            'transitions': dict(self.transitions),
+            'slots': ({'total': self.slots_total, 'busy': self.slots_busy}
+                      if self.slots_total is not None else None),
+        }
+
+# Request priorities, highest first; a request's rank is its index
+PRIORITIES = ('interactive', 'background')
+
+class AdmissionRejected(Exception):
+    """A request could not be admitted to a backend: queue full (429) or wait timed out (503)"""
+
+    def __init__(self, status: int, message: str):
+        super().__init__(message)
+        self.status = status
+
+class BackendPool:
+    """
+    Weighted least-outstanding-requests selection across backend replicas.
+
+    A streaming generation holds its backend for its whole duration, so new requests
+    go to the replica with the fewest open streams per unit of weight rather than the
+    next one in turn. Ties rotate, so idle replicas share the first requests evenly.
+    Backends come from the `backends` setting; without it the pool holds TARGET_HOST.
+
+    Each backend has a circuit breaker fed by request outcomes and a background prober.
+    After `breaker_failure_threshold` consecutive failures it opens and the backend is
+    skipped. After `breaker_reset_timeout` seconds, or on a successful probe, it
+    half-opens and admits a few trial requests. A successful trial closes it again;
+    a failed one reopens it.
+
+    With `routing_mode: prefix_affinity`, requests carrying an affinity key (a hash of
+    their stable prompt prefix) are placed on a consistent hash ring instead, so turns
+    of one conversation reach the replica that already has the prefix in its KV cache.
+    Load is bounded: a backend is skipped along the ring while its open streams reach
+    `affinity_load_factor` times its weighted share of the current load.
+
+    With `slot_aware_routing`, llama.cpp `/slots` occupancy is polled on each backend,
+    and only backends with a free decoding slot are selected. Between polls, the
+    busy count follows the proxy's own dispatches and completions.
+
+    A backend also stops taking requests at its concurrency limit (`max_concurrency`
+    or `backend_max_concurrency`). When no backend has capacity, requests wait in a
+    priority queue in the proxy rather than inside a saturated server: interactive
+    turns ahead of background work, FIFO within a priority.
+    """
+
+    def __init__(self):
+        self._configured: List[Backend] = []
+        self._default: Optional[Backend] = None
+        self._turn = 0
+        self._probe_task: Optional[asyncio.Task] = None
+        self._slots_task: Optional[asyncio.Task] = None
+        self._waiters: List[tuple] = []  # Heap of (rank, seq, future)
+        self._waiter_seq = itertools.count()
+        self.queue_depth = {priority: 0 for priority in PRIORITIES}
+        self.queued = {priority: 0 for priority in PRIORITIES}
+        self.queue_timeouts = {priority: 0 for priority in PRIORITIES}
+        self.queue_rejected = {priority: 0 for priority in PRIORITIES}
+        self._ring_signature = None
+        self._ring_points: List[int] = []
+        self._ring_owners: List[Backend] = []
+        self._last_backend: 'OrderedDict[int, str]' = OrderedDict()  # Affinity key -> backend url
+        self.affinity_routed = 0
+        self.affinity_home = 0
+        self.affinity_spilled = 0
+        self.prefix_repeats = 0
+        self.prefix_repeat_hits = 0
+
+    def configure(self, backend_settings):
+        """(Re)load backends from config, keeping counters of replicas that stay"""
+        existing = {backend.url: backend for backend in self._configured}
+        backends = []
+        for entry in backend_settings or []:
+            if isinstance(entry, str):
+                entry = {'url': entry}
+            url = str(entry['url']).rstrip('/')
+            weight = entry.get('weight', 1.0)
+            backend = existing.get(url) or Backend(url)
+            backend.weight = float(weight) if weight and weight > 0 else 1.0
+            backend.max_concurrency = entry.get('max_concurrency', 0) or 0
+            backends.append(backend)
+        self._configured = backends
+        if backends:
+            logger.info(f"Backend pool: {', '.join(f'{b.url} (weight {b.weight})' for b in backends)}")
+
+    @property
+    def backends(self) -> List[Backend]:
+        if self._configured:
+            return self._configured
+        if self._default is None or self._default.url != TARGET_HOST.rstrip('/'):
+            self._default = Backend(TARGET_HOST)
+        return [self._default]
+
+    def urls(self) -> List[str]:
+        return [backend.url for backend in self.backends]
+
+    def is_available(self, backend: Backend, now: float) -> bool:
+        """Whether the breaker admits a request, half-opening it once the reset timeout passed"""
+        if backend.state == BREAKER_CLOSED:
+            return True
+        if backend.state == BREAKER_OPEN:
+            if now - backend.opened_at < fix_engine.get_setting('breaker_reset_timeout', 10):
+                return False
+            self._transition(backend, BREAKER_HALF_OPEN, "reset timeout elapsed")
+        return backend.trials < fix_engine.get_setting('breaker_half_open_requests', 1)
+
+    def select(self, exclude=(), affinity_key: Optional[int] = None) -> Optional[Backend]:
+        """Pick a backend for a request: by prefix affinity when keyed, else least outstanding"""
+        now = time.monotonic()
+        backends = [backend for backend in self.backends
+                    if backend not in exclude and self.is_available(backend, now)]
+        if backends and self.queue_enabled():
+            backends = [backend for backend in backends if self.has_capacity(backend)]
+        if not backends:
+            return None
+        if affinity_key is not None:
+            backend = self._select_affine(affinity_key, backends)
+            if backend is not None:
+                self._record_affinity(affinity_key, backend, first_attempt=not exclude)
+                return backend
+        return self._least_outstanding(backends)
+
+    def _least_outstanding(self, backends: List[Backend]) -> Backend:
+        """The backend with the lowest (outstanding + 1) / weight, rotating ties"""
+        self._turn += 1
+        count = len(backends)
+        best = None
+        best_score = None
+        for offset in range(count):
+            backend = backends[(self._turn + offset) % count]
+            score = (backend.outstanding + 1) / backend.weight
+            if best_score is None or score < best_score:
+                best, best_score = backend, score
+        return best
+
+    def _ring(self):
+        """Consistent hash ring with virtual nodes in proportion to weight, rebuilt on change"""
+        backends = self.backends
+        vnodes = fix_engine.get_setting('affinity_virtual_nodes', 100)
+        signature = (vnodes, tuple((backend.url, backend.weight) for backend in backends))
+        if signature != self._ring_signature:
+            points = []
+            for backend in backends:
+                for replica in range(max(1, round(vnodes * backend.weight))):
+                    points.append((_hash64(f"{backend.url}#{replica}".encode('utf-8')), backend))
+            points.sort(key=lambda point: point[0])
+            self._ring_points = [point for point, _ in points]
+            self._ring_owners = [owner for _, owner in points]
+            self._ring_signature = signature
+        return self._ring_points, self._ring_owners
+
+    def _select_affine(self, affinity_key: int, candidates: List[Backend]) -> Optional[Backend]:
+        """Walk the ring clockwise from the key to the first candidate under its load bound"""
+        points, owners = self._ring()
+        total_weight = sum(backend.weight for backend in candidates)
+        total_load = sum(backend.outstanding for backend in candidates) + 1
+        load_factor = fix_engine.get_setting('affinity_load_factor', 1.25)
+        start = bisect_left(points, affinity_key)
+        seen = set()
+        home = None
+        for step in range(len(points)):
+            backend = owners[(start + step) % len(points)]
+            if backend.url in seen:
+                continue
+            seen.add(backend.url)
+            if home is None:
+                home = backend
+            if backend in candidates:
+                capacity = math.ceil(load_factor * total_load * backend.weight / total_weight)
+                if backend.outstanding < capacity:
+                    self.affinity_routed += 1
+                    if backend is home:
+                        self.affinity_home += 1
+                    else:
+                        self.affinity_spilled += 1
+                    return backend
+            if len(seen) == len(self.backends):
+                break
+        return None
+
+    def _record_affinity(self, affinity_key: int, backend: Backend, first_attempt: bool):
+        """Remember where a prefix went, counting repeats that land on the same replica"""
+        previous = self._last_backend.pop(affinity_key, None)
+        if first_attempt and previous is not None:
+            self.prefix_repeats += 1
+            if previous == backend.url:
+                self.prefix_repeat_hits += 1
+        self._last_backend[affinity_key] = backend.url
+        if len(self._last_backend) > fix_engine.get_setting('affinity_table_size', 4096):
+            self._last_backend.popitem(last=False)
+
+    def affinity_key(self, body) -> Optional[int]:
+        """
+        Hash of the stable prompt prefix of a parsed request body, or None when
+        prefix affinity is off or the body has no prompt.
+
+        The prefix is the model, the tool schemas, every leading system message and
+        the first `affinity_prefix_messages` other messages; these stay the same for
+        every turn of a conversation while the history after them grows.
+        """
+        if fix_engine.get_setting('routing_mode', 'least_outstanding') != 'prefix_affinity':
+            return None
+        if not isinstance(body, dict):
+            return None
+        messages = body.get('messages')
+        if isinstance(messages, list) and messages:
+            count = 0
+            while count < len(messages) and isinstance(messages[count], dict) \
+                    and messages[count].get('role') in ('system', 'developer'):
+                count += 1
+            count += fix_engine.get_setting('affinity_prefix_messages', 1)
+            prefix = [body.get('model'), body.get('tools'), messages[:count]]
+        elif isinstance(body.get('prompt'), str):
+            prefix = [body.get('model'), body['prompt'][:fix_engine.get_setting('affinity_prompt_chars', 4096)]]
+        else:
+            return None
+        return _hash64(json_codec.dumps_bytes(prefix))
+
+    def affinity_stats(self) -> Dict[str, Any]:
+        return {
+            'mode': fix_engine.get_setting('routing_mode', 'least_outstanding'),
+            'routed': self.affinity_routed,
+            'home': self.affinity_home,
+            'spilled': self.affinity_spilled,
+            'prefix_repeats': self.prefix_repeats,
+            'prefix_repeat_hits': self.prefix_repeat_hits,
+            'hit_rate': round(self.prefix_repeat_hits / self.prefix_repeats, 4) if self.prefix_repeats else None,
+        }
+
+    def acquire(self, backend: Backend):
+        backend.outstanding += 1
+        backend.requests += 1
+        backend.slots_busy += 1
+        if backend.state == BREAKER_HALF_OPEN:
+            backend.trials += 1
+
+    def release(self, backend: Backend):
+        backend.outstanding = max(backend.outstanding - 1, 0)
+        backend.slots_busy = max(backend.slots_busy - 1, 0)
+        if backend.trials:
+            backend.trials -= 1
+        self._wake_waiters(1)
+
+    def queue_enabled(self) -> bool:
+        """Whether any limit can make requests wait: slot-aware routing or a concurrency limit"""
+        return bool(fix_engine.get_setting('slot_aware_routing', False)
+                    or fix_engine.get_setting('backend_max_concurrency', 0)
+                    or any(backend.max_concurrency for backend in self._configured))
+
+    def has_capacity(self, backend: Backend) -> bool:
+        limit = backend.max_concurrency or fix_engine.get_setting('backend_max_concurrency', 0)
+        if limit and backend.outstanding >= limit:
+            return False
+        return not fix_engine.get_setting('slot_aware_routing', False) or backend.has_free_slot()
+
+    async def acquire_backend(self, exclude=(), affinity_key: Optional[int] = None,
+                              priority: str = PRIORITIES[0]) -> Optional[Backend]:
+        """
+        Select and acquire a backend for a request.
+
+        Returns None when no backend is healthy. When every backend is at capacity, waits
+        in the priority queue and raises AdmissionRejected: 429 when max_queue_size
+        requests are already waiting, 503 after queue_timeout seconds.
+        """
+        rank = PRIORITIES.index(priority)
+        if not any(self.queue_depth[ahead] for ahead in PRIORITIES[:rank + 1]):
+            backend = self.select(exclude, affinity_key)
+            if backend is not None:
+                self.acquire(backend)
+                return backend
+        if not self.queue_enabled() or not self._has_healthy(exclude):
+            return None
+
+        max_queue_size = fix_engine.get_setting('max_queue_size', 100)
+        if max_queue_size and sum(self.queue_depth.values()) >= max_queue_size:
+            self.queue_rejected[priority] += 1
+            raise AdmissionRejected(429, f"request queue is full ({max_queue_size} waiting)")
+
+        loop = asyncio.get_running_loop()
+        started = time.monotonic()
+        deadline = started + fix_engine.get_setting('queue_timeout', 30)
+        seq = next(self._waiter_seq)
+        self.queue_depth[priority] += 1
+        self.queued[priority] += 1
+        waiter = None
+        try:
+            while True:
+                # A waiter woken too late for the capacity keeps its place in the queue
+                waiter = loop.create_future()
+                heapq.heappush(self._waiters, (rank, seq, waiter))
+                try:
+                    await asyncio.wait_for(waiter, deadline - time.monotonic())
+                except asyncio.TimeoutError:
+                    self.queue_timeouts[priority] += 1
+                    raise AdmissionRejected(
+                        503, f"no backend capacity within {time.monotonic() - started:.1f}s")
+                backend = self.select(exclude, affinity_key)
+                if backend is not None:
+                    self.acquire(backend)
+                    proxy_metrics.queue_wait[priority].observe(time.monotonic() - started)
+                    # Let the next request in line check for more capacity
+                    self._wake_waiters(1)
+                    return backend
+                if not self._has_healthy(exclude):
+                    return None
+        finally:
+            self.queue_depth[priority] -= 1
+            if waiter is not None and not waiter.done():
+                waiter.cancel()
+
+    def _has_healthy(self, exclude=()) -> bool:
+        now = time.monotonic()
+        return any(backend not in exclude and self.is_available(backend, now) for backend in self.backends)
+
+    def _wake_waiters(self, count: int):
+        """Wake up to `count` queued requests, highest priority and oldest first"""
+        while count > 0 and self._waiters:
+            _, _, waiter = heapq.heappop(self._waiters)
+            if not waiter.done():
+                waiter.set_result(None)
+                count -= 1
+
+    def record_success(self, backend: Backend):
+        backend.consecutive_failures = 0
+        if backend.state != BREAKER_CLOSED:
+            self._transition(backend, BREAKER_CLOSED, "request succeeded")
+
+    def record_failure(self, backend: Backend, reason: str):
+        backend.consecutive_failures += 1
+        backend.last_error = reason
+        threshold = fix_engine.get_setting('breaker_failure_threshold', 3)
+        if backend.state == BREAKER_HALF_OPEN or (
+                backend.state == BREAKER_CLOSED and threshold and backend.consecutive_failures >= threshold):
+            self._transition(backend, BREAKER_OPEN, reason)
+
+    def record_response(self, backend: Backend, status: int):
+        """Feed the breaker from a backend response status; 5xx counts as a failure"""
+        if status >= 500:
+            self.record_failure(backend, f"HTTP {status}")
+        else:
+            self.record_success(backend)
+
+    def _transition(self, backend: Backend, state: str, reason: str):
+        previous = backend.state
+        backend.state = state
+        backend.transitions[state] += 1
+        if state == BREAKER_OPEN:
+            backend.opened_at = time.monotonic()
+        if state != BREAKER_HALF_OPEN:
+            backend.trials = 0
+        message = f"Backend {backend.url} circuit {previous} -> {state} ({reason})"
+        if state == BREAKER_OPEN:
+            console_logger.warning(f"⚠️  {message}")
+        else:
+            console_logger.info(f"🔁 {message}")
+        logger.info(message)
+
+    def request_timeout(self) -> aiohttp.ClientTimeout:
+        """Per-request timeout: bounded connect so a dead backend fails fast, aiohttp's default total"""
+        return aiohttp.ClientTimeout(total=300, sock_connect=fix_engine.get_setting('upstream_connect_timeout', 5))
+
+    async def probe(self, backend: Backend):
+        """One health probe; a failure counts towards the breaker, a success half-opens an open one"""
+        path = fix_engine.get_setting('health_check_path', '/health')
+        timeout = aiohttp.ClientTimeout(total=fix_engine.get_setting('health_check_timeout', 2))
+        try:
+            session = await upstream_pool.get_session()
+            async with session.get(f"{backend.url}{path}", timeout=timeout) as resp:
+                await resp.read()
+                ok = resp.status < 500
+                reason = f"probe HTTP {resp.status}"
+        except Exception as e:
+            ok = False
+            reason = f"probe {type(e).__name__}: {e}" if str(e) else f"probe {type(e).__name__}"
+
+        backend.last_probe_at = time.monotonic()
+        backend.last_probe_ok = ok
+        if not ok:
+            backend.probe_failures += 1
+            self.record_failure(backend, reason)
+        elif backend.state == BREAKER_OPEN:
+            self._transition(backend, BREAKER_HALF_OPEN, "probe succeeded")
+        elif backend.state == BREAKER_CLOSED:
+            backend.consecutive_failures = 0
+
+    async def poll_slots(self, backend: Backend):
+        """Read slot occupancy from a llama.cpp /slots endpoint"""
+        path = fix_engine.get_setting('slots_path', '/slots')
+        timeout = aiohttp.ClientTimeout(total=fix_engine.get_setting('health_check_timeout', 2))
+        try:
+            session = await upstream_pool.get_session()
+            async with session.get(f"{backend.url}{path}", timeout=timeout) as resp:
+                if resp.status in (404, 501):
+                    # Slots endpoint disabled (llama.cpp --no-slots) or not llama.cpp
+                    if backend.slots_total is not None or backend.slots_polled_at is None:
+                        logger.info(f"Backend {backend.url} has no {path} endpoint, not slot-limited")
+                    backend.slots_total = None
+                    backend.slots_polled_at = time.monotonic()
+                    return
+                slots = json_codec.loads(await resp.read())
+        except Exception as e:
+            logger.debug(f"Slot poll of {backend.url} failed: {e}")
+            return
+
+        if not isinstance(slots, list):
+            return
+        busy = 0
+        for slot in slots:
+            if isinstance(slot, dict) and (slot.get('is_processing') or slot.get('state', 0) != 0):
+                busy += 1
+        # Streams the proxy holds occupy slots even if the snapshot predates them
+        backend.slots_total = len(slots)
+        backend.slots_busy = max(busy, backend.outstanding)
+        backend.slots_polled_at = time.monotonic()
+        if busy < backend.slots_total:
+            self._wake_waiters(backend.slots_total - busy)
+
+    async def _slots_loop(self):
+        while fix_engine.get_setting('slot_aware_routing', False):
+            await asyncio.gather(*(self.poll_slots(backend) for backend in self.backends))
+            await asyncio.sleep(fix_engine.get_setting('slots_poll_interval', 1.0))
+
+    async def _probe_loop(self):
+        while fix_engine.get_setting('health_check_interval', 5) > 0:
+            await asyncio.gather(*(self.probe(backend) for backend in self.backends))
+            await asyncio.sleep(fix_engine.get_setting('health_check_interval', 5))
+
+    def start(self):
+        """Start background health probing and, with slot-aware routing, slot polling"""
+        if fix_engine.get_setting('health_check_interval', 5) > 0:
+            if self._probe_task is None or self._probe_task.done():
+                self._probe_task = asyncio.create_task(self._probe_loop())
+        if fix_engine.get_setting('slot_aware_routing', False):
+            if self._slots_task is None or self._slots_task.done():
+                self._slots_task = asyncio.create_task(self._slots_loop())
+
+    async def close(self):
+        for task in (self._probe_task, self._slots_task):
+            if task is not None:
+                task.cancel()
+                try:
+                    await task
+                except asyncio.CancelledError:
+                    pass
+        self._probe_task = None
+        self._slots_task = None
+
+    def queue_stats(self) -> Dict[str, Any]:
+        return {
+            'enabled': self.queue_enabled(),
+            'waiting': dict(self.queue_depth),
+            'queued': dict(self.queued),
+            'timeouts': dict(self.queue_timeouts),
+            'rejected': dict(self.queue_rejected),
+        }
+
+    def stats(self) -> List[Dict[str, Any]]:
+        return [backend.stats() for backend in self.backends]
+
+class HoldbackStats:
+    """Counters for content held back while an XML tool call might be starting"""
+
+    def __init__(self):
+        self.held_bytes = 0  # Bytes not forwarded in the delta they arrived in
+        self.released_bytes = 0  # Held bytes later forwarded as plain content
+        self.converted_bytes = 0  # Held bytes replaced by a converted tool call
+        self.releases = 0
+        self.total_delay = 0.0
+        self.max_delay = 0.0
+
+    def record_release(self, nbytes: int, delay: float):
+        self.released_bytes += nbytes
+        self.releases += 1
+        self.total_delay += delay
+        self.max_delay = max(self.max_delay, delay)
+
+    def as_dict(self) -> Dict[str, Any]:
+        return {
+            'held_bytes': self.held_bytes,
+            'released_bytes': self.released_bytes,
+            'converted_bytes': self.converted_bytes,
+            'releases': self.releases,
+            'avg_delay_ms': round(self.total_delay / self.releases * 1000, 3) if self.releases else 0.0,
+            'max_delay_ms': round(self.max_delay * 1000, 3),
+        }
+
+class Histogram:
+    """Fixed-bucket histogram rendered in the Prometheus text format"""
+    __slots__ = ('name', 'help', 'buckets', 'labels', 'counts', 'sum', 'count')
+
+    def __init__(self, name: str, help_text: str, buckets: tuple, labels: str = ''):
+        self.name = name
+        self.help = help_text
+        self.buckets = buckets
+        self.labels = labels  # Rendered label pairs, e.g. 'priority="interactive"'
+        self.counts = [0] * (len(buckets) + 1)  # Last slot is +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, q: float) -> Optional[float]:
+        """Upper bound of the bucket holding the q-quantile; None before any observation"""
+        if not self.count:
+            return None
+        target = q * self.count
+        cumulative = 0
+        for bound, count in zip(self.buckets, self.counts):
+            cumulative += count
+            if cumulative >= target:
+                return bound
+        return self.buckets[-1]
+
+    def render(self, header: bool = True) -> List[str]:
+        """Text-format lines; pass header=False for further label sets of the same metric"""
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"] if header else []
+        prefix = f"{self.labels}," if self.labels else ""
+        series = f"{{{self.labels}}}" if self.labels else ""
+        cumulative = 0
+        for bound, count in zip(self.buckets, self.counts):
+            cumulative += count
+            lines.append(f'{self.name}_bucket{{{prefix}le="{bound}"}} {cumulative}')
+        lines.append(f'{self.name}_bucket{{{prefix}le="+Inf"}} {self.count}')
+        lines.append(f"{self.name}_sum{series} {self.sum}")
+        lines.append(f"{self.name}_count{series} {self.count}")
+        return lines
+
+def _metric_label(value: str) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+class ProxyMetrics:
+    """Latency histograms and counters exported on /_metrics"""
+
+    LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+    GAP_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+    PROCESSING_BUCKETS = (0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.05)
+    ASSEMBLY_BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+
+    def __init__(self):
+        self.started_at = time.monotonic()
+        self.backend_ttfb = Histogram(
+            'qwen3_proxy_backend_ttfb_seconds', 'Time from request start to the first event from the backend',
+            self.LATENCY_BUCKETS)
+        self.client_ttfb = Histogram(
+            'qwen3_proxy_client_ttfb_seconds', 'Time from request start to the first event written to the client',
+            self.LATENCY_BUCKETS)
+        self.event_gap = Histogram(
+            'qwen3_proxy_sse_event_gap_seconds', 'Time between consecutive SSE data events from the backend',
+            self.GAP_BUCKETS)
+        self.event_processing = Histogram(
+            'qwen3_proxy_sse_event_processing_seconds', 'Time the proxy spends on one SSE event before writing it',
+            self.PROCESSING_BUCKETS)
+        self.tool_call_assembly = Histogram(
+            'qwen3_proxy_tool_call_assembly_seconds', 'Time from the first fragment of a tool call to its emission',
+            self.ASSEMBLY_BUCKETS)
+        self.queue_wait = {
+            priority: Histogram('qwen3_proxy_queue_wait_seconds',
+                                'Time a request waited in the proxy for backend capacity, by priority',
+                                self.LATENCY_BUCKETS, labels=f'priority="{priority}"')
+            for priority in PRIORITIES
+        }
+        self.requests_total = 0
+        self.legacy_retries = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.client_writes = 0
+        self.fix_hits: Dict[tuple, int] = {}
+        self.hedges_sent = 0
+        self.hedges_won = 0
+        self.stream_continuations = 0
+        self.stream_continuation_failures = 0
+
+    def record_fixes(self, tool_name: str, fix_names: List[str]):
+        for fix_name in fix_names:
+            key = (tool_name, fix_name)
+            self.fix_hits[key] = self.fix_hits.get(key, 0) + 1
+
+    def observe_tool_call(self, buffer: 'ToolBuffer'):
+        self.tool_call_assembly.observe(time.monotonic() - buffer.created_at)
+
+    def render(self) -> str:
+        lines = []
+        for histogram in (self.backend_ttfb, self.client_ttfb, self.event_gap,
+                          self.event_processing, self.tool_call_assembly):
+            lines.extend(histogram.render())
+        for position, priority in enumerate(PRIORITIES):
+            lines.extend(self.queue_wait[priority].render(header=position == 0))
+
+        counters = (
+            ('qwen3_proxy_requests_total', 'Proxied requests', self.requests_total),
+            ('qwen3_proxy_legacy_retries_total', 'Requests retried in legacy API mode', self.legacy_retries),
+            ('qwen3_proxy_hedges_sent_total', 'Duplicate requests sent after a slow first byte', self.hedges_sent),
+            ('qwen3_proxy_hedges_won_total', 'Hedged requests where the duplicate answered first', self.hedges_won),
+            ('qwen3_proxy_stream_continuations_total', 'Streams continued on a backend after a mid-stream failure',
+             self.stream_continuations),
+            ('qwen3_proxy_stream_continuation_failures_total', 'Mid-stream failures that could not be continued',
+             self.stream_continuation_failures),
+            ('qwen3_proxy_bytes_in_total', 'Bytes received from the backend stream', self.bytes_in),
+            ('qwen3_proxy_bytes_out_total', 'Bytes written to clients', self.bytes_out),
+            ('qwen3_proxy_client_writes_total', 'Writes to client connections, after coalescing',
+             self.client_writes),
+            ('qwen3_proxy_upstream_connections_reused_total', 'Requests served on a pooled connection',
+             upstream_pool.hits),
+            ('qwen3_proxy_upstream_connections_created_total', 'New connections opened to the backend',
+             upstream_pool.misses),
+            ('qwen3_proxy_holdback_bytes_total', 'Content bytes held back for possible XML tool calls',
+             holdback_stats.held_bytes),
+            ('qwen3_proxy_buffers_evicted_total', 'Idle tool call buffers evicted by the expiry scheduler',
+             expiry_scheduler.buffers_evicted),
+            ('qwen3_proxy_requests_reaped_total', 'Abandoned request states reaped by the expiry scheduler',
+             expiry_scheduler.requests_reaped),
+            ('qwen3_proxy_affinity_home_total', 'Prefix-affinity requests routed to their home backend',
+             backend_pool.affinity_home),
+            ('qwen3_proxy_affinity_spilled_total', 'Prefix-affinity requests moved off their home backend by load',
+             backend_pool.affinity_spilled),
+            ('qwen3_proxy_affinity_prefix_repeats_total', 'Requests whose prompt prefix was seen before',
+             backend_pool.prefix_repeats),
+            ('qwen3_proxy_affinity_prefix_repeat_hits_total',
+             'Repeated prompt prefixes routed to the same backend as last time', backend_pool.prefix_repeat_hits),
+        )
+        for name, help_text, value in counters:
+            lines.extend((f"# HELP {name} {help_text}", f"# TYPE {name} counter", f"{name} {value}"))
+
+        queue_series = (
+            ('qwen3_proxy_queue_depth', 'Requests waiting in the proxy for backend capacity', 'gauge',
+             backend_pool.queue_depth),
+            ('qwen3_proxy_queue_timeouts_total', 'Requests that gave up waiting for backend capacity', 'counter',
+             backend_pool.queue_timeouts),
+            ('qwen3_proxy_queue_rejected_total', 'Requests rejected because the queue was full', 'counter',
+             backend_pool.queue_rejected),
+        )
+        for name, help_text, kind, values in queue_series:
+            lines.extend((f"# HELP {name} {help_text}", f"# TYPE {name} {kind}"))
+            lines.extend(f'{name}{{priority="{priority}"}} {values[priority]}' for priority in PRIORITIES)
+
+        lines.extend(('# HELP qwen3_proxy_fix_applied_total Fix rules applied, by tool and rule',
+                      '# TYPE qwen3_proxy_fix_applied_total counter'))
+        for (tool_name, fix_name), count in sorted(self.fix_hits.items()):
+            lines.append(f'qwen3_proxy_fix_applied_total{{tool="{_metric_label(tool_name)}",'
+                         f'rule="{_metric_label(fix_name)}"}} {count}')
+
+        backend_series = (
+            ('qwen3_proxy_backend_outstanding', 'Streams currently open to each backend', 'gauge', 'outstanding'),
+            ('qwen3_proxy_backend_requests_total', 'Requests routed to each backend', 'counter', 'requests'),
+            ('qwen3_proxy_backend_errors_total', 'Requests that failed on each backend', 'counter', 'errors'),
+            ('qwen3_proxy_backend_probe_failures_total', 'Failed health probes per backend', 'counter',
+             'probe_failures'),
+        )
+        for name, help_text, kind, field in backend_series:
+            lines.extend((f"# HELP {name} {help_text}", f"# TYPE {name} {kind}"))
+            for backend in backend_pool.backends:
+                lines.append(f'{name}{{backend="{_metric_label(backend.url)}"}} {getattr(backend, field)}')
+
+        for name, help_text, field in (
+                ('qwen3_proxy_backend_slots_busy', 'Busy decoding slots per backend (from /slots)', 'slots_busy'),
+                ('qwen3_proxy_backend_slots_total', 'Decoding slots per backend (from /slots)', 'slots_total')):
+            lines.extend((f"# HELP {name} {help_text}", f"# TYPE {name} gauge"))
+            for backend in backend_pool.backends:
+                if backend.slots_total is not None:
+                    lines.append(f'{name}{{backend="{_metric_label(backend.url)}"}} {getattr(backend, field)}')
+
+        lines.extend(('# HELP qwen3_proxy_backend_breaker_state Circuit breaker state per backend '
+                      '(0 = closed, 1 = half-open, 2 = open)',
+                      '# TYPE qwen3_proxy_backend_breaker_state gauge'))
+        for backend in backend_pool.backends:
+            lines.append(f'qwen3_proxy_backend_breaker_state{{backend="{_metric_label(backend.url)}"}} '
+                         f'{BREAKER_STATES.index(backend.state)}')
+        lines.extend(('# HELP qwen3_proxy_backend_breaker_transitions_total Circuit breaker transitions, '
+                      'by backend and new state',
+                      '# TYPE qwen3_proxy_backend_breaker_transitions_total counter'))
+        for backend in backend_pool.backends:
+            for state, count in backend.transitions.items():
+                lines.append(f'qwen3_proxy_backend_breaker_transitions_total{{backend="{_metric_label(backend.url)}",'
+                             f'state="{state}"}} {count}')
+
+        gauges = (
+            ('qwen3_proxy_active_requests', 'Requests currently being streamed', len(request_states)),
+            ('qwen3_proxy_tool_buffers', 'Tool call buffers currently open',
+             sum(len(state.tool_buffers) for state in request_states.values())),
+            ('qwen3_proxy_uptime_seconds', 'Seconds since the proxy started', round(self.uptime(), 3)),
+        )
+        for name, help_text, value in gauges:
+            lines.extend((f"# HELP {name} {help_text}", f"# TYPE {name} gauge", f"{name} {value}"))
+        return "\n".join(lines) + "\n"
+
+    def uptime(self) -> float:
+        return time.monotonic() - self.started_at
+
+class ExpiryScheduler:
+    """
+    Process-wide expiry of idle tool buffers and abandoned request states.
+
+    One task sleeps until the earliest deadline in a heap of monotonic deadlines.
+    Entries are rescheduled lazily: activity only refreshes last_activity on the
+    buffer or request, and a popped entry whose owner was active since is pushed
+    back with its new deadline instead of being evicted.
+    """
+
+    def __init__(self):
+        self._heap: List[tuple] = []
+        self._counter = itertools.count()
+        self._wakeup: Optional[asyncio.Event] = None
+        self._task: Optional[asyncio.Task] = None
+        self.buffers_evicted = 0
+        self.requests_reaped = 0
+
+    def start(self):
+        if self._task is None or self._task.done():
+            self._wakeup = asyncio.Event()
+            self._task = asyncio.create_task(self._run())
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        self._heap.clear()
+
+    def _schedule(self, deadline: float, entry: tuple):
+        # Nothing drains the heap until the scheduler runs (e.g. when used without the app)
+        if self._task is None:
+            return
+        earliest = self._heap[0][0] if self._heap else None
+        heapq.heappush(self._heap, (deadline, next(self._counter)) + entry)
+        if earliest is None or deadline < earliest:
+            self._wakeup.set()
+
+    def track_buffer(self, request_id: str, buffer_key: str, buffer: 'ToolBuffer'):
+        timeout = fix_engine.get_setting('buffer_timeout', 30)
+        self._schedule(buffer.last_activity + timeout, ('buffer', request_id, buffer_key, buffer))
+
+    def track_request(self, request_state: 'RequestState'):
+        timeout = fix_engine.get_setting('request_state_timeout', 600)
+        self._schedule(request_state.last_activity + timeout, ('request', request_state.request_id, None, request_state))
+
+    async def _run(self):
+        while True:
+            try:
+                timeout = self._heap[0][0] - time.monotonic() if self._heap else None
+                if timeout is None or timeout > 0:
+                    self._wakeup.clear()
+                    try:
+                        await asyncio.wait_for(self._wakeup.wait(), timeout)
+                    except asyncio.TimeoutError:
+                        pass
+                    continue
+                self.expire_due(time.monotonic())
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Expiry scheduler error: {e}")
+
+    def expire_due(self, now: float):
+        """Evict every entry whose deadline has passed without new activity"""
+        buffer_timeout = fix_engine.get_setting('buffer_timeout', 30)
+        request_timeout = fix_engine.get_setting('request_state_timeout', 600)
+        while self._heap and self._heap[0][0] <= now:
+            _, _, kind, request_id, buffer_key, owner = heapq.heappop(self._heap)
+            request_state = request_states.get(request_id)
+            if kind == 'buffer':
+                if request_state is None or request_state.tool_buffers.get(buffer_key) is not owner:
+                    continue  # Buffer already emitted or request finished
+                deadline = owner.last_activity + buffer_timeout
+                if deadline > now:
+                    heapq.heappush(self._heap, (deadline, next(self._counter), kind, request_id, buffer_key, owner))
+                    continue
+                logger.warning(f"[{request_id}] Cleaning up expired buffer: {buffer_key}")
+                del request_state.tool_buffers[buffer_key]
+                self.buffers_evicted += 1
+            else:
+                if request_state is not owner:
+                    continue  # Handler cleaned up normally
+                deadline = owner.last_activity + request_timeout
+                if deadline > now:
+                    heapq.heappush(self._heap, (deadline, next(self._counter), kind, request_id, buffer_key, owner))
+                    continue
+                logger.warning(f"[{request_id}] Reaping abandoned request state ({len(owner.tool_buffers)} buffers)")
+                del request_states[request_id]
+                self.requests_reaped += 1
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            'scheduled': len(self._heap),
+            'buffers_evicted': self.buffers_evicted,
+            'requests_reaped': self.requests_reaped,
+        }
+
+class LegacyCapabilities:
+    """
+    Which backend and model pairs need the legacy stream reader.
+
+    Entries are keyed by (backend URL, model) and expire after legacy_capability_ttl
+    seconds, so a fixed server goes back to the fast resp.content path. They come
+    from runtime detection (a ClientPayloadError on the fast path, or a stream that
+    completed on it) and from the optional startup probe. When legacy_capability_file
+    is set they are saved there, so a restart does not repeat the failed first
+    attempt. Changes only mark the table dirty; it is written SAVE_DELAY seconds
+    later, and at shutdown, in a worker thread, never from the request path.
+    """
+    SAVE_DELAY = 1.0
+
+    def __init__(self):
+        self._entries: Dict[tuple, Dict[str, Any]] = {}
+        self._probe_task: Optional[asyncio.Task] = None
+        self._save_task: Optional[asyncio.Task] = None
+        self._save_lock = asyncio.Lock()
+        self._dirty = False
+        self.loaded_from = ""
+
+    def lookup(self, backend_url: str, model: Optional[str]) -> Optional[bool]:
+        """True or False when known and fresh, None when this pair was never checked or expired"""
+        entry = self._entries.get((backend_url, model or ""))
+        if entry is None:
+            return None
+        if time.time() - entry['checked_at'] > fix_engine.get_setting('legacy_capability_ttl', 86400):
+            return None
+        return entry['legacy']
+
+    def record(self, backend_url: str, model: Optional[str], legacy: bool, source: str):
+        key = (backend_url, model or "")
+        previous = self._entries.get(key)
+        if previous is not None and previous['legacy'] == legacy and self.lookup(backend_url, model) is not None:
+            return  # Unchanged and still fresh
+        self._entries[key] = {'legacy': legacy, 'checked_at': time.time(), 'source': source}
+        if previous is None or previous['legacy'] != legacy:
+            mode = "legacy" if legacy else "standard"
+            console_logger.info(f"🔄 {backend_url} model {model or '(default)'}: {mode} streaming ({source})")
+        self._schedule_save()
+
+    def confirm(self, backend_url: str, model: Optional[str]):
+        """A stream completed on the fast path: remember it unless already known"""
+        if self.lookup(backend_url, model) is None:
+            self.record(backend_url, model, False, 'runtime')
+
+    def _schedule_save(self):
+        if not fix_engine.get_setting('legacy_capability_file', ''):
+            return
+        self._dirty = True
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            self.save()  # No event loop to block
+            return
+        if self._save_task is None or self._save_task.done():
+            self._save_task = loop.create_task(self._save_later())
+
+    async def _save_later(self):
+        await asyncio.sleep(self.SAVE_DELAY)
+        await self.flush()
+
+    async def flush(self):
+        """Write the table if it changed since the last write, in a worker thread"""
+        async with self._save_lock:
+            if self._dirty:
+                await asyncio.get_running_loop().run_in_executor(None, self.save)
+
+    def save(self):
+        path = fix_engine.get_setting('legacy_capability_file', '')
+        self._dirty = False
+        if not path:
+            return
+        ttl = fix_engine.get_setting('legacy_capability_ttl', 86400)
+        now = time.time()
+        entries = [dict(backend=backend_url, model=model, **entry)
+                   for (backend_url, model), entry in list(self._entries.items()) if now - entry['checked_at'] <= ttl]
+        try:
+            # Write to a temporary file first so a crash never leaves half a table behind
+            with open(f"{path}.tmp", 'w') as f:
+                json.dump({'entries': entries}, f, indent=2)
+            os.replace(f"{path}.tmp", path)
+        except OSError as e:
+            logger.warning(f"Could not save legacy capability table to {path}: {e}")
+
+    def load(self):
+        path = fix_engine.get_setting('legacy_capability_file', '')
+        if not path or not os.path.exists(path):
+            return
+        try:
+            with open(path) as f:
+                entries = json.load(f).get('entries', [])
+            for entry in entries:
+                self._entries[(entry['backend'], entry['model'])] = {
+                    'legacy': bool(entry['legacy']), 'checked_at': float(entry['checked_at']),
+                    'source': entry.get('source', 'runtime'),
+                }
+        except (OSError, ValueError, KeyError, TypeError, AttributeError) as e:
+            logger.warning(f"Ignoring unreadable legacy capability table {path}: {e}")
+            return
+        self.loaded_from = path
+        logger.info(f"Loaded {len(entries)} legacy capability entries from {path}")
+
+    async def probe(self, backend_url: str, model: str):
+        """Stream a one-token completion on the fast path and record whether it parses"""
+        timeout = aiohttp.ClientTimeout(total=fix_engine.get_setting('legacy_probe_timeout', 30))
+        body = {"model": model, "messages": [{"role": "user", "content": "ping"}],
+                "max_tokens": 1, "stream": True}
+        try:
+            session = await upstream_pool.get_session()
+            async with session.post(f"{backend_url}/v1/chat/completions", json=body, timeout=timeout) as resp:
+                if resp.status >= 400:
+                    logger.info(f"Legacy probe of {backend_url} ({model}) answered {resp.status}, skipped")
+                    return
+                await resp.read()
+        except aiohttp.client_exceptions.ClientPayloadError:
+            self.record(backend_url, model, True, 'probe')
+            return
+        except Exception as e:
+            logger.info(f"Legacy probe of {backend_url} ({model}) failed: {type(e).__name__}: {e}")
+            return
+        self.record(backend_url, model, False, 'probe')
+
+    async def _probe_models(self, backend_url: str):
+        models = fix_engine.get_setting('legacy_probe_models') or []
+        if not models:
+            # Ask the backend which models it serves
+            try:
+                session = await upstream_pool.get_session()
+                timeout = aiohttp.ClientTimeout(total=fix_engine.get_setting('legacy_probe_timeout', 30))
+                async with session.get(f"{backend_url}/v1/models", timeout=timeout) as resp:
+                    listing = await resp.json(content_type=None) if resp.status < 400 else {}
+                models = [item['id'] for item in listing.get('data', []) if item.get('id')]
+            except Exception as e:
+                logger.info(f"Could not list models on {backend_url}: {type(e).__name__}: {e}")
+                return
+        for model in models:
+            if self.lookup(backend_url, model) is None:
+                await self.probe(backend_url, model)
+
+    async def probe_all(self, backend_urls: List[str]):
+        await asyncio.gather(*(self._probe_models(url) for url in backend_urls))
+
+    def start(self, backend_urls: List[str]):
+        self.load()
+        if fix_engine.get_setting('legacy_probe', False):
+            self._probe_task = asyncio.ensure_future(self.probe_all(backend_urls))
+
+    async def close(self):
+        if self._probe_task is not None:
+            self._probe_task.cancel()
+            await asyncio.gather(self._probe_task, return_exceptions=True)
+            self._probe_task = None
+        if self._save_task is not None:
+            self._save_task.cancel()
+            await asyncio.gather(self._save_task, return_exceptions=True)
+            self._save_task = None
+        await self.flush()
+
+    def detected(self) -> bool:
+        """Whether any fresh entry needs the legacy reader"""
+        return any(self.lookup(backend_url, model) for backend_url, model in self._entries)
+
+    def stats(self) -> List[Dict[str, Any]]:
+        return [{'backend': backend_url, 'model': model, 'legacy': entry['legacy'], 'source': entry['source'],
+                 'age': round(time.time() - entry['checked_at'], 1),
+                 'fresh': self.lookup(backend_url, model) is not None}
+                for (backend_url, model), entry in self._entries.items()]
+
 # Global instances
 fix_engine = ToolFixEngine(CONFIG_FILE)
+json_codec = JSONCodec(fix_engine.get_setting('json_backend', 'auto'))
+holdback_stats = HoldbackStats()
+proxy_metrics = ProxyMetrics()
+
+def configure_log_rotation():
+    """Apply log file rotation settings from the config"""
+    file_handler.maxBytes = fix_engine.get_setting('log_max_bytes', 50 * 1024 * 1024)
+    file_handler.backupCount = fix_engine.get_setting('log_backup_count', 5)
+
+configure_log_rotation()
+upstream_pool = UpstreamPool()
+backend_pool = BackendPool()
+backend_pool.configure(fix_engine.get_setting('backends'))
+expiry_scheduler = ExpiryScheduler()
+legacy_capabilities = LegacyCapabilities()
 request_states: Dict[str, RequestState] = {}
-# Track if we've detected legacy API mode automatically
-legacy_mode_detected = False
+
+def parse_request_body(data: bytes) -> Optional[dict]:
+    """Parse a JSON request body once; None when empty or not a JSON object"""
+    if not data:
+        return None
+
+    try:
+        body = json_codec.loads(data)
+    except json.JSONDecodeError:
+        return None
+    return body if isinstance(body, dict) else None
 
 def extract_model_from_request(data: bytes) -> Optional[str]:
     """
@@ -323,167 +2258,644 @@ def extract_model_from_request(data: bytes) -> Optional[str]:
 
     Returns model name if found, None otherwise.
     """
-    if not data:
-        return None
+    body = parse_request_body(data)
+    return body.get('model') if body else None
 
-    try:
-        body = json.loads(data)
-        return body.get('model')
-    except (json.JSONDecodeError, AttributeError):
-        return None
+def request_priority(headers, body: Optional[dict]) -> str:
+    """
+    Queue priority of a request, from the first source that names one:
+    the X-Proxy-Priority header, the client's API key in `client_priorities`,
+    then subagent detection, falling back to `default_priority`.
+
+    With `detect_subagents`, a request that offers tools but not `task` is treated
+    as background work: OpenCode gives the task tool only to the primary agent.
+    """
+    priority = headers.get('X-Proxy-Priority', '').strip().lower()
+    if priority in PRIORITIES:
+        return priority
+
+    client_priorities = fix_engine.get_setting('client_priorities') or {}
+    if client_priorities:
+        authorization = headers.get('Authorization', '')
+        api_key = authorization[7:].strip() if authorization[:7].lower() == 'bearer ' else headers.get('X-Api-Key')
+        priority = client_priorities.get(api_key)
+        if priority in PRIORITIES:
+            return priority
 
-def should_use_legacy_mode_for_model(model_name: Optional[str]) -> bool:
+    if fix_engine.get_setting('detect_subagents', False) and body:
+        tools = body.get('tools')
+        if isinstance(tools, list) and tools:
+            names = {fix_engine.normalize_tool_name(str((tool.get('function') or {}).get('name', '')))
+                     for tool in tools if isinstance(tool, dict)}
+            if fix_engine.normalize_tool_name('task') not in names:
+                return 'background'
+
+    priority = fix_engine.get_setting('default_priority', PRIORITIES[0])
+    return priority if priority in PRIORITIES else PRIORITIES[0]
+
+def should_use_legacy_mode_for_model(model_name: Optional[str], backend_url: Optional[str] = None) -> bool:
     """
     Check if a model should use legacy API mode.
 
     Returns True if:
     - Model is in legacy_models list
     - Legacy mode is globally enabled
-    - Legacy mode was auto-detected
+    - The capability table says this backend needs it for this model
     """
-    global legacy_mode_detected
-
     # Check if legacy mode is forced globally
     if fix_engine.get_setting('legacy_api_mode', False):
         return True
 
-    # Check if legacy mode was auto-detected
-    if legacy_mode_detected:
+    # Check if legacy mode was detected for this backend and model
+    if backend_url and legacy_capabilities.lookup(backend_url, model_name):
         return True
 
-    # Check if model is in legacy models list
-    if model_name:
-        legacy_models = fix_engine.get_setting('legacy_models', [])
-        if model_name in legacy_models:
-            return True
+    # Check if model is in legacy models list
+    if model_name:
+        legacy_models = fix_engine.get_setting('legacy_models', [])
+        if model_name in legacy_models:
+            return True
+
+    return False
+
+# A line made only of a chunk size, left behind in the payload by broken chunked framing
+_CHUNK_SIZE_LINE = re.compile(rb'[0-9a-fA-F]+(;[^\r\n]*)?\r?\n')
+
+class LegacyHTTPProtocol(asyncio.Protocol):
+    """
+    Minimal HTTP/1.1 response parser for backends with broken framing.
+
+    Status line and headers are parsed here, not by aiohttp. Chunked bodies are
+    de-chunked while the framing is valid. On the first malformed size line or
+    missing chunk terminator the parser switches to salvage mode and passes the
+    remaining bytes through as they are, so the SSE payload still gets through.
+    The body ends at the terminating chunk, at Content-Length, or when the server
+    closes the connection, whichever comes first.
+    """
+
+    MAX_HEAD = 64 * 1024  # Give up on a response whose headers never end
+    HIGH_WATER = 1024 * 1024  # Pause the socket while this much payload is unread
+
+    def __init__(self):
+        self.transport: Optional[asyncio.Transport] = None
+        self.status = 0
+        self.reason = ""
+        self.headers = CIMultiDict()
+        self.payload = bytearray()  # De-framed body bytes not yet read
+        self._scanned = 0  # Bytes of payload already searched for a newline
+        self.eof = False
+        self.salvaged = False
+        self.paused = False
+        self.headers_received = asyncio.get_event_loop().create_future()
+        self._head = bytearray()
+        self._raw = bytearray()  # Partial chunk size line or CRLF held until the next read
+        self._chunked = False
+        self._length: Optional[int] = None  # Body bytes still expected with Content-Length
+        self._chunk_left = 0
+        self._expect_crlf = False
+        self._waiter: Optional[asyncio.Future] = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def data_received(self, data: bytes):
+        if not self.headers_received.done():
+            self._head += data
+            end = self._head.find(b"\r\n\r\n")
+            if end < 0:
+                if len(self._head) > self.MAX_HEAD:
+                    self.headers_received.set_exception(ConnectionError("Response headers too large"))
+                    self.transport.close()
+                return
+            data = bytes(self._head[end + 4:])
+            self._parse_head(bytes(self._head[:end]))
+            self._head = bytearray()
+            if self.headers_received.done():
+                return  # Malformed status line
+            self.headers_received.set_result(None)
+            if not data:
+                return
+
+        if self.eof:
+            return
+        if self._chunked and not self.salvaged:
+            self._dechunk(data)
+        elif self._length is not None:
+            self.payload += memoryview(data)[:self._length]
+            self._length -= min(len(data), self._length)
+            if self._length == 0:
+                self._finish()
+        else:
+            self.payload += data
+        if len(self.payload) > self.HIGH_WATER and not self.paused:
+            self.paused = True
+            self.transport.pause_reading()
+        self._wake()
+
+    def _parse_head(self, head: bytes):
+        lines = head.decode('latin-1').split("\r\n")
+        parts = lines[0].split(" ", 2)
+        try:
+            self.status = int(parts[1])
+        except (IndexError, ValueError):
+            self.headers_received.set_exception(ConnectionError(f"Malformed status line: {lines[0]!r}"))
+            self.transport.close()
+            return
+        self.reason = parts[2] if len(parts) > 2 else ""
+        for line in lines[1:]:
+            name, sep, value = line.partition(":")
+            if sep:
+                self.headers.add(name.strip(), value.strip())
+        self._chunked = 'chunked' in self.headers.get('Transfer-Encoding', '').lower()
+        if not self._chunked and self.headers.get('Content-Length', '').strip().isdigit():
+            self._length = int(self.headers['Content-Length'])
+            if self._length == 0:
+                self._finish()
+
+    def _dechunk(self, data: bytes):
+        """Copy chunk contents straight from the socket read into the payload"""
+        if self._raw:
+            data = bytes(self._raw) + data
+            self._raw = bytearray()
+        view = memoryview(data)
+        pos, end = 0, len(data)
+        while pos < end and not self.eof:
+            if self._chunk_left:
+                take = min(self._chunk_left, end - pos)
+                self.payload += view[pos:pos + take]
+                pos += take
+                self._chunk_left -= take
+                self._expect_crlf = self._chunk_left == 0
+            elif self._expect_crlf:
+                if data.startswith(b"\r\n", pos):
+                    pos += 2
+                elif data.startswith(b"\n", pos):
+                    pos += 1
+                elif end - pos == 1 and data[pos] == 0x0d:
+                    self._raw += view[pos:]
+                    return
+                else:
+                    self._salvage(view[pos:], "chunk not followed by CRLF")
+                    return
+                self._expect_crlf = False
+            else:
+                newline = data.find(b"\n", pos)
+                if newline < 0:
+                    if end - pos > 1024:
+                        self._salvage(view[pos:], "chunk size line too long")
+                    else:
+                        self._raw += view[pos:]
+                    return
+                size_field = data[pos:newline]
+                if b";" in size_field:
+                    size_field = size_field.split(b";", 1)[0]
+                try:
+                    size = int(size_field, 16)
+                except ValueError:
+                    self._salvage(view[pos:], f"invalid chunk size {size_field[:20]!r}")
+                    return
+                pos = newline + 1
+                if size == 0:
+                    self._finish()
+                    return
+                tail = pos + size
+                if data.startswith(b"\r\n", tail):
+                    # Whole chunk in this read, the usual case for one event per chunk
+                    self.payload += view[pos:tail]
+                    pos = tail + 2
+                else:
+                    self._chunk_left = size
+
+    def _salvage(self, rest, reason: str):
+        logger.debug(f"Legacy stream framing broken ({reason}), passing the rest through")
+        self.salvaged = True
+        self.payload += rest
+
+    def take_lines(self) -> List[bytes]:
+        """
+        Remove and return the complete lines buffered so far, with their endings.
+
+        Only bytes appended since the last call are searched for a newline, so a
+        long line arriving in many small reads is scanned once, not once per read.
+        The lines are split in one pass; like SSE, a lone CR also ends a line.
+        """
+        payload = self.payload
+        end = payload.rfind(b"\n", self._scanned)
+        if end < 0:
+            self._scanned = len(payload)
+            return []
+        with memoryview(payload) as view:
+            lines = bytes(view[:end + 1]).splitlines(True)
+        # Dropping a bytearray prefix only moves its start pointer
+        del payload[:end + 1]
+        self._scanned = len(payload)
+        return lines
+
+    def _finish(self):
+        self.eof = True
+        self._wake()
+        if self.transport is not None:
+            self.transport.close()
+
+    def _wake(self):
+        if self._waiter is not None and not self._waiter.done():
+            self._waiter.set_result(None)
+
+    def connection_lost(self, exc):
+        self.eof = True
+        if not self.headers_received.done():
+            self.headers_received.set_exception(
+                ConnectionError(f"Connection closed before response headers: {exc or 'EOF'}"))
+        self._wake()
+
+    async def wait_for_data(self, timeout: float):
+        if self.paused:
+            self.paused = False
+            self.transport.resume_reading()
+        self._waiter = asyncio.get_event_loop().create_future()
+        try:
+            await asyncio.wait_for(self._waiter, timeout)
+        finally:
+            self._waiter = None
+
+class LegacyResponse:
+    """
+    A response read through LegacyHTTPProtocol, with iter_any() like aiohttp's
+    resp.content. Each piece it yields is made of whole lines.
+
+    The stream ends at the body's end, when the connection closes, or right after
+    `data: [DONE]`. The proxy stops there even if the server keeps the connection open.
+    """
+
+    def __init__(self, transport: asyncio.Transport, protocol: LegacyHTTPProtocol, request_id: str):
+        self.transport = transport
+        self.protocol = protocol
+        self.request_id = request_id
+
+    @property
+    def status(self) -> int:
+        return self.protocol.status
+
+    @property
+    def reason(self) -> str:
+        return self.protocol.reason
+
+    @property
+    def headers(self) -> CIMultiDict:
+        return self.protocol.headers
+
+    async def iter_any(self):
+        protocol = self.protocol
+        read_timeout = fix_engine.get_setting('legacy_read_timeout', 30)
+        while True:
+            lines = protocol.take_lines()
+            if not lines:
+                if protocol.eof:
+                    if protocol.payload:
+                        yield bytes(protocol.payload)  # Unterminated last line
+                        protocol.payload.clear()
+                    return
+                try:
+                    await protocol.wait_for_data(read_timeout)
+                except asyncio.TimeoutError:
+                    logger.warning(f"[{self.request_id}] Legacy backend sent nothing for {read_timeout}s, "
+                                   f"ending stream")
+                    return
+                continue
+            if protocol.salvaged:
+                lines = [line for line in lines if not _CHUNK_SIZE_LINE.fullmatch(line)]
+            data = b"".join(lines)
+            done = data.find(b"data: [DONE]")
+            if done >= 0 and (done == 0 or data[done - 1] in b"\r\n"):
+                # End of the SSE stream: finish the event and stop, whatever the socket does next
+                end = data.find(b"\n", done)
+                yield data[:end + 1 if end >= 0 else len(data)] + b"\n"
+                self.close()
+                return
+            if data:
+                yield data
+
+    def close(self):
+        self.transport.close()
+
+    async def __aenter__(self) -> 'LegacyResponse':
+        return self
+
+    async def __aexit__(self, *exc_info):
+        self.close()
+
+async def open_legacy_stream(method: str, url: str, headers: Dict[str, str], data: Optional[bytes],
+                             request_id: str) -> LegacyResponse:
+    """
+    Send a request over a fresh connection and read the response with the tolerant
+    parser. Connection failures raise ConnectionError or asyncio.TimeoutError, like
+    a refused connect on the aiohttp path.
+    """
+    target = URL(url)
+    loop = asyncio.get_event_loop()
+    ssl_context = None
+    if target.scheme == 'https':
+        ssl_context = ssl.create_default_context()
+        ssl_context.check_hostname = False
+        ssl_context.verify_mode = ssl.CERT_NONE
+    try:
+        transport, protocol = await asyncio.wait_for(
+            loop.create_connection(LegacyHTTPProtocol, target.host, target.port, ssl=ssl_context),
+            fix_engine.get_setting('upstream_connect_timeout', 5))
+    except OSError as e:
+        if isinstance(e, ConnectionError):
+            raise
+        raise ConnectionError(f"Cannot connect to {target.host}:{target.port}: {e}") from e
+
+    body = data or b""
+    lines = [f"{method} {target.raw_path_qs} HTTP/1.1", f"Host: {target.raw_authority}"]
+    lines += [f"{name}: {value}" for name, value in headers.items() if name.lower() != 'accept-encoding']
+    # One request per connection, so the end of the body is the server closing it;
+    # identity encoding because this client does not decompress
+    lines += ["Accept-Encoding: identity", "Connection: close", f"Content-Length: {len(body)}"]
+    transport.write("\r\n".join(lines).encode('latin-1') + b"\r\n\r\n" + body)
 
-    return False
+    try:
+        await asyncio.wait_for(protocol.headers_received, fix_engine.get_setting('legacy_read_timeout', 30))
+    except BaseException:
+        transport.close()
+        raise
+    logger.info(f"[{request_id}] Using legacy stream reader ({protocol.status} from {target.host}:{target.port})")
+    return LegacyResponse(transport, protocol, request_id)
 
-async def read_legacy_stream(resp, request_id: str):
+def hedge_delay(body: Optional[dict]) -> Optional[float]:
     """
-    Robust streaming reader for legacy APIs with incorrect HTTP headers.
+    Seconds to wait for a first line before hedging a streaming request, or None
+    when hedging is off. `hedge_after` is a fixed number of seconds or "p95" for the
+    observed backend TTFT p95, never below hedge_min_delay.
+    """
+    if not fix_engine.get_setting('hedging', False) or not body or not body.get('stream'):
+        return None
+    after = fix_engine.get_setting('hedge_after', 'p95')
+    floor = fix_engine.get_setting('hedge_min_delay', 0.5)
+    if after == 'p95':
+        p95 = proxy_metrics.backend_ttfb.quantile(0.95)
+        return max(floor, p95) if p95 is not None else floor
+    return float(after)
 
-    This function reads directly from the TCP socket transport, completely bypassing
-    aiohttp's StreamReader and Transfer-Encoding parser. This is the ONLY way to handle
-    servers that send malformed chunked encoding.
+# Bytes of a response body read before answering the client, at most
+FIRST_LINE_SNIFF_LIMIT = 64 * 1024
 
-    Yields raw_line bytes for each complete line found in the stream.
+async def read_first_line(content: aiohttp.StreamReader) -> bytes:
     """
-    read_timeout = fix_engine.get_setting('legacy_read_timeout', 30)
-    chunk_size = fix_engine.get_setting('legacy_read_chunk_size', 8192)
+    Read the body up to its first newline, its end or FIRST_LINE_SNIFF_LIMIT bytes.
 
-    buffer = b""  # Buffer for incomplete lines
+    Unlike readline() this has no line length limit: a large first SSE event or a
+    single-line JSON body is returned in part and the rest is streamed as usual.
+    """
+    first_line = bytearray()
+    while b"\n" not in first_line and len(first_line) < FIRST_LINE_SNIFF_LIMIT:
+        chunk = await content.readany()
+        if not chunk:
+            break
+        first_line += chunk
+    return bytes(first_line)
+
+async def open_upstream(session: aiohttp.ClientSession, backend: Backend, request: web.Request,
+                        headers: Dict[str, str], data: Optional[bytes]):
+    """Send the request to one backend and wait for the first line of a successful response"""
+    resp = await session.request(method=request.method, url=f"{backend.url}{request.rel_url}",
+                                 headers=headers, data=data, allow_redirects=False,
+                                 timeout=backend_pool.request_timeout())
+    try:
+        backend_pool.record_response(backend, resp.status)
+        first_line = await read_first_line(resp.content) if resp.status < 400 else b""
+    except BaseException:
+        resp.close()
+        raise
+    return resp, first_line
 
-    logger.info(f"[{request_id}] Using legacy stream reading mode (raw socket, chunk size: {chunk_size} bytes)")
+async def open_hedged(session: aiohttp.ClientSession, request_id: str, request: web.Request,
+                      headers: Dict[str, str], data: Optional[bytes], primary: Backend,
+                      delay: float, exclude=()):
+    """
+    Open the upstream stream on `primary`, racing a duplicate on a second backend
+    if no first line arrives within `delay` seconds.
 
-    chunk_count = 0
-    total_bytes_read = 0
+    Nothing is written to the client here, so either response can still be chosen.
+    The first successful response wins. The loser's connection is closed, which
+    stops its generation and frees its slot. Returns (backend, resp, first_line).
+    The returned backend is the one left acquired: when the duplicate wins, the
+    primary is released and the caller holds the duplicate's backend instead.
+    """
+    primary_task = asyncio.ensure_future(open_upstream(session, primary, request, headers, data))
+    done, _ = await asyncio.wait({primary_task}, timeout=delay)
+    hedge = None if done else backend_pool.select(exclude=[primary, *exclude])
+    if hedge is None:
+        try:
+            return (primary, *await primary_task)
+        except asyncio.CancelledError:
+            primary_task.cancel()
+            raise
 
+    backend_pool.acquire(hedge)
+    proxy_metrics.hedges_sent += 1
+    console_logger.info(f"[{request_id}] 🏁 No first byte from {primary.url} after {delay:.2f}s, "
+                        f"hedging on {hedge.url}")
+    hedge_task = asyncio.ensure_future(open_upstream(session, hedge, request, headers, data))
+    owners = {primary_task: primary, hedge_task: hedge}
+    pending = set(owners)
+    winner = None
     try:
-        # Get direct access to the transport (raw socket)
-        # This completely bypasses aiohttp's StreamReader and chunked parser
-        protocol = resp.connection.protocol
-        transport = protocol.transport
-
-        logger.debug(f"[{request_id}] Got direct access to socket transport: {type(transport)}")
-
-        # Read from the internal buffer first (already received data)
-        # resp.content._buffer contains data that was already read but not processed
-        if hasattr(resp.content, '_buffer') and resp.content._buffer:
-            buffered_data = bytes(resp.content._buffer)
-            if buffered_data:
-                chunk_count += 1
-                total_bytes_read += len(buffered_data)
-                logger.debug(f"[{request_id}] Reading {len(buffered_data)} bytes from internal buffer")
-                buffer += buffered_data
-                resp.content._buffer.clear()
-
-        # Now read directly from transport in a loop
-        while not transport.is_closing():
-            try:
-                # Wait for data to arrive with timeout
-                # We'll check if there's data available by trying to read from content
-                try:
-                    chunk = await asyncio.wait_for(
-                        transport.protocol._read_from_stream(chunk_size),
-                        timeout=read_timeout
-                    )
-                except AttributeError:
-                    # Fallback: try to read from content but catch the error
-                    try:
-                        chunk = await asyncio.wait_for(
-                            resp.content.read(chunk_size),
-                            timeout=read_timeout
-                        )
-                    except aiohttp.client_exceptions.ClientPayloadError:
-                        # Expected error with chunked encoding - ignore and continue
-                        logger.debug(f"[{request_id}] ClientPayloadError during read, attempting to get remaining data")
-                        # Try to extract any remaining data from the buffer
-                        if hasattr(resp.content, '_buffer') and resp.content._buffer:
-                            chunk = bytes(resp.content._buffer)
-                            resp.content._buffer.clear()
-                        else:
-                            break
-
-                if not chunk:
-                    logger.debug(f"[{request_id}] EOF - no more data from transport")
+        while pending and winner is None:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in sorted(done, key=lambda task: task is not primary_task):
+                if task.exception() is None and task.result()[0].status < 500:
+                    winner = task
+                    break
+        if winner is None:
+            # Neither succeeded: pass through the primary's error response or exception
+            for task in (primary_task, hedge_task):
+                if task.exception() is None:
+                    winner = task
                     break
+            else:
+                error = hedge_task.exception()
+                hedge.errors += 1
+                backend_pool.record_failure(hedge, str(error) or type(error).__name__)
+                primary_task.result()
+    finally:
+        for task, backend in owners.items():
+            if task is winner:
+                continue
+            if not task.done():
+                task.cancel()
+            elif not task.cancelled() and task.exception() is None:
+                task.result()[0].close()
+            if backend is hedge:
+                backend_pool.release(hedge)
+            elif winner is not None:
+                backend_pool.release(primary)
+
+    backend = owners[winner]
+    if backend is hedge:
+        if primary_task.done() and not primary_task.cancelled() and primary_task.exception() is not None:
+            error = primary_task.exception()
+            primary.errors += 1
+            backend_pool.record_failure(primary, str(error) or type(error).__name__)
+        proxy_metrics.hedges_won += 1
+        logger.info(f"[{request_id}] Hedged request on {hedge.url} answered first")
+    return (backend, *winner.result())
+
+async def sse_batches(chunks, first_line: bytes = b""):
+    """
+    Frame an upstream body into SSE events, yielding the events completed by each
+    read as one batch. first_line is a part of the body already read.
+    """
+    framer = SSEFramer()
+    if first_line:
+        proxy_metrics.bytes_in += len(first_line)
+        events = framer.feed(first_line)
+        if events:
+            yield events
+    async for chunk in chunks:
+        proxy_metrics.bytes_in += len(chunk)
+        events = framer.feed(chunk)
+        if events:
+            yield events
+    events = framer.close()
+    if events:
+        yield events
 
-                chunk_count += 1
-                chunk_size_actual = len(chunk)
-                total_bytes_read += chunk_size_actual
+# Upstream failures after the client already got part of the stream
+STREAM_INTERRUPTIONS = (aiohttp.client_exceptions.ClientPayloadError,
+                        aiohttp.client_exceptions.ServerDisconnectedError, asyncio.TimeoutError)
 
-                logger.debug(f"[{request_id}] Read chunk #{chunk_count}: {chunk_size_actual} bytes (total: {total_bytes_read} bytes)")
+def continuation_enabled(body: Optional[dict], use_legacy_mode: bool) -> bool:
+    """Streams are continued after a backend failure only for single-choice chat streams"""
+    if not fix_engine.get_setting('stream_continuation', False) or use_legacy_mode:
+        return False
+    return bool(body and body.get('stream') and isinstance(body.get('messages'), list)
+                and body.get('n', 1) == 1)
 
-                # Log first bytes of chunk for debugging
-                preview = chunk[:100].decode('utf-8', errors='replace')
-                logger.debug(f"[{request_id}] Chunk #{chunk_count} preview: {preview!r}...")
+def prepare_continuation(request_state: RequestState, request_id: str) -> Optional[Dict[str, Any]]:
+    """
+    Fold the broken segment into the transcript and return the assistant message to
+    continue from, or None when the stream cannot be continued.
 
-                # Add chunk to buffer
-                buffer += chunk
+    Tool calls still being assembled were never shown to the client, so their buffers
+    are dropped and the continuation generates them again under the same indices.
+    A call whose arguments were already streamed progressively cannot be spliced.
+    """
+    transcript = request_state.transcript
+    offset = request_state.next_tool_index
+    for buffer_key, buffer in list(request_state.tool_buffers.items()):
+        if buffer.stream_id:
+            logger.warning(f"[{request_id}] Tool call {buffer_key} was partly streamed, cannot continue")
+            return None
+        if buffer_key.startswith("index:"):
+            offset = min(offset, buffer.index)
+        logger.debug(f"[{request_id}] Dropping unfinished tool call {buffer_key} for continuation")
+        del request_state.tool_buffers[buffer_key]
+    request_state.next_tool_index = request_state.tool_index_offset = offset
+    request_state.last_fragment_key = ""
+    return transcript.assistant_message()
 
-                # Split buffer by newlines and process complete lines
-                lines = buffer.split(b'\n')
+def build_continuation_body(body: dict, message: Dict[str, Any]) -> bytes:
+    """The original request with the output so far appended as an assistant prefix"""
+    messages = list(body['messages'])
+    if messages and isinstance(messages[-1], dict) and messages[-1].get('role') == 'assistant' \
+            and isinstance(messages[-1].get('content'), str) and not messages[-1].get('tool_calls'):
+        # The client prefilled the assistant turn itself: extend its prefix
+        message = dict(message, content=messages[-1]['content'] + message['content'])
+        messages.pop()
+    continued = dict(body, messages=messages + [message])
+    continued.update(fix_engine.get_setting('continuation_params',
+                                            {'continue_final_message': True, 'add_generation_prompt': False}))
+    return json_codec.dumps_bytes(continued)
 
-                # Keep the last incomplete line in buffer
-                buffer = lines[-1]
+def without_role(sse_event: SSEEvent) -> List[SSEEvent]:
+    """The event with its role removed, or nothing when the role was all it carried"""
+    try:
+        event = json_codec.loads(sse_data(sse_event.line))
+    except (json.JSONDecodeError, ValueError):
+        return [sse_event]
+    choice = (event.get("choices") or [{}])[0]
+    delta = choice.get("delta") or {}
+    delta.pop("role", None)
+    if not delta.get("content") and not delta.get("tool_calls") \
+            and not delta.get("reasoning_content") and not choice.get("finish_reason"):
+        return []
+    return [SSEEvent(b"data: " + json_codec.dumps_bytes(event) + b"\n\n", fields=sse_event.fields)]
 
-                # Yield all complete lines
-                complete_lines = len(lines) - 1
-                if complete_lines > 0:
-                    logger.debug(f"[{request_id}] Yielding {complete_lines} complete lines from chunk #{chunk_count}")
+async def continuation_events(batches):
+    """
+    Stream a continuation without its opening role event, since the client already
+    got one from the original stream.
+    """
+    opening = True
+    async for events in batches:
+        if opening:
+            for position, sse_event in enumerate(events):
+                if sse_event.has_data:
+                    opening = False
+                    if b'"role"' in sse_event.line:
+                        events = events[:position] + without_role(sse_event) + events[position + 1:]
+                    break
+        if events:
+            yield events
 
-                for line in lines[:-1]:
-                    # Add newline back since we split by it
-                    yield line + b'\n'
+async def end_of_stream():
+    yield [SSEEvent(b"data: [DONE]\n\n")]
 
-            except asyncio.TimeoutError:
-                logger.warning(f"[{request_id}] Read timeout in legacy mode (no data for {read_timeout}s)")
-                # Timeout might mean end of stream
-                break
-            except Exception as e:
-                logger.error(f"[{request_id}] Unexpected error in legacy stream read: {e}")
-                logger.error(f"[{request_id}] Stats at error: chunks={chunk_count}, total_bytes={total_bytes_read}")
-                break
+async def resume_stream(request_id: str, request: web.Request, headers: Dict[str, str], body: dict,
+                        failed: Backend, request_state: RequestState, affinity_key: Optional[int],
+                        priority: str):
+    """
+    Continue a stream whose backend failed mid-generation.
 
-        # End of stream - yield any remaining data in buffer
-        logger.info(f"[{request_id}] Legacy stream ended: chunks={chunk_count}, total_bytes={total_bytes_read}, buffer_size={len(buffer)}")
-        if buffer:
-            logger.debug(f"[{request_id}] Yielding final buffer: {len(buffer)} bytes")
-            buffer_preview = buffer[:200].decode('utf-8', errors='replace')
-            logger.debug(f"[{request_id}] Final buffer preview: {buffer_preview!r}...")
-            yield buffer
-        else:
-            logger.debug(f"[{request_id}] No remaining data in buffer at stream end")
+    The request is sent again with the output so far as an assistant prefix, to
+    another backend if one is available and otherwise to the same one after
+    continuation_retry_delay. Returns (backend, resp, batches) to keep streaming from,
+    with the backend acquired, or None when the stream cannot be continued. When the
+    generation had already finished and only [DONE] was lost, the end of the stream
+    is produced without a new request.
+    """
+    transcript = request_state.transcript
+    transcript.absorb()
+    if transcript.finished:
+        return None, None, end_of_stream()
+    message = prepare_continuation(request_state, request_id)
+    if message is None:
+        return None
+    data = build_continuation_body(body, message)
 
-    except Exception as e:
-        logger.error(f"[{request_id}] Fatal error in legacy stream reader: {e}")
-        logger.error(f"[{request_id}] Stats at fatal error: chunks={chunk_count}, total_bytes={total_bytes_read}, buffer_size={len(buffer)}")
-        import traceback
-        logger.error(f"[{request_id}] Traceback: {traceback.format_exc()}")
-        if buffer:
-            yield buffer
-        raise
+    for exclude in ([failed], ()):
+        try:
+            if not exclude:
+                await asyncio.sleep(fix_engine.get_setting('continuation_retry_delay', 0.5))
+            backend = await backend_pool.acquire_backend(exclude=exclude, affinity_key=affinity_key,
+                                                         priority=priority)
+        except AdmissionRejected as e:
+            logger.error(f"[{request_id}] Continuation not admitted: {e}")
+            return None
+        if backend is None:
+            continue
+        try:
+            session = await upstream_pool.get_session()
+            resp, first_line = await open_upstream(session, backend, request, headers, data)
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            reason = str(e) or type(e).__name__
+            backend.errors += 1
+            backend_pool.record_failure(backend, reason)
+            backend_pool.release(backend)
+            logger.error(f"[{request_id}] Continuation on {backend.url} failed: {reason}")
+            continue
+        if resp.status >= 400:
+            logger.error(f"[{request_id}] Continuation on {backend.url} answered {resp.status}")
+            resp.close()
+            backend_pool.release(backend)
+            continue
+        proxy_metrics.stream_continuations += 1
+        console_logger.info(f"[{request_id}] 🔁 Continuing stream on {backend.url} "
+                            f"after {len(message['content'])} chars")
+        return backend, resp, continuation_events(sse_batches(resp.content.iter_any(), first_line))
+    return None
 
 async def handle_request(request: web.Request):
     """
@@ -496,24 +2908,29 @@ async def handle_request(request: web.Request):
     """
     # Generate unique request ID for correlation
     request_id = str(uuid.uuid4())[:8]
-    target_url = f"{TARGET_HOST}{request.rel_url}"
+    request_started = time.monotonic()
+    proxy_metrics.requests_total += 1
     logger.debug(f"[{request_id}] --> {request.method} {request.rel_url}")
 
     # Create request state
-    request_states[request_id] = RequestState(request_id=request_id)
-
-    # Start buffer cleanup task
-    cleanup_task = asyncio.create_task(periodic_cleanup(request_id))
+    trace = request.headers.get('X-Proxy-Trace', '').lower() in ('1', 'true', 'yes')
+    request_state = RequestState(request_id=request_id, trace=trace)
+    request_states[request_id] = request_state
+    expiry_scheduler.track_request(request_state)
 
     headers = {k: v for k, v in request.headers.items()
-               if k.lower() not in ("host", "content-length", "transfer-encoding", "connection")}
+               if k.lower() not in ("host", "content-length", "transfer-encoding", "connection",
+                                    "x-proxy-trace", "x-proxy-priority")}
 
     data = await request.read() if request.can_read_body else None
-    if data and fix_engine.get_setting('detailed_logging', True):
+    if data and fix_engine.get_setting('detailed_logging', True) and logger.isEnabledFor(logging.DEBUG):
         logger.debug(f"[{request_id}] Request body ({len(data)} bytes): {data[:500]!r}")
 
     # Extract model name and check if we should use legacy mode
-    model_name = extract_model_from_request(data)
+    body = parse_request_body(data)
+    model_name = body.get('model') if body else None
+    affinity_key = backend_pool.affinity_key(body)
+    priority = request_priority(request.headers, body)
     force_legacy = should_use_legacy_mode_for_model(model_name)
 
     if model_name and force_legacy:
@@ -525,107 +2942,158 @@ async def handle_request(request: web.Request):
     # Track retry attempts
     retry_count = 0
     max_retries = 1 if fix_engine.get_setting('auto_retry_legacy', True) else 0
-    global legacy_mode_detected
+    legacy_retry = False
+
+    # The backend is held for the whole stream, legacy retries included.
+    # Unreachable backends are skipped until every available one was tried.
+    backend = None
+    tried_backends = []
+    response = None
 
     try:
         while retry_count <= max_retries:
+            if backend is None:
+                try:
+                    backend = await backend_pool.acquire_backend(exclude=tried_backends, affinity_key=affinity_key,
+                                                                 priority=priority)
+                except AdmissionRejected as e:
+                    logger.error(f"[{request_id}] Not admitted ({priority}): {e}")
+                    console_logger.info(f"[{request_id}] ⏳ Backends at capacity, rejected with {e.status}")
+                    return web.Response(status=e.status, text=f"Backends at capacity: {e}",
+                                        headers={'Retry-After': '1'})
+                if backend is None:
+                    logger.error(f"[{request_id}] No healthy backend available")
+                    console_logger.info(f"[{request_id}] ❌ No healthy backend available")
+                    return web.Response(status=503, text="No healthy backend available")
+                target_url = f"{backend.url}{request.rel_url}"
+                logger.debug(f"[{request_id}] Routed to {backend.url} ({backend.outstanding} outstanding)")
+
             # Determine if we should use legacy mode for this attempt
-            use_legacy_mode = force_legacy or legacy_mode_detected
+            use_legacy_mode = force_legacy or legacy_retry or \
+                should_use_legacy_mode_for_model(model_name, backend.url)
+            # On a pair never checked, read the first line before answering the client,
+            # so a payload error can still be retried in legacy mode
+            check_first_line = not use_legacy_mode and max_retries > retry_count and \
+                legacy_capabilities.lookup(backend.url, model_name) is None
 
             try:
-                # Create SSL context that ignores certificate verification
-                # This is needed for backends with self-signed or custom certificates
-                ssl_context = ssl.create_default_context()
-                ssl_context.check_hostname = False
-                ssl_context.verify_mode = ssl.CERT_NONE
-
-                logger.debug(f"[{request_id}] Using SSL context with disabled certificate verification")
-
-                connector = aiohttp.TCPConnector(ssl=ssl_context)
-
-                async with aiohttp.ClientSession(connector=connector) as session:
-                    async with session.request(method=request.method, url=target_url,
-                                               headers=headers, data=data, allow_redirects=False) as resp:
-                        logger.debug(f"[{request_id}] <-- {resp.status} {resp.reason} from backend (attempt {retry_count + 1})")
+                session = await upstream_pool.get_session()
+                delay = None if use_legacy_mode else hedge_delay(body)
+                if delay is not None:
+                    backend, resp, first_line = await open_hedged(session, request_id, request, headers, data,
+                                                                  backend, delay, exclude=tried_backends)
+                elif check_first_line:
+                    resp, first_line = await open_upstream(session, backend, request, headers, data)
+                elif use_legacy_mode:
+                    resp = await open_legacy_stream(request.method, target_url, headers, data, request_id)
+                    backend_pool.record_response(backend, resp.status)
+                    first_line = b""
+                else:
+                    resp = await session.request(method=request.method, url=target_url,
+                                                 headers=headers, data=data, allow_redirects=False,
+                                                 timeout=backend_pool.request_timeout())
+                    backend_pool.record_response(backend, resp.status)
+                    first_line = b""
+                async with resp:
+                    logger.debug(f"[{request_id}] <-- {resp.status} {resp.reason} from backend (attempt {retry_count + 1})")
 
-                        # Log response headers for debugging
+                    # Log response headers for debugging
+                    if logger.isEnabledFor(logging.DEBUG):
                         logger.debug(f"[{request_id}] Backend response headers: {dict(resp.headers)}")
                         if 'content-length' in resp.headers:
                             logger.debug(f"[{request_id}] Content-Length: {resp.headers['content-length']}")
                         if 'transfer-encoding' in resp.headers:
                             logger.debug(f"[{request_id}] Transfer-Encoding: {resp.headers['transfer-encoding']}")
 
-                        # Prepare response but don't send yet
-                        response = web.StreamResponse(status=resp.status, reason=resp.reason, headers=resp.headers)
-                        for hop in ("transfer-encoding", "connection", "content-length"):
-                            response.headers.pop(hop, None)
-                        await response.prepare(request)
-
-                        # Choose the appropriate stream reader
-                        if use_legacy_mode:
-                            stream_iterator = read_legacy_stream(resp, request_id)
-                        else:
-                            stream_iterator = resp.content
+                    # Prepare response but don't send yet
+                    response = web.StreamResponse(status=resp.status, reason=resp.reason, headers=resp.headers)
+                    for hop in ("transfer-encoding", "connection", "content-length"):
+                        response.headers.pop(hop, None)
+                    await response.prepare(request)
+                    writer = ClientWriter(response, request_id)
 
-                        # Process and forward the stream
-                        async for raw_line in stream_iterator:
-                            try:
-                                line = raw_line.decode("utf-8")
-                            except UnicodeDecodeError:
-                                await response.write(raw_line)
-                                continue
-
-                            if not line.startswith("data:"):
-                                await response.write(raw_line)
-                                continue
-
-                            payload = line[len("data:"):].strip()
-                            if payload == "[DONE]":
-                                # Process any remaining incomplete buffers before cleanup
-                                await process_remaining_buffers(request_id, response)
-                                logger.debug(f"[{request_id}] Stream ended, cleaning up buffers")
-                                await cleanup_request(request_id)
-                                await response.write(raw_line)
-                                continue
+                    # Choose the appropriate stream reader; either way the body is framed into events
+                    if use_legacy_mode:
+                        stream_iterator = sse_batches(resp.iter_any())
+                    else:
+                        stream_iterator = sse_batches(resp.content.iter_any(), first_line)
 
-                            try:
-                                event = json.loads(payload)
-                            except json.JSONDecodeError as e:
-                                logger.warning(f"[{request_id}] Invalid JSON in SSE: {e}")
-                                await response.write(raw_line)
-                                continue
+                    # Keep what was generated, so a backend failure mid-stream can be continued
+                    transcript = None
+                    if resp.status < 400 and continuation_enabled(body, use_legacy_mode):
+                        transcript = request_state.transcript = StreamTranscript()
+                    continuations = 0
+                    upstream = resp
 
+                    # Process and forward the stream, one batch of events per upstream read
+                    last_event_at = None
+                    client_gone = False
+                    try:
+                        while True:
                             try:
-                                fixed_event = await process_sse_event(event, request_id)
-                                new_payload = json.dumps(fixed_event, ensure_ascii=False)
-
-                                # Log detailed SSE output for debugging (file only)
-                                logger.debug(f"[{request_id}] SSE Event: {json.dumps(fixed_event, indent=2)}")
-                                if "tool_calls" in fixed_event.get("choices", [{}])[0].get("delta", {}):
-                                    tool_calls = fixed_event["choices"][0]["delta"]["tool_calls"]
-                                    for i, tool_call in enumerate(tool_calls):
-                                        logger.debug(f"[{request_id}] SSE Tool Call {i}: {json.dumps(tool_call, indent=2)}")
-
-                                await response.write(f"data: {new_payload}\n\n".encode("utf-8"))
-                            except aiohttp.client_exceptions.ClientConnectionResetError:
-                                logger.warning(f"[{request_id}] Client connection reset, stopping stream")
+                                async for events in stream_iterator:
+                                    received_at = time.monotonic()
+                                    request_state.last_activity = received_at
+                                    for sse_event in events:
+                                        if sse_event.has_data:
+                                            if last_event_at is None:
+                                                proxy_metrics.backend_ttfb.observe(received_at - request_started)
+                                            else:
+                                                proxy_metrics.event_gap.observe(received_at - last_event_at)
+                                            last_event_at = received_at
+                                            if transcript is not None:
+                                                transcript.record(sse_event.line)
+                                        if not await forward_sse_event(sse_event, request_id, writer):
+                                            client_gone = True
+                                            break
+                                    if client_gone or not await writer.end_batch():
+                                        break
                                 break
-                            except Exception as e:
-                                logger.error(f"[{request_id}] Error processing SSE event: {e}")
-                                # Write original event on processing error
-                                await response.write(raw_line)
+                            except STREAM_INTERRUPTIONS as e:
+                                if transcript is None or backend is None or \
+                                        continuations >= fix_engine.get_setting('continuation_attempts', 2):
+                                    raise
+                                continuations += 1
+                                reason = str(e) or type(e).__name__
+                                logger.error(f"[{request_id}] Backend {backend.url} failed mid-stream: {reason}")
+                                console_logger.info(f"[{request_id}] ⚠️  Backend {backend.url} failed mid-stream, "
+                                                    f"continuing the generation")
+                                backend.errors += 1
+                                backend_pool.record_failure(backend, reason)
+                                backend_pool.release(backend)
+                                failed, backend = backend, None
+                                if upstream is not resp:
+                                    upstream.close()
+                                resumed = await resume_stream(request_id, request, headers, body, failed,
+                                                              request_state, affinity_key, priority)
+                                if resumed is None:
+                                    proxy_metrics.stream_continuation_failures += 1
+                                    raise
+                                backend, upstream, stream_iterator = resumed
+                                upstream = upstream or resp
+                    finally:
+                        if upstream is not resp:
+                            upstream.close()
+                        await writer.close()
+                        if writer.first_write_at is not None:
+                            proxy_metrics.client_ttfb.observe(writer.first_write_at - request_started)
 
-                        await response.write_eof()
-                        return response
+                    if not use_legacy_mode and resp.status < 400 and backend is not None:
+                        legacy_capabilities.confirm(backend.url, model_name)
+                    await response.write_eof()
+                    return response
 
             except aiohttp.client_exceptions.ClientPayloadError as e:
-                # Legacy API detected
-                if retry_count < max_retries and not use_legacy_mode:
-                    # Enable legacy mode and retry
+                # Legacy API detected: remember it for this backend and model only
+                if not use_legacy_mode and backend is not None and fix_engine.get_setting('auto_detect_legacy', True):
+                    legacy_capabilities.record(backend.url, model_name, True, 'runtime')
+                if retry_count < max_retries and not use_legacy_mode and response is None:
+                    # Nothing reached the client yet: retry this request in legacy mode
                     logger.error(f"[{request_id}] ClientPayloadError detected on attempt {retry_count + 1}: {e}")
                     console_logger.info(f"[{request_id}] 🔄 Legacy API detected, retrying with compatible mode...")
-                    legacy_mode_detected = True
+                    legacy_retry = True
                     retry_count += 1
+                    proxy_metrics.legacy_retries += 1
 
                     # Wait a bit before retry
                     await asyncio.sleep(0.1)
@@ -633,44 +3101,284 @@ async def handle_request(request: web.Request):
                 else:
                     # Already tried with legacy mode or retries disabled
                     logger.error(f"[{request_id}] ClientPayloadError in legacy mode: {e}")
+                    if backend is not None:
+                        backend.errors += 1
+                    if response is not None:
+                        # Headers are already out: end the stream, the next request uses legacy mode
+                        return await end_interrupted_stream(request_id, response)
                     return web.Response(
                         status=502,
                         text=f"Backend server error: {str(e)}"
                     )
 
+            except (aiohttp.client_exceptions.ClientConnectorError, ConnectionError, asyncio.TimeoutError,
+                    aiohttp.client_exceptions.ServerDisconnectedError) as e:
+                reason = str(e) or type(e).__name__
+                if response is not None and not isinstance(e, aiohttp.client_exceptions.ClientConnectionResetError):
+                    # Headers are already out: end the client's stream instead of resetting it
+                    logger.error(f"[{request_id}] Backend failed mid-stream: {reason}")
+                    console_logger.info(f"[{request_id}] ⚠️  Backend failed mid-stream, ending the stream")
+                    if backend is not None:
+                        backend.errors += 1
+                        backend_pool.record_failure(backend, reason)
+                    return await end_interrupted_stream(request_id, response)
+                if response is not None or isinstance(e, aiohttp.client_exceptions.ServerDisconnectedError):
+                    raise
+                # Nothing reached the client yet, so another replica can take the request
+                logger.error(f"[{request_id}] Backend {backend.url} unreachable: {reason}")
+                console_logger.info(f"[{request_id}] ⚠️  Backend {backend.url} unreachable, trying another replica")
+                backend.errors += 1
+                backend_pool.record_failure(backend, reason)
+                backend_pool.release(backend)
+                tried_backends.append(backend)
+                backend = None
+                continue
+
             # If we reach here without exception, request succeeded
             break
 
     except aiohttp.client_exceptions.ServerDisconnectedError:
         logger.info(f"[{request_id}] Backend server disconnected - this is normal when client interrupts")
+        if backend is not None:
+            backend.errors += 1
         return web.Response(status=502, text="Backend server disconnected")
     except aiohttp.client_exceptions.ClientConnectionResetError:
         logger.info(f"[{request_id}] Client connection reset - this is normal when client disconnects")
         return web.Response(status=499, text="Client disconnected")
     except Exception as e:
         logger.error(f"[{request_id}] Request handling error: {e}")
+        if backend is not None:
+            backend.errors += 1
         raise
     finally:
-        # Clean up request state and cancel cleanup task
-        cleanup_task.cancel()
+        if backend is not None:
+            backend_pool.release(backend)
+        # Clean up request state
         try:
             await cleanup_request(request_id)
         except Exception as cleanup_error:
             logger.warning(f"[{request_id}] Cleanup error: {cleanup_error}")
 
-async def periodic_cleanup(request_id: str):
-    """Periodically clean up expired buffers for a request"""
-    timeout = fix_engine.get_setting('buffer_timeout', 30)
-    
-    while request_id in request_states:
+# Markers in a raw SSE line that mean the event may need rewriting
+_SSE_REWRITE_MARKERS = (b'"tool_calls"', b'<', b'\\u003c', b'\\u003C', b'[DONE]')
+_SSE_FINISH_REASON_SET = re.compile(rb'"finish_reason"\s*:\s*"')
+
+def sse_line_needs_processing(raw_line: bytes, request_id: str) -> bool:
+    """
+    Cheap pre-scan deciding whether a data: line must be parsed and possibly rewritten.
+
+    Plain content deltas without tool calls, tag characters or a finish_reason are
+    passed through byte-for-byte, unless the request is in the middle of an XML
+    tool call or holding back content.
+    """
+    if any(marker in raw_line for marker in _SSE_REWRITE_MARKERS):
+        return True
+    if _SSE_FINISH_REASON_SET.search(raw_line):
+        return True
+
+    request_state = request_states.get(request_id)
+    if request_state is None:
+        return False
+    return request_state.xml_lexer.in_tool_call or request_state.xml_lexer.held_size() > 0 \
+        or bool(request_state.held_content)
+
+# Output the client acts on at once: a finished choice or the end of the stream
+_SSE_FLUSH_NOW = re.compile(rb'"finish_reason"\s*:\s*"|^data: \[DONE\]', re.MULTILINE)
+
+class ClientWriter:
+    """
+    Write-coalescing layer between the stream processing and the client response.
+
+    Everything written to the client in a stream goes through write(), which only
+    collects it. end_batch() is called after the events of each upstream read were
+    processed and sends what was collected as one write. With write_coalesce_window
+    set it first waits that long for the next read, but nothing is held longer than
+    write_flush_deadline. A tool call with its name, a finish_reason or [DONE] is
+    sent at once together with everything before it.
+    """
+    MAX_PENDING = 64 * 1024  # Send a large backlog without waiting for the batch to end
+    __slots__ = ('response', 'request_id', 'coalescing', 'window', 'deadline', 'first_write_at',
+                 '_pending', '_size', '_since', '_timer', '_task', '_lock', '_error')
+
+    def __init__(self, response: web.StreamResponse, request_id: str):
+        self.response = response
+        self.request_id = request_id
+        self.coalescing = fix_engine.get_setting('write_coalescing', True)
+        self.window = fix_engine.get_setting('write_coalesce_window', 0.0)
+        self.deadline = fix_engine.get_setting('write_flush_deadline', 0.01)
+        self.first_write_at: Optional[float] = None
+        self._pending: List[bytes] = []
+        self._size = 0
+        self._since = 0.0
+        self._timer: Optional[asyncio.TimerHandle] = None
+        self._task: Optional[asyncio.Task] = None
+        self._lock = asyncio.Lock()  # A timer flush may overlap one from the stream
+        self._error: Optional[Exception] = None
+
+    async def write(self, data: bytes):
+        if self._error is not None:
+            # A timer flush already found the client gone
+            raise self._error
+        if not self._pending:
+            self._since = time.monotonic()
+        self._pending.append(data)
+        self._size += len(data)
+        if not self.coalescing or self._size >= self.MAX_PENDING or _SSE_FLUSH_NOW.search(data) \
+                or b'"tool_calls"' in data and b'"name"' in data:
+            await self.flush()
+
+    async def end_batch(self) -> bool:
+        """
+        Send or schedule what the last upstream read produced. Returns False when
+        the client went away.
+        """
+        if self._error is not None:
+            logger.warning(f"[{self.request_id}] Client connection reset, stopping stream")
+            return False
+        if not self._pending:
+            return True
+        now = time.monotonic()
+        due = min(now + self.window, self._since + self.deadline)
+        if due > now:
+            if self._timer is not None:
+                self._timer.cancel()
+            self._timer = asyncio.get_running_loop().call_later(due - now, self._flush_later)
+            return True
         try:
-            await asyncio.sleep(timeout // 3)  # Check every 1/3 of timeout period
-            if request_id in request_states:
-                request_states[request_id].cleanup_expired_buffers(timeout)
-        except asyncio.CancelledError:
-            break
-        except Exception as e:
-            logger.error(f"[{request_id}] Cleanup task error: {e}")
+            await self.flush()
+        except aiohttp.client_exceptions.ClientConnectionResetError:
+            logger.warning(f"[{self.request_id}] Client connection reset, stopping stream")
+            return False
+        return True
+
+    def _flush_later(self):
+        self._timer = None
+        self._task = asyncio.ensure_future(self._flush_quietly())
+
+    async def _flush_quietly(self):
+        try:
+            await self.flush()
+        except aiohttp.client_exceptions.ClientConnectionResetError:
+            pass  # Reported by the stream's next write or end_batch()
+
+    async def flush(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        async with self._lock:
+            if self._error is not None:
+                raise self._error
+            if not self._pending:
+                return
+            data = self._pending[0] if len(self._pending) == 1 else b"".join(self._pending)
+            self._pending = []
+            self._size = 0
+            try:
+                await self.response.write(data)
+            except aiohttp.client_exceptions.ClientConnectionResetError as e:
+                self._error = e
+                raise
+            proxy_metrics.client_writes += 1
+            if self.first_write_at is None:
+                self.first_write_at = time.monotonic()
+
+    async def close(self):
+        """Send whatever is still pending; a client that went away is not an error here"""
+        try:
+            await self.flush()
+        except aiohttp.client_exceptions.ClientConnectionResetError:
+            pass
+
+async def forward_sse_event(sse_event: SSEEvent, request_id: str, response) -> bool:
+    """
+    Process one framed upstream event and write the result to the client. Events
+    without data are forwarded unchanged.
+
+    Returns False when the client went away and streaming should stop.
+    """
+    if sse_event.has_data:
+        return await forward_sse_line(sse_event.line, request_id, response, sse_event.fields)
+    try:
+        await response.write(sse_event.line)
+    except aiohttp.client_exceptions.ClientConnectionResetError:
+        logger.warning(f"[{request_id}] Client connection reset, stopping stream")
+        return False
+    proxy_metrics.bytes_out += len(sse_event.line)
+    return True
+
+async def forward_sse_line(raw_line: bytes, request_id: str, response, fields: bytes = b"") -> bool:
+    """
+    Process one upstream SSE data event and write the result to the client, after
+    the event's other fields if it has any.
+
+    Returns False when the client went away and streaming should stop.
+    """
+    started = time.perf_counter()
+    try:
+        out = await rewrite_sse_line(raw_line, request_id, response)
+    except aiohttp.client_exceptions.ClientConnectionResetError:
+        logger.warning(f"[{request_id}] Client connection reset, stopping stream")
+        return False
+    proxy_metrics.event_processing.observe(time.perf_counter() - started)
+    if fields:
+        out = fields + out
+
+    try:
+        await response.write(out)
+    except aiohttp.client_exceptions.ClientConnectionResetError:
+        logger.warning(f"[{request_id}] Client connection reset, stopping stream")
+        return False
+    proxy_metrics.bytes_out += len(out)
+    return True
+
+async def write_sse_payload(response, payload: bytes):
+    """Write an event the proxy generated itself (not a rewrite of an upstream line)"""
+    out = b"data: " + payload + b"\n\n"
+    await response.write(out)
+    proxy_metrics.bytes_out += len(out)
+
+async def rewrite_sse_line(raw_line: bytes, request_id: str, response) -> bytes:
+    """Return the bytes to send to the client for one upstream SSE event"""
+    if (raw_line.startswith(b"data:") and fix_engine.get_setting('sse_fast_path', True)
+            and not sse_line_needs_processing(raw_line, request_id)):
+        return raw_line
+
+    if not raw_line.startswith(b"data:"):
+        return raw_line
+
+    payload = sse_data(raw_line)
+    if payload == b"[DONE]":
+        # Release held-back content and process any remaining incomplete buffers before cleanup
+        await flush_held_content(request_id, response)
+        await process_remaining_buffers(request_id, response)
+        logger.debug(f"[{request_id}] Stream ended, cleaning up buffers")
+        await cleanup_request(request_id)
+        return raw_line
+
+    try:
+        event = json_codec.loads(payload)
+    except json.JSONDecodeError as e:
+        logger.warning(f"[{request_id}] Invalid JSON in SSE: {e}")
+        return raw_line
+
+    try:
+        fixed_event = await process_sse_event(event, request_id)
+        new_payload = json_codec.dumps_bytes(fixed_event)
+
+        # Log detailed SSE output for sampled or fully traced requests (file only)
+        request_state = request_states.get(request_id)
+        if request_state is not None and request_state.trace_event:
+            logger.debug(f"[{request_id}] SSE Event: {json.dumps(fixed_event, indent=2)}")
+            if "tool_calls" in fixed_event.get("choices", [{}])[0].get("delta", {}):
+                tool_calls = fixed_event["choices"][0]["delta"]["tool_calls"]
+                for i, tool_call in enumerate(tool_calls):
+                    logger.debug(f"[{request_id}] SSE Tool Call {i}: {json.dumps(tool_call, indent=2)}")
+
+        return b"data: " + new_payload + b"\n\n"
+    except Exception as e:
+        logger.error(f"[{request_id}] Error processing SSE event: {e}")
+        # Write original event on processing error
+        return raw_line
 
 async def cleanup_request(request_id: str):
     """Clean up all resources for a request"""
@@ -687,6 +3395,7 @@ async def process_sse_event(event: dict, request_id: str) -> dict:
         return event
     
     request_state = request_states[request_id]
+    request_state.trace_event = should_trace_event(request_state)
 
     if "choices" not in event or not event["choices"]:
         return event
@@ -694,154 +3403,186 @@ async def process_sse_event(event: dict, request_id: str) -> dict:
     choice = event["choices"][0]
     delta = choice.get("delta", {})
     finish_reason = choice.get("finish_reason")
+
+    if request_state.tool_index_offset:
+        # A continuation numbers its calls from 0 again, after the ones the client already has
+        for tool in delta.get("tool_calls") or ():
+            if tool.get("index") is not None:
+                tool["index"] += request_state.tool_index_offset
     
-    # Accumulate content and check for XML-format tool calls
+    # Feed content to the streaming lexer and check for XML-format tool calls
     content = delta.get("content", "")
     if content:
-        # Add content to buffer
-        request_state.content_buffer += content
-        
-        # Check if we have a complete XML tool call
-        xml_tool_call = detect_and_convert_xml_tool_call(request_state.content_buffer)
-        if xml_tool_call:
-            console_logger.info(f"[{request_id}] 🔀 XML→JSON: {xml_tool_call['function_name']}")
-            logger.info(f"[{request_id}] Detected XML tool call, converting to JSON format")
-            
-            # Create proper JSON tool call format
-            fixed_call_id = f"call_{uuid.uuid4().hex[:24]}"
-            args_str = json.dumps(xml_tool_call["arguments"], ensure_ascii=False)
-            
+        # Stream offset of the first character still held back from earlier deltas
+        stream_start = request_state.xml_lexer.position - len(request_state.held_content)
+        xml_tool_calls = request_state.xml_lexer.feed(content)
+        if xml_tool_calls:
             # Replace content with tool_calls
-            delta["tool_calls"] = [{
-                "index": 0,
-                "id": fixed_call_id,
-                "function": {
-                    "name": xml_tool_call["function_name"],
-                    "arguments": args_str
-                }
-            }]
-            # Remove the XML content to prevent display
-            delta["content"] = ""
-            
-            # Clear the content buffer since we processed the tool call
-            request_state.content_buffer = ""
-            
-            logger.debug(f"[{request_id}] Converted XML to JSON tool call: {xml_tool_call['function_name']}")
+            delta["tool_calls"] = []
+            for xml_tool_call in xml_tool_calls:
+                console_logger.info(f"[{request_id}] 🔀 XML→JSON: {xml_tool_call['function_name']}")
+                logger.info(f"[{request_id}] Detected XML tool call, converting to JSON format")
+
+                # Create proper JSON tool call format
+                fixed_call_id = f"call_{uuid.uuid4().hex[:24]}"
+                args_str = json_codec.dumps(xml_tool_call["arguments"])
+                delta["tool_calls"].append({
+                    "index": request_state.next_tool_index,
+                    "id": fixed_call_id,
+                    "function": {
+                        "name": xml_tool_call["function_name"],
+                        "arguments": args_str
+                    }
+                })
+                request_state.next_tool_index += 1
+                logger.debug(f"[{request_id}] Converted XML to JSON tool call: {xml_tool_call['function_name']}")
         else:
-            # Check if buffer is getting too large and clear it periodically
+            # Drop a runaway tool call that will never close
             max_buffer_size = fix_engine.get_setting('max_buffer_size', 1048576)
-            if len(request_state.content_buffer) > max_buffer_size:
-                logger.warning(f"[{request_id}] Content buffer exceeded size limit, clearing")
-                request_state.content_buffer = ""
+            if request_state.xml_lexer.held_size() > max_buffer_size:
+                logger.warning(f"[{request_id}] XML tool call buffer exceeded size limit, clearing")
+                request_state.xml_lexer.reset()
+
+        # Converted calls and their wrapper tags are cut out of the content, prose around them stays
+        spans = sorted([call["span"] for call in xml_tool_calls] + request_state.xml_lexer.wrapper_spans)
+        if fix_engine.get_setting('content_holdback', True):
+            hold_back_content(request_state, delta, content, stream_start, spans)
+        elif spans:
+            delta["content"], _ = split_at_spans(content, request_state.xml_lexer.position - len(content), spans)
+
+    # Nothing more can close a held-back tool call once the choice finishes
+    if finish_reason and request_state.held_content:
+        delta["content"] = delta.get("content", "") + release_held_content(request_state)
     
     if "tool_calls" not in delta:
         # Check if we need to process buffers on finish_reason
         if finish_reason == "tool_calls":
+            closing_tool_calls = close_progressive_buffers(request_state, request_id)
+            if closing_tool_calls:
+                delta["tool_calls"] = closing_tool_calls
             await process_all_buffers(request_state, request_id)
         return event
 
-    # Use a single buffer for all indexed tool call fragments
-    main_buffer_key = "main_tool_call"
-    
-    # Collect all tool call fragments in this SSE event
-    fragments_in_event = []
+    # Buffer index-addressed fragments per (choice, index) so parallel calls stay apart
+    choice_index = choice.get("index", 0)
+    fragment_buffers = []
     named_tool_calls = []
+    emitted_tool_calls = []
     
     for tool in delta["tool_calls"]:
         tool_index = tool.get("index")
         func = tool.get("function", {})
         call_id = tool.get("id")
         tool_name = func.get("name", "")
+        arguments = func.get("arguments", "")
         
-        if call_id and tool_name and func.get("arguments", "").strip():
+        if call_id and tool_name and arguments.strip() and (tool_index is None or is_json_complete(arguments)):
             # This is a complete named tool call with actual arguments
             named_tool_calls.append(tool)
-        elif call_id and tool_name and not func.get("arguments", "").strip():
-            # This is a named tool call header with empty arguments - likely for fragments
-            # Remove it from the delta to prevent it from being sent
-            logger.debug(f"[{request_id}] Suppressing empty named tool call header: {call_id}")
-            # Mark this tool call for removal
-            tool["_suppress"] = True
-        elif "arguments" in func:
-            # This is a fragment - collect it
-            frag = func["arguments"]
-            fragments_in_event.append((tool_index or 0, frag, tool))
-    
-    # Process fragments first
-    if fragments_in_event:
-        # Initialize buffer if needed
-        if main_buffer_key not in request_state.tool_buffers:
-            request_state.tool_buffers[main_buffer_key] = ToolBuffer(
-                call_id=main_buffer_key,
-                request_id=request_id,
-                tool_name=""
-            )
+            continue
         
-        buffer = request_state.tool_buffers[main_buffer_key]
+        # Headers and fragments are never forwarded raw - the completed call replaces them
+        tool["_suppress"] = True
         
-        # Sort fragments by index and add to buffer
-        fragments_in_event.sort(key=lambda x: x[0])
-        for _, frag, tool in fragments_in_event:
-            buffer.update_content(frag)
+        if call_id and tool_name and tool_index is not None:
+            # Announce the call so fragments with this index get their own buffer
+            buffer_key = f"index:{choice_index}:{tool_index}"
+            if buffer_key not in request_state.tool_buffers:
+                request_state.add_buffer(buffer_key, ToolBuffer(
+                    call_id=buffer_key,
+                    request_id=request_id,
+                    tool_name=tool_name,
+                    index=tool_index
+                ))
+                request_state.next_tool_index = max(request_state.next_tool_index, tool_index + 1)
+        
+        if call_id and tool_name and not arguments.strip():
+            # This is a named tool call header with empty arguments - the fragments follow
+            logger.debug(f"[{request_id}] Suppressing empty named tool call header: {call_id} (index {tool_index})")
+            continue
+        
+        if "arguments" not in func:
+            continue
         
-        # Check buffer size limit
-        max_size = fix_engine.get_setting('max_buffer_size', 1048576)
+        buffer = get_fragment_buffer(request_state, request_id, choice_index, tool_index)
+        if tool_name:
+            # A header that already carries the first arguments names its call too
+            buffer.tool_name = tool_name
+        buffer.update_content(arguments)
+        request_state.last_fragment_key = buffer.call_id
+        if buffer not in fragment_buffers:
+            fragment_buffers.append(buffer)
+    
+    # Emit every buffered call whose own JSON closed in this event
+    max_size = fix_engine.get_setting('max_buffer_size', 1048576)
+    for buffer in fragment_buffers:
+        buffer_key = buffer.call_id
         if buffer.size() > max_size:
-            logger.error(f"[{request_id}] Buffer {main_buffer_key} exceeded size limit")
-            del request_state.tool_buffers[main_buffer_key]
-            # Suppress all fragments since buffer is invalid
-            delta["tool_calls"] = []
-        else:
-            if fix_engine.get_setting('detailed_logging', True):
-                total_frag = ''.join([f[1] for f in fragments_in_event])
-                logger.debug(f"[{request_id}] Buffer {main_buffer_key} += {total_frag!r} (total: {len(buffer.content)} chars)")
-            
-            # Try to determine tool name from buffer content
-            if not buffer.tool_name and buffer.content:
-                buffer.tool_name = infer_tool_name_from_content(buffer.content)
-            
-            # Check if tool call is complete now
-            if buffer.content and is_json_complete(buffer.content):
-                # Process the complete tool call and get fixed arguments
-                final_tool_name, fixed_args = await get_fixed_arguments(buffer, request_id)
-                if fixed_args and final_tool_name:
-                    # Replace all fragment tool_calls with a single complete one
-                    # Use the original call ID format that OpenCode expects
-                    fixed_call_id = f"call_{uuid.uuid4().hex[:24]}"
-                    delta["tool_calls"] = [{
-                        "index": 0,  # Required by OpenCode
-                        "id": fixed_call_id,
-                        "function": {
-                            "name": final_tool_name,
-                            "arguments": fixed_args
-                        }
-                    }]
-                    console_logger.info(f"[{request_id}] 🔧 Tool call: {final_tool_name}")
-                    logger.info(f"[{request_id}] Replaced fragments with complete fixed tool call: {final_tool_name}")
-                    del request_state.tool_buffers[main_buffer_key]
-                else:
-                    # Couldn't get fixed args or tool name, suppress fragments to prevent client errors
-                    if not buffer.tool_name:
-                        logger.warning(f"[{request_id}] Could not infer tool name from content: {buffer.content[:100]}...")
-                    logger.warning(f"[{request_id}] Failed to get fixed args or tool name, suppressing fragments")
-                    delta["tool_calls"] = []
+            logger.error(f"[{request_id}] Buffer {buffer_key} exceeded size limit")
+            del request_state.tool_buffers[buffer_key]
+            continue
+        
+        if request_state.trace_event:
+            logger.debug(f"[{request_id}] Buffer {buffer_key} (total: {buffer.length} chars)")
+        
+        # Try to determine tool name from buffer content
+        if not buffer.tool_name and buffer.content:
+            buffer.tool_name = infer_tool_name_from_content(buffer.content)
+        
+        # Check if this tool call is complete now
+        if not (buffer.length and buffer.is_json_complete()):
+            streamed_call = stream_buffer_fragment(buffer, request_id)
+            if streamed_call:
+                emitted_tool_calls.append(streamed_call)
             else:
-                # Tool call incomplete, suppress fragments to prevent sending invalid data to client
-                logger.debug(f"[{request_id}] Tool call incomplete, suppressing {len(fragments_in_event)} fragments")
-                delta["tool_calls"] = []
+                if request_state.trace_event:
+                    logger.debug(f"[{request_id}] Tool call {buffer_key} incomplete, suppressing fragments")
+            continue
+        
+        if buffer.stream_id:
+            # Header and arguments are already out - only the tail and fixes remain
+            emitted_tool_calls.append(finish_progressive_buffer(buffer, buffer.content, request_id))
+            del request_state.tool_buffers[buffer_key]
+            continue
+        
+        # Process the complete tool call and get fixed arguments
+        final_tool_name, fixed_args = await get_fixed_arguments(buffer, request_id)
+        if fixed_args and final_tool_name:
+            # Use the original call ID format that OpenCode expects
+            fixed_call_id = f"call_{uuid.uuid4().hex[:24]}"
+            emitted_tool_calls.append({
+                "index": buffer.index,
+                "id": fixed_call_id,
+                "function": {
+                    "name": final_tool_name,
+                    "arguments": fixed_args
+                }
+            })
+            console_logger.info(f"[{request_id}] 🔧 Tool call: {final_tool_name}")
+            logger.info(f"[{request_id}] Replaced fragments with complete fixed tool call: {final_tool_name} (index {buffer.index})")
+            proxy_metrics.observe_tool_call(buffer)
+            del request_state.tool_buffers[buffer_key]
+        else:
+            # Couldn't get fixed args or tool name, keep suppressing fragments to prevent client errors
+            if not buffer.tool_name:
+                logger.warning(f"[{request_id}] Could not infer tool name from content: {buffer.content[:100]}...")
+            logger.warning(f"[{request_id}] Failed to get fixed args or tool name, suppressing fragments")
     
     # Process named tool calls normally
     for tool in named_tool_calls:
         call_id = tool["id"]
         func = tool.get("function", {})
         tool_name = func.get("name", "")
+        if tool.get("index") is not None:
+            # Forwarded as is, so calls numbered by the proxy must come after it
+            request_state.next_tool_index = max(request_state.next_tool_index, tool["index"] + 1)
         
         if call_id not in request_state.tool_buffers:
-            request_state.tool_buffers[call_id] = ToolBuffer(
+            request_state.add_buffer(call_id, ToolBuffer(
                 call_id=call_id,
                 request_id=request_id,
                 tool_name=tool_name
-            )
+            ))
         
         buffer = request_state.tool_buffers[call_id]
         
@@ -849,27 +3590,213 @@ async def process_sse_event(event: dict, request_id: str) -> dict:
             frag = func["arguments"]
             buffer.update_content(frag)
             
-            if fix_engine.get_setting('detailed_logging', True):
-                logger.debug(f"[{request_id}] Named buffer {call_id} ({buffer.tool_name}) += {frag!r} (total: {len(buffer.content)} chars)")
+            if request_state.trace_event:
+                logger.debug(f"[{request_id}] Named buffer {call_id} ({buffer.tool_name}) += {frag!r} (total: {buffer.length} chars)")
             
-            if buffer.content and is_json_complete(buffer.content):
+            if buffer.length and buffer.is_json_complete():
                 console_logger.info(f"[{request_id}] 🔧 Tool call: {buffer.tool_name}")
                 await process_complete_buffer(buffer, tool, request_id)
+                proxy_metrics.observe_tool_call(buffer)
                 del request_state.tool_buffers[call_id]
 
     # Check for finish_reason indicating all tool calls are done
     if finish_reason == "tool_calls":
+        emitted_tool_calls.extend(close_progressive_buffers(request_state, request_id))
         await process_all_buffers(request_state, request_id)
 
-    # Remove suppressed tool calls from the event
+    # Remove suppressed tool calls from the event and add the completed ones
     if "tool_calls" in delta:
-        delta["tool_calls"] = [tool for tool in delta["tool_calls"] if not tool.get("_suppress")]
+        delta["tool_calls"] = [tool for tool in delta["tool_calls"] if not tool.get("_suppress")] + emitted_tool_calls
         # If all tool calls were suppressed, remove the tool_calls key entirely
         if not delta["tool_calls"]:
             del delta["tool_calls"]
 
     return event
 
+def should_trace_event(request_state: RequestState) -> bool:
+    """Decide whether to log full per-event detail for the event being processed"""
+    if not fix_engine.get_setting('detailed_logging', True) or not logger.isEnabledFor(logging.DEBUG):
+        return False
+    if request_state.trace:
+        return True
+    rate = fix_engine.get_setting('sse_trace_sample_rate', 0.01)
+    return rate >= 1 or (rate > 0 and random.random() < rate)
+
+def get_fragment_buffer(request_state: RequestState, request_id: str,
+                        choice_index: int, tool_index: Optional[int]) -> ToolBuffer:
+    """
+    Find the buffer an index-addressed argument fragment belongs to.
+
+    A fragment joins the buffer announced or started at its own index. Qwen3 also
+    streams a single call with a new index per fragment, so a fragment at an unknown
+    index continues the most recently fed call while that call is still open. Only
+    when no call is open does it start a new one.
+    """
+    if tool_index is None:
+        tool_index = 0
+    buffer_key = f"index:{choice_index}:{tool_index}"
+    buffer = request_state.tool_buffers.get(buffer_key)
+    if buffer is not None:
+        return buffer
+
+    last_buffer = request_state.tool_buffers.get(request_state.last_fragment_key)
+    if last_buffer is not None and last_buffer.call_id.startswith(f"index:{choice_index}:") \
+            and not last_buffer.is_json_complete():
+        return last_buffer
+
+    # A new call without a header - number it after the calls already emitted
+    buffer = ToolBuffer(
+        call_id=buffer_key,
+        request_id=request_id,
+        index=request_state.next_tool_index
+    )
+    request_state.next_tool_index += 1
+    return request_state.add_buffer(buffer_key, buffer)
+
+def stream_buffer_fragment(buffer: ToolBuffer, request_id: str) -> Optional[dict]:
+    """
+    Forward the unsent arguments of an incomplete call of a progressively streamed tool.
+
+    The first call sends the id/name header together with everything buffered so far,
+    later calls send only the new characters. Returns None while the call is suppressed.
+    """
+    if not buffer.stream_id:
+        if not fix_engine.streams_progressively(buffer.tool_name):
+            return None
+        buffer.stream_id = f"call_{uuid.uuid4().hex[:24]}"
+        buffer.streamed = buffer.length
+        console_logger.info(f"[{request_id}] 📡 Streaming tool call: {buffer.tool_name}")
+        logger.info(f"[{request_id}] Streaming arguments of {buffer.tool_name} progressively (index {buffer.index})")
+        return {
+            "index": buffer.index,
+            "id": buffer.stream_id,
+            "type": "function",
+            "function": {
+                "name": buffer.tool_name,
+                "arguments": buffer.content
+            }
+        }
+
+    unsent = buffer.tail(buffer.streamed)
+    if not unsent:
+        return None
+    buffer.streamed = buffer.length
+    return {"index": buffer.index, "function": {"arguments": unsent}}
+
+def finish_progressive_buffer(buffer: ToolBuffer, args_str: str, request_id: str) -> dict:
+    """
+    Build the trailing arguments delta of a progressively streamed call.
+
+    args_str is the complete JSON whose prefix was already forwarded. The delta holds
+    the rest up to the final brace, the members added by the fixes, and the brace.
+    """
+    body = args_str.rstrip()
+    tail = body[buffer.streamed:]
+    try:
+        args_obj = json_codec.loads(body)
+        # apply_fixes works in place; args_obj is compared against the result below
+        _, fixed_obj = fix_engine.apply_fixes(buffer.tool_name, dict(args_obj), request_id)
+        added = {key: value for key, value in fixed_obj.items() if key not in args_obj}
+        if any(fixed_obj.get(key) != value for key, value in args_obj.items()):
+            logger.warning(f"[{request_id}] Fixes changed streamed arguments of {buffer.tool_name}, ignoring changes")
+        if added and body.endswith('}') and len(body) - 1 >= buffer.streamed:
+            members = ", ".join(f"{json_codec.dumps(key)}: {json_codec.dumps(value)}" for key, value in added.items())
+            tail = body[buffer.streamed:-1] + (", " if args_obj else "") + members + "}"
+    except json.JSONDecodeError as e:
+        logger.warning(f"[{request_id}] Streamed arguments of {buffer.tool_name} are not valid JSON: {e}")
+
+    buffer.streamed = len(body)
+    logger.info(f"[{request_id}] Finished streamed tool call: {buffer.tool_name} (index {buffer.index})")
+    proxy_metrics.observe_tool_call(buffer)
+    return {"index": buffer.index, "function": {"arguments": tail}}
+
+def close_progressive_buffers(request_state: RequestState, request_id: str) -> List[dict]:
+    """Close every streamed call that is still open, repairing truncated arguments"""
+    closing_tool_calls = []
+    for buffer_key, buffer in list(request_state.tool_buffers.items()):
+        if not buffer.stream_id:
+            continue
+        # Append only the missing closing characters so the streamed prefix stays valid
+        closing = buffer.scanner.closing()
+        if closing is None:
+            logger.warning(f"[{request_id}] Streamed arguments of {buffer.tool_name} cannot be closed, sending as is")
+        closing_tool_calls.append(finish_progressive_buffer(buffer, buffer.content + (closing or ""), request_id))
+        del request_state.tool_buffers[buffer_key]
+    return closing_tool_calls
+
+def hold_back_content(request_state: RequestState, delta: dict, content: str,
+                      stream_start: int, spans: List[tuple]):
+    """
+    Forward content that cannot belong to an XML tool call and hold back the rest.
+
+    Only a possible "<function=" prefix or an unclosed call is held. Held text is
+    released with the next delta once it stops matching, so prose is never delayed.
+    """
+    previously_held = request_state.held_content
+    pending = previously_held + content
+    cut = request_state.xml_lexer.safe_offset() - stream_start
+    released, held = pending[:cut], pending[cut:]
+    now = time.monotonic()
+
+    # Converted calls became tool_calls; only the prose around them is released
+    released, converted = split_at_spans(released, stream_start, spans)
+    delta["content"] = released
+    if converted:
+        holdback_stats.converted_bytes += len(converted.encode('utf-8'))
+    if previously_held and cut > 0:
+        delayed, _ = split_at_spans(previously_held[:cut], stream_start, spans)
+        if delayed:
+            holdback_stats.record_release(len(delayed.encode('utf-8')), now - request_state.held_since)
+
+    newly_held = pending[max(cut, len(previously_held)):]
+    if newly_held:
+        holdback_stats.held_bytes += len(newly_held.encode('utf-8'))
+    if held and (not previously_held or cut >= len(previously_held)):
+        request_state.held_since = now
+    request_state.held_content = held
+
+def split_at_spans(text: str, text_start: int, spans: List[tuple]) -> tuple[str, str]:
+    """
+    Split text that starts at stream offset text_start into the parts outside and
+    inside the [start, end) stream spans of converted tool calls.
+    """
+    if not spans:
+        return text, ""
+    outside, inside = [], []
+    cursor = 0
+    for start, end in spans:
+        start = min(max(start - text_start, cursor), len(text))
+        end = min(max(end - text_start, start), len(text))
+        outside.append(text[cursor:start])
+        inside.append(text[start:end])
+        cursor = end
+    outside.append(text[cursor:])
+    return "".join(outside), "".join(inside)
+
+def release_held_content(request_state: RequestState) -> str:
+    """Release all held-back content and abandon any unclosed XML tool call"""
+    held = request_state.held_content
+    if held:
+        holdback_stats.record_release(len(held.encode('utf-8')), time.monotonic() - request_state.held_since)
+        request_state.held_content = ""
+    request_state.xml_lexer.reset()
+    return held
+
+async def flush_held_content(request_id: str, response):
+    """Send held-back content as a final content delta before the stream ends"""
+    request_state = request_states.get(request_id)
+    if request_state is None or not request_state.held_content:
+        return
+
+    held = release_held_content(request_state)
+    logger.debug(f"[{request_id}] Releasing {len(held)} held-back content chars at stream end")
+    flush_event = {"choices": [{"index": 0, "delta": {"content": held}}]}
+    new_payload = json_codec.dumps_bytes(flush_event)
+    try:
+        await write_sse_payload(response, new_payload)
+    except Exception as write_error:
+        logger.warning(f"[{request_id}] Failed to write held-back content: {write_error}")
+
 async def process_complete_buffer(buffer: ToolBuffer, tool: dict, request_id: str):
     """Process a complete tool call buffer"""
     full_args_str = buffer.content
@@ -877,9 +3804,16 @@ async def process_complete_buffer(buffer: ToolBuffer, tool: dict, request_id: st
     call_id = buffer.call_id
     
     try:
-        args_obj = json.loads(full_args_str)
-        final_tool_name, args_obj = fix_engine.apply_fixes(tool_name, args_obj, request_id)
-        fixed_args_str = json.dumps(args_obj, ensure_ascii=False)
+        args_obj = json_codec.loads(full_args_str)
+        fixes = fix_engine.get_fixes(tool_name)
+        if not fixes:
+            # No rule can change anything - forward the model's valid JSON without re-serializing
+            tool["function"]["arguments"] = full_args_str
+            logger.debug(f"[{request_id}] No fixes for tool call {call_id} ({tool_name}), forwarding as is")
+            return
+        final_tool_name, args_obj = fix_engine.run_fixes(fix_engine.normalize_tool_name(tool_name), fixes,
+                                                         args_obj, request_id)
+        fixed_args_str = json_codec.dumps(args_obj)
         
         # Update tool name if it was converted
         if final_tool_name != tool_name:
@@ -888,7 +3822,7 @@ async def process_complete_buffer(buffer: ToolBuffer, tool: dict, request_id: st
         else:
             logger.debug(f"[{request_id}] Fixed tool call {call_id} ({tool_name}): {len(fixed_args_str)} chars")
         
-        if fix_engine.get_setting('detailed_logging', True):
+        if fix_engine.get_setting('detailed_logging', True) and logger.isEnabledFor(logging.DEBUG):
             logger.debug(f"[{request_id}] Fixed args: {fixed_args_str}")
         
         tool["function"]["arguments"] = fixed_args_str
@@ -939,15 +3873,24 @@ async def process_remaining_buffers(request_id: str, response):
     
     logger.info(f"[{request_id}] Processing {len(request_state.tool_buffers)} incomplete buffers before cleanup")
     
+    # Streamed calls already have their header out - send only their closing delta
+    closing_tool_calls = close_progressive_buffers(request_state, request_id)
+    if closing_tool_calls:
+        closing_event = {"choices": [{"index": 0, "delta": {"tool_calls": closing_tool_calls}}]}
+        try:
+            await write_sse_payload(response, json_codec.dumps_bytes(closing_event))
+        except Exception as write_error:
+            logger.warning(f"[{request_id}] Failed to write streamed tool call completion: {write_error}")
+    
     for call_id, buffer in list(request_state.tool_buffers.items()):
         if buffer.content:
             try:
                 # Try to fix incomplete JSON
                 fixed_json = await try_fix_incomplete_json(buffer.content)
                 if fixed_json and buffer.tool_name:
-                    args_obj = json.loads(fixed_json)
+                    args_obj = json_codec.loads(fixed_json)
                     final_tool_name, args_obj = fix_engine.apply_fixes(buffer.tool_name, args_obj, request_id)
-                    fixed_args_str = json.dumps(args_obj, ensure_ascii=False)
+                    fixed_args_str = json_codec.dumps(args_obj)
                     
                     # Create a completion event for this tool call
                     # Generate a proper call ID format
@@ -956,7 +3899,7 @@ async def process_remaining_buffers(request_id: str, response):
                         "choices": [{
                             "delta": {
                                 "tool_calls": [{
-                                    "index": 0,  # Required by OpenCode
+                                    "index": buffer.index,
                                     "id": completion_call_id,
                                     "function": {
                                         "name": final_tool_name,
@@ -967,10 +3910,11 @@ async def process_remaining_buffers(request_id: str, response):
                         }]
                     }
                     
-                    new_payload = json.dumps(completion_event, ensure_ascii=False)
+                    new_payload = json_codec.dumps_bytes(completion_event)
                     try:
-                        await response.write(f"data: {new_payload}\n\n".encode("utf-8"))
+                        await write_sse_payload(response, new_payload)
                         console_logger.info(f"[{request_id}] 🔧 Completion: {final_tool_name}")
+                        proxy_metrics.observe_tool_call(buffer)
                         logger.info(f"[{request_id}] Sent completion for incomplete buffer {call_id}")
                     except Exception as write_error:
                         logger.warning(f"[{request_id}] Failed to write completion: {write_error}")
@@ -980,6 +3924,22 @@ async def process_remaining_buffers(request_id: str, response):
             except Exception as e:
                 logger.warning(f"[{request_id}] Failed to process incomplete buffer {call_id}: {e}")
 
+async def end_interrupted_stream(request_id: str, response: web.StreamResponse) -> web.StreamResponse:
+    """
+    End a client stream whose upstream failed after the headers were sent.
+
+    Held-back content and unfinished tool calls are sent as at a normal stream end,
+    then the body is closed, so the client gets a shortened but well-formed stream
+    instead of a reset connection.
+    """
+    await flush_held_content(request_id, response)
+    await process_remaining_buffers(request_id, response)
+    try:
+        await response.write_eof()
+    except ConnectionError as e:
+        logger.info(f"[{request_id}] Client gone before the interrupted stream was ended: {e}")
+    return response
+
 async def try_fix_incomplete_json(json_str: str) -> str:
     """Try to fix incomplete JSON by adding missing closing braces/brackets"""
     if not json_str.strip():
@@ -1000,7 +3960,7 @@ async def try_fix_incomplete_json(json_str: str) -> str:
     
     # Validate the result
     try:
-        json.loads(result)
+        json_codec.loads(result)
         return result
     except:
         return None
@@ -1017,9 +3977,9 @@ async def try_json_recovery(malformed_json: str, tool: dict, tool_name: str, req
     for i, fix_func in enumerate(recovery_attempts):
         try:
             fixed_json = fix_func(malformed_json.strip())
-            args_obj = json.loads(fixed_json)
+            args_obj = json_codec.loads(fixed_json)
             final_tool_name, args_obj = fix_engine.apply_fixes(tool_name, args_obj, request_id)
-            fixed_args_str = json.dumps(args_obj, ensure_ascii=False)
+            fixed_args_str = json_codec.dumps(args_obj)
             tool["function"]["name"] = final_tool_name
             tool["function"]["arguments"] = fixed_args_str
             logger.info(f"[{request_id}] JSON recovery attempt {i+1} succeeded")
@@ -1033,51 +3993,15 @@ def is_json_complete(json_str: str) -> bool:
     """Robust detection if JSON string is syntactically complete"""
     if not json_str or not json_str.strip():
         return False
-    
-    json_str = json_str.strip()
-    
-    # Must start with { or [
-    if not json_str.startswith(('{', '[')):
-        return False
-    
-    # Check bracket/brace balancing
-    stack = []
-    in_string = False
-    escape_next = False
-    
-    for char in json_str:
-        if escape_next:
-            escape_next = False
-            continue
-            
-        if char == '\\':
-            escape_next = True
-            continue
-            
-        if char == '"' and not escape_next:
-            in_string = not in_string
-            continue
-            
-        if in_string:
-            continue
-            
-        if char in '{[':
-            stack.append(char)
-        elif char in '}]':
-            if not stack:
-                return False
-            
-            last = stack.pop()
-            if (char == '}' and last != '{') or (char == ']' and last != '['):
-                return False
-    
-    # JSON is complete if stack is empty (all brackets matched) and not in string
-    return len(stack) == 0 and not in_string
+
+    scanner = JSONCompletenessScanner()
+    scanner.feed(json_str)
+    return scanner.is_complete()
 
 def validate_json_syntax(json_str: str) -> bool:
     """Quick validation that JSON is syntactically correct"""
     try:
-        json.loads(json_str)
+        json_codec.loads(json_str)
         return True
     except json.JSONDecodeError:
         return False
@@ -1123,77 +4047,105 @@ def detect_and_convert_xml_tool_call(content: str) -> dict:
     """
     Detect XML-format tool calls like <function=glob><parameter=pattern>*.py</parameter></function>
     and convert them to OpenAI-compatible JSON format.
-    Handles both single and multiple parameters.
+    Handles both single and multiple parameters. Returns the first complete call, or None.
     """
-    import re
-    
-    # First, extract the function name
-    function_match = re.search(r'<function=([^>]+)>', content)
-    if not function_match:
-        return None
-    
-    function_name = function_match.group(1).strip()
-    
-    # Find all parameters within this function call
-    # Pattern to match all parameters: <parameter=name>value</parameter>
-    param_pattern = r'<parameter=([^>]+)>\s*([^<]*?)\s*</parameter>'
-    param_matches = re.findall(param_pattern, content, re.DOTALL)
-    
-    if not param_matches:
-        return None
-    
-    # Create JSON arguments object from all parameters
-    args_obj = {}
-    for param_name, param_value in param_matches:
-        args_obj[param_name.strip()] = param_value.strip()
-    
-    return {
-        "function_name": function_name,
-        "arguments": args_obj
-    }
+    completed = XMLToolCallLexer().feed(content)
+    return completed[0] if completed else None
 
 async def get_fixed_arguments(buffer: ToolBuffer, request_id: str) -> tuple[str, str]:
     """Get fixed arguments from buffer and return as (tool_name, JSON string)"""
     try:
-        args_obj = json.loads(buffer.content)
-        final_tool_name, args_obj = fix_engine.apply_fixes(buffer.tool_name, args_obj, request_id)
-        return final_tool_name, json.dumps(args_obj, ensure_ascii=False)
+        args_obj = json_codec.loads(buffer.content)
+        tool_name = fix_engine.normalize_tool_name(buffer.tool_name)
+        fixes = fix_engine.fix_table.get(tool_name, NO_FIXES)
+        if not fixes:
+            # No rule can change anything - forward the model's valid JSON without re-serializing
+            return tool_name, buffer.content
+        final_tool_name, args_obj = fix_engine.run_fixes(tool_name, fixes, args_obj, request_id)
+        return final_tool_name, json_codec.dumps(args_obj)
     except Exception as e:
         logger.error(f"[{request_id}] Failed to get fixed arguments: {e}")
         return buffer.tool_name, ""
 
 async def health_check(request: web.Request):
     """Health check endpoint"""
+    breakers = [backend.state for backend in backend_pool.backends]
     stats = {
-        'status': 'healthy',
+        'status': 'healthy' if all(state == BREAKER_CLOSED for state in breakers) else 'degraded',
         'active_requests': len(request_states),
         'total_buffers': sum(len(state.tool_buffers) for state in request_states.values()),
         'config_loaded': bool(fix_engine.config),
+        'json_backend': json_codec.backend,
         'target_host': TARGET_HOST,
-        'legacy_mode': fix_engine.get_setting('legacy_api_mode', False) or legacy_mode_detected,
-        'legacy_mode_auto_detected': legacy_mode_detected,
+        'backends': backend_pool.stats(),
+        'affinity': backend_pool.affinity_stats(),
+        'queue': backend_pool.queue_stats(),
+        'legacy_mode': fix_engine.get_setting('legacy_api_mode', False),
+        'legacy_mode_auto_detected': legacy_capabilities.detected(),
+        'legacy_capabilities': legacy_capabilities.stats(),
         'legacy_models': fix_engine.get_setting('legacy_models', []),
         'auto_retry_legacy': fix_engine.get_setting('auto_retry_legacy', True),
-        'uptime': 'unknown'  # Could track start time
+        'upstream_pool': upstream_pool.stats(),
+        'content_holdback': holdback_stats.as_dict(),
+        'expiry': expiry_scheduler.stats(),
+        'uptime': round(proxy_metrics.uptime(), 1)
     }
     return web.json_response(stats)
 
+async def metrics_handler(request: web.Request):
+    """Prometheus text-format metrics endpoint"""
+    return web.Response(body=proxy_metrics.render().encode('utf-8'),
+                        headers={'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'})
+
 async def reload_config(request: web.Request):
     """Reload configuration endpoint"""
     try:
-        global fix_engine
+        global fix_engine, json_codec
         fix_engine = ToolFixEngine(CONFIG_FILE)
+        json_codec = JSONCodec(fix_engine.get_setting('json_backend', 'auto'))
+        configure_log_rotation()
+        backend_pool.configure(fix_engine.get_setting('backends'))
         return web.json_response({'status': 'success', 'message': 'Configuration reloaded'})
     except Exception as e:
         logger.error(f"Failed to reload config: {e}")
         return web.json_response({'status': 'error', 'message': str(e)}, status=500)
 
+async def upstream_pool_ctx(app: web.Application):
+    """Tie the shared upstream connection pool to the application lifetime"""
+    await upstream_pool.start()
+    upstream_pool.start_warm_up(*backend_pool.urls())
+    yield
+    await upstream_pool.close()
+
+async def backend_health_ctx(app: web.Application):
+    """Probe backend health in the background for the application lifetime"""
+    backend_pool.start()
+    yield
+    await backend_pool.close()
+
+async def legacy_capabilities_ctx(app: web.Application):
+    """Load the legacy capability table and run the optional startup probe"""
+    legacy_capabilities.start(backend_pool.urls())
+    yield
+    await legacy_capabilities.close()
+
+async def expiry_scheduler_ctx(app: web.Application):
+    """Run the buffer and request state expiry scheduler for the application lifetime"""
+    expiry_scheduler.start()
+    yield
+    await expiry_scheduler.close()
+
 def main():
     """Main entry point for the proxy server"""
     app = web.Application()
+    app.cleanup_ctx.append(upstream_pool_ctx)
+    app.cleanup_ctx.append(backend_health_ctx)
+    app.cleanup_ctx.append(legacy_capabilities_ctx)
+    app.cleanup_ctx.append(expiry_scheduler_ctx)
     
     # Add health and management endpoints
     app.router.add_get('/_health', health_check)
+    app.router.add_get('/_metrics', metrics_handler)
     app.router.add_post('/_reload', reload_config)
     
     # Main proxy route (catch-all)
@@ -1201,7 +4153,8 @@ def main():
 
     console_logger.info(f"🔌 Qwen3 Call Patch Proxy starting...")
     console_logger.info(f"   📡 Listening: 0.0.0.0:{LISTEN_PORT}")
-    console_logger.info(f"   🎯 Target: {TARGET_HOST}")
+    for backend in backend_pool.backends:
+        console_logger.info(f"   🎯 Target: {backend.url} (weight {backend.weight})")
     console_logger.info(f"   ⚙️  Config: {CONFIG_FILE}")
 
     # Show legacy mode status
@@ -1215,6 +4168,7 @@ def main():
         console_logger.info(f"   🔄 Legacy API mode: DISABLED")
 
     logger.info(f"   Health check: http://localhost:{LISTEN_PORT}/_health")
+    logger.info(f"   Metrics: http://localhost:{LISTEN_PORT}/_metrics")
     logger.info(f"   Reload config: POST http://localhost:{LISTEN_PORT}/_reload")
     
     try:
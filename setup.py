@@ -40,6 +40,9 @@ setup(
     ],
     python_requires=">=3.8",
     install_requires=requirements,
+    extras_require={
+        "fast": ["orjson>=3.8.0"],
+    },
     entry_points={
         "console_scripts": [
             "qwen3-call-patch-proxy=call_patch_proxy:main",
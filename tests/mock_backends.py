@@ -0,0 +1,168 @@
+#!/usr/bin/env python3
+"""
+Local mock model servers for multi-backend tests and benchmarks
+
+Each MockBackend is an OpenAI-compatible streaming server on a random local port.
+A completion streams `chunks` content deltas `delay` seconds apart; a request body
+may override them with "mock_chunks" and "mock_delay". `first_delay` (or
+"mock_first_delay") stalls before the first chunk, like a long prefill, and
+`aborted` counts streams the client closed early. The backend name is put in
+each delta so callers can tell which replica served a request. Setting `healthy`
+to False makes /health and completions answer 503.
+
+`fail_after` drops the connection after that many events, like a server that
+crashes mid-generation, and `tool_call` ({"name", "arguments"}) adds a native tool
+call after the content, streamed as a header and argument fragments. When the last
+message is an assistant prefix, content numbering continues after its chunks, so a
+continued stream reads like one unbroken generation.
+
+With `slots` set, the backend behaves like llama.cpp with that many parallel
+decoding slots. Requests beyond them wait inside the server, and /slots reports
+which slots are busy. `external_busy` marks slots as taken by clients outside the test.
+"""
+import asyncio
+import json
+
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+
+
+class MockBackend:
+    """One local streaming backend with request accounting"""
+
+    def __init__(self, name: str, chunks: int = 3, delay: float = 0.0, slots: int = None,
+                 first_delay: float = 0.0, fail_after: int = None, tool_call: dict = None):
+        self.name = name
+        self.fail_after = fail_after
+        self.failed = 0
+        self.tool_call = tool_call
+        self.chunks = chunks
+        self.delay = delay
+        self.first_delay = first_delay
+        self.aborted = 0
+        self.slots = slots
+        self.external_busy = 0
+        self.healthy = True
+        self.hits = 0
+        self.bodies = []  # Request bodies in arrival order
+        self.probes = 0
+        self.active = 0
+        self.max_active = 0
+        self.waiting = 0
+        self.max_waiting = 0
+        self.server = None
+        self._slot_semaphore = asyncio.Semaphore(slots) if slots else None
+        self._url = None
+
+        app = web.Application()
+        app.router.add_post('/v1/chat/completions', self.completion)
+        app.router.add_get('/health', self.health)
+        app.router.add_get('/slots', self.slots_status)
+        self.app = app
+
+    @property
+    def url(self) -> str:
+        return self._url
+
+    async def start(self) -> 'MockBackend':
+        self.server = TestServer(self.app)
+        await self.server.start_server()
+        self._url = str(self.server.make_url('')).rstrip('/')
+        return self
+
+    async def close(self):
+        if self.server is not None:
+            await self.server.close()
+            self.server = None
+
+    async def health(self, request: web.Request):
+        self.probes += 1
+        if not self.healthy:
+            return web.json_response({"status": "unavailable"}, status=503)
+        return web.json_response({"status": "ok"})
+
+    async def slots_status(self, request: web.Request):
+        """llama.cpp-style slot list"""
+        if not self.slots:
+            return web.json_response({"error": "This server does not support slots endpoint."}, status=501)
+        busy = min(self.active + self.external_busy, self.slots)
+        return web.json_response([{"id": i, "is_processing": i < busy} for i in range(self.slots)])
+
+    async def completion(self, request: web.Request):
+        body = await request.json() if request.can_read_body else {}
+        if not self.healthy:
+            return web.json_response({"error": "unavailable"}, status=503)
+        chunks = body.get("mock_chunks", self.chunks)
+        delay = body.get("mock_delay", self.delay)
+        first_delay = body.get("mock_first_delay", self.first_delay)
+
+        self.hits += 1
+        self.bodies.append(body)
+        if self._slot_semaphore is not None:
+            if self._slot_semaphore.locked():
+                self.waiting += 1
+                self.max_waiting = max(self.max_waiting, self.waiting)
+                await self._slot_semaphore.acquire()
+                self.waiting -= 1
+            else:
+                await self._slot_semaphore.acquire()
+        self.active += 1
+        self.max_active = max(self.max_active, self.active)
+        slot_held = True
+        try:
+            response = web.StreamResponse(headers={"Content-Type": "text/event-stream"})
+            await response.prepare(request)
+            if first_delay:
+                await asyncio.sleep(first_delay)
+            for sent, event in enumerate(self._events(body, chunks)):
+                if delay:
+                    await asyncio.sleep(delay)
+                if sent == self.fail_after:
+                    self.failed += 1
+                    request.transport.close()
+                    return response
+                await response.write(f"data: {json.dumps(event)}\n\n".encode())
+            # Like llama.cpp, the slot is free once generation stops, before the stream ends
+            slot_held = False
+            self._release_slot()
+            await response.write(b"data: [DONE]\n\n")
+            await response.write_eof()
+            return response
+        except (ConnectionResetError, asyncio.CancelledError):
+            self.aborted += 1
+            raise
+        finally:
+            if slot_held:
+                self._release_slot()
+
+    def _events(self, body: dict, chunks: int):
+        messages = body.get("messages") or [{}]
+        prefix = (messages[-1].get("content") or "") if messages[-1].get("role") == "assistant" else ""
+        start = len(prefix.split())
+        for i in range(start, max(chunks, start)):
+            yield {"choices": [{"delta": {"content": f"{self.name}:{i} "}, "index": 0}]}
+        if self.tool_call:
+            call = {"index": 0, "id": f"call_{self.name}", "type": "function",
+                    "function": {"name": self.tool_call["name"], "arguments": ""}}
+            yield {"choices": [{"delta": {"tool_calls": [call]}, "index": 0}]}
+            arguments = self.tool_call["arguments"]
+            step = max(1, len(arguments) // 3)
+            for i in range(0, len(arguments), step):
+                fragment = {"index": 0, "function": {"arguments": arguments[i:i + step]}}
+                yield {"choices": [{"delta": {"tool_calls": [fragment]}, "index": 0}]}
+            yield {"choices": [{"delta": {}, "finish_reason": "tool_calls", "index": 0}]}
+
+    def _release_slot(self):
+        self.active -= 1
+        if self._slot_semaphore is not None:
+            self._slot_semaphore.release()
+
+
+async def start_backends(count: int, **kwargs):
+    """Start `count` mock backends named b0, b1, ..."""
+    return [await MockBackend(f"b{i}", **kwargs).start() for i in range(count)]
+
+
+async def close_backends(backends):
+    for backend in backends:
+        await backend.close()
@@ -0,0 +1,174 @@
+#!/usr/bin/env python3
+"""
+Test per-backend concurrency limits and the priority admission queue
+"""
+import sys
+import os
+import asyncio
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from aiohttp import web
+from aiohttp.test_utils import TestServer, TestClient
+from multidict import CIMultiDict
+
+import call_patch_proxy
+from call_patch_proxy import backend_pool, handle_request, health_check, metrics_handler, request_priority, \
+    upstream_pool_ctx
+from mock_backends import MockBackend, close_backends
+
+SETTINGS = {
+    'backend_max_concurrency': 1,
+    'max_queue_size': 100,
+    'queue_timeout': 5,
+    'client_priorities': {'sk-batch': 'background'},
+    'detect_subagents': True,
+}
+
+PRIMARY_TOOLS = [{"type": "function", "function": {"name": name}} for name in ("bash", "Task")]
+SUBAGENT_TOOLS = [{"type": "function", "function": {"name": name}} for name in ("bash", "read")]
+
+
+def override_settings(**overrides):
+    settings = call_patch_proxy.fix_engine.settings
+    values = dict(SETTINGS, **overrides)
+    original = {key: settings.get(key) for key in values}
+    settings.update(values)
+    return original
+
+
+def restore_settings(original):
+    settings = call_patch_proxy.fix_engine.settings
+    for key, value in original.items():
+        if value is None:
+            settings.pop(key, None)
+        else:
+            settings[key] = value
+
+
+def build_proxy_app() -> web.Application:
+    app = web.Application()
+    app.cleanup_ctx.append(upstream_pool_ctx)
+    app.router.add_get('/_health', health_check)
+    app.router.add_get('/_metrics', metrics_handler)
+    app.router.add_route("*", "/{tail:.*}", handle_request)
+    return app
+
+
+def test_request_priority():
+    """Header, then client key, then subagent detection, then the default"""
+    print("Testing request priority sources:")
+    original = override_settings()
+    try:
+        primary = {"tools": PRIMARY_TOOLS}
+        subagent = {"tools": SUBAGENT_TOOLS}
+        assert request_priority(CIMultiDict(), primary) == 'interactive'
+        assert request_priority(CIMultiDict(), subagent) == 'background'
+        assert request_priority(CIMultiDict(), {"messages": []}) == 'interactive'
+        print("  ✓ Requests without the task tool are detected as subagents")
+
+        batch = CIMultiDict({'Authorization': 'Bearer sk-batch'})
+        assert request_priority(batch, primary) == 'background'
+        assert request_priority(CIMultiDict({'X-Api-Key': 'sk-batch'}), primary) == 'background'
+        print("  ✓ Client API keys map to priorities")
+
+        header = CIMultiDict({'X-Proxy-Priority': 'Interactive', 'Authorization': 'Bearer sk-batch'})
+        assert request_priority(header, subagent) == 'interactive'
+        assert request_priority(CIMultiDict({'X-Proxy-Priority': 'bogus'}), subagent) == 'background'
+        print("  ✓ X-Proxy-Priority header wins; unknown values are ignored")
+    finally:
+        restore_settings(original)
+
+
+async def test_interactive_requests_go_first():
+    """Queued interactive turns are admitted before background subagents, FIFO within each"""
+    original = override_settings()
+    backend = await MockBackend("b0", chunks=3, delay=0.02).start()
+    backend_pool.configure([backend.url])
+    client = TestClient(TestServer(build_proxy_app()))
+    await client.start_server()
+
+    try:
+        print("\nTesting priority admission:")
+
+        async def send(tag, tools, delay):
+            await asyncio.sleep(delay)
+            resp = await client.post('/v1/chat/completions', json={"model": "test", "tag": tag, "tools": tools})
+            assert resp.status == 200 and b"[DONE]" in await resp.read()
+
+        requests = [send("first", PRIMARY_TOOLS, 0)]
+        requests += [send(f"sub{i}", SUBAGENT_TOOLS, 0.01 + i * 0.002) for i in range(3)]
+        requests += [send(f"turn{i}", PRIMARY_TOOLS, 0.02 + i * 0.002) for i in range(2)]
+        gathered = asyncio.gather(*requests)
+
+        await asyncio.sleep(0.04)
+        stats = (await (await client.get('/_health')).json())['queue']
+        print(f"  Waiting: {stats['waiting']}")
+        assert stats['waiting'] == {'interactive': 2, 'background': 3}
+        await gathered
+
+        order = [body['tag'] for body in backend.bodies]
+        print(f"  Backend order: {order}")
+        assert order == ["first", "turn0", "turn1", "sub0", "sub1", "sub2"]
+        assert backend.max_active == 1
+        print("  ✓ Concurrency limit held; interactive turns overtook queued subagents")
+
+        metrics = await (await client.get('/_metrics')).text()
+        assert 'qwen3_proxy_queue_wait_seconds_count{priority="background"}' in metrics
+        assert 'qwen3_proxy_queue_depth{priority="interactive"} 0' in metrics
+        assert metrics.count('# TYPE qwen3_proxy_queue_wait_seconds histogram') == 1
+        print("  ✓ Queue depth and wait time exported per priority")
+    finally:
+        await client.close()
+        await close_backends([backend])
+        backend_pool.configure(call_patch_proxy.fix_engine.get_setting('backends'))
+        restore_settings(original)
+
+
+async def test_queue_bounds():
+    """429 when the queue is full, 503 when the wait times out"""
+    original = override_settings(max_queue_size=1, queue_timeout=0.3)
+    backend = await MockBackend("b0", chunks=30, delay=0.02).start()
+    backend_pool.configure([backend.url])
+    client = TestClient(TestServer(build_proxy_app()))
+    await client.start_server()
+
+    try:
+        print("\nTesting queue bounds:")
+        running = asyncio.ensure_future(client.post('/v1/chat/completions', json={"model": "test"}))
+        await asyncio.sleep(0.05)
+        waiting = asyncio.ensure_future(client.post('/v1/chat/completions', json={"model": "test"}))
+        await asyncio.sleep(0.05)
+
+        resp = await client.post('/v1/chat/completions', json={"model": "test"})
+        assert resp.status == 429 and resp.headers.get('Retry-After') == '1'
+        print("  ✓ 429 while the queue is full")
+
+        resp = await waiting
+        assert resp.status == 503
+        print("  ✓ 503 after queue_timeout")
+
+        resp = await running
+        assert resp.status == 200 and b"[DONE]" in await resp.read()
+        stats = backend_pool.queue_stats()
+        assert stats['rejected']['interactive'] >= 1 and stats['timeouts']['interactive'] >= 1
+        print(f"  ✓ Counted: rejected={stats['rejected']}, timeouts={stats['timeouts']}")
+    finally:
+        await client.close()
+        await close_backends([backend])
+        backend_pool.configure(call_patch_proxy.fix_engine.get_setting('backends'))
+        restore_settings(original)
+
+
+if __name__ == "__main__":
+    async def run_tests():
+        await test_interactive_requests_go_first()
+        await test_queue_bounds()
+
+    try:
+        test_request_priority()
+        asyncio.run(run_tests())
+        print("\n🎉 All admission control tests passed!")
+    except AssertionError as e:
+        print(f"\n💥 Test failed: {e}")
+        sys.exit(1)
@@ -0,0 +1,186 @@
+#!/usr/bin/env python3
+"""
+Test backend health probing and per-backend circuit breakers
+"""
+import sys
+import os
+import asyncio
+import time
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from aiohttp import web
+from aiohttp.test_utils import TestServer, TestClient
+
+import call_patch_proxy
+from call_patch_proxy import (BackendPool, BREAKER_CLOSED, BREAKER_HALF_OPEN, BREAKER_OPEN,
+                              backend_pool, handle_request, health_check, metrics_handler, upstream_pool_ctx)
+from mock_backends import start_backends, close_backends
+
+# Nothing listens on port 1, so connections are refused immediately
+DEAD_BACKEND = "http://127.0.0.1:1"
+
+SETTINGS = {
+    'breaker_failure_threshold': 2,
+    'breaker_reset_timeout': 0.2,
+    'breaker_half_open_requests': 1,
+    'health_check_interval': 0.05,
+    'health_check_timeout': 1,
+}
+
+
+def override_settings():
+    settings = call_patch_proxy.fix_engine.settings
+    original = {key: settings.get(key) for key in SETTINGS}
+    settings.update(SETTINGS)
+    return original
+
+
+def restore_settings(original):
+    settings = call_patch_proxy.fix_engine.settings
+    for key, value in original.items():
+        if value is None:
+            settings.pop(key, None)
+        else:
+            settings[key] = value
+
+
+def build_proxy_app() -> web.Application:
+    app = web.Application()
+    app.cleanup_ctx.append(upstream_pool_ctx)
+    app.router.add_get('/_health', health_check)
+    app.router.add_get('/_metrics', metrics_handler)
+    app.router.add_route("*", "/{tail:.*}", handle_request)
+    return app
+
+
+def test_breaker_transitions():
+    """closed -> open after N failures, half-open after the reset timeout, trial decides"""
+    print("Testing circuit breaker transitions:")
+    original = override_settings()
+    try:
+        pool = BackendPool()
+        pool.configure(['http://a', 'http://b'])
+        a, b = pool.backends
+
+        pool.record_failure(a, "refused")
+        assert a.state == BREAKER_CLOSED
+        pool.record_failure(a, "refused")
+        assert a.state == BREAKER_OPEN and a.transitions[BREAKER_OPEN] == 1
+        assert all(pool.select() is b for _ in range(5))
+        print("  ✓ Opens after 2 consecutive failures and is skipped")
+
+        time.sleep(0.25)
+        trial = pool.select(exclude=[b])
+        assert trial is a and a.state == BREAKER_HALF_OPEN
+        pool.acquire(a)
+        assert pool.select(exclude=[b]) is None, "Only one trial request at a time"
+        pool.record_failure(a, "HTTP 503")
+        pool.release(a)
+        assert a.state == BREAKER_OPEN
+        print("  ✓ Half-opens after the reset timeout; a failed trial reopens")
+
+        time.sleep(0.25)
+        assert pool.select(exclude=[b]) is a
+        pool.acquire(a)
+        pool.record_response(a, 200)
+        pool.release(a)
+        assert a.state == BREAKER_CLOSED and a.consecutive_failures == 0 and a.trials == 0
+        print("  ✓ A successful trial closes the breaker")
+
+        pool.record_failure(b, "refused")
+        pool.record_success(b)
+        pool.record_failure(b, "refused")
+        assert b.state == BREAKER_CLOSED
+        print("  ✓ Successes reset the consecutive failure count")
+    finally:
+        restore_settings(original)
+
+
+async def test_requests_route_around_dead_backend():
+    """Connection failures fail over to another replica, then the breaker skips the dead one"""
+    original = override_settings()
+    backends = await start_backends(1)
+    backend_pool.configure([DEAD_BACKEND, backends[0].url])
+    client = TestClient(TestServer(build_proxy_app()))
+    await client.start_server()
+
+    try:
+        print("\nTesting failover around a dead backend:")
+        for _ in range(4):
+            resp = await client.post('/v1/chat/completions', json={"model": "test"})
+            body = await resp.read()
+            assert resp.status == 200 and b"b0:0" in body
+        dead = backend_pool.backends[0]
+        print(f"  Dead backend: state={dead.state}, errors={dead.errors}")
+        assert dead.state == BREAKER_OPEN and dead.errors == 2
+        assert backends[0].hits == 4
+        print("  ✓ All requests served; dead backend opened after 2 failed connects")
+
+        health = await (await client.get('/_health')).json()
+        assert health['status'] == 'degraded'
+        assert health['backends'][0]['state'] == BREAKER_OPEN
+        assert health['backends'][0]['last_error']
+        metrics = await (await client.get('/_metrics')).text()
+        assert f'qwen3_proxy_backend_breaker_state{{backend="{DEAD_BACKEND}"}} 2' in metrics
+        assert (f'qwen3_proxy_backend_breaker_transitions_total{{backend="{DEAD_BACKEND}",'
+                f'state="open"}} 1') in metrics
+        print("  ✓ Breaker state visible in /_health and /_metrics")
+
+        backend_pool.configure([DEAD_BACKEND])
+        started = time.monotonic()
+        resp = await client.post('/v1/chat/completions', json={"model": "test"})
+        assert resp.status == 503
+        print(f"  ✓ All breakers open: 503 in {(time.monotonic() - started) * 1000:.1f}ms")
+    finally:
+        await client.close()
+        await close_backends(backends)
+        backend_pool.configure(call_patch_proxy.fix_engine.get_setting('backends'))
+        restore_settings(original)
+
+
+async def test_prober_drives_breaker():
+    """Failed probes open the breaker, a recovered probe half-opens it, a request closes it"""
+    original = override_settings()
+    backends = await start_backends(2)
+    pool = BackendPool()
+    pool.configure([backend.url for backend in backends])
+    flaky = pool.backends[1]
+
+    try:
+        print("\nTesting background health probes:")
+        backends[1].healthy = False
+        pool.start()
+        await asyncio.sleep(0.3)
+        assert flaky.state == BREAKER_OPEN and flaky.last_probe_ok is False
+        assert flaky.probe_failures >= 2 and backends[0].probes >= 2
+        assert pool.backends[0].state == BREAKER_CLOSED
+        print(f"  ✓ Unhealthy backend opened after {flaky.probe_failures} failed probes")
+
+        backends[1].healthy = True
+        await asyncio.sleep(0.15)
+        assert flaky.state == BREAKER_HALF_OPEN and flaky.last_probe_ok is True
+        pool.acquire(flaky)
+        pool.record_response(flaky, 200)
+        pool.release(flaky)
+        assert flaky.state == BREAKER_CLOSED
+        print("  ✓ Recovered probe half-opens; a successful request closes")
+    finally:
+        await pool.close()
+        await call_patch_proxy.upstream_pool.close()
+        await close_backends(backends)
+        restore_settings(original)
+
+
+if __name__ == "__main__":
+    async def run_tests():
+        await test_requests_route_around_dead_backend()
+        await test_prober_drives_breaker()
+
+    try:
+        test_breaker_transitions()
+        asyncio.run(run_tests())
+        print("\n🎉 All circuit breaker tests passed!")
+    except AssertionError as e:
+        print(f"\n💥 Test failed: {e}")
+        sys.exit(1)
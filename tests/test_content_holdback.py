@@ -0,0 +1,112 @@
+#!/usr/bin/env python3
+"""
+Test that content is forwarded immediately and only possible XML tool call text is held back
+"""
+import sys
+import os
+import asyncio
+import json
+import uuid
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from call_patch_proxy import process_sse_event, RequestState, request_states, holdback_stats
+
+
+def content_event(text, finish_reason=None):
+    return {"choices": [{"index": 0, "delta": {"content": text}, "finish_reason": finish_reason}]}
+
+
+async def stream(deltas, finish_reason="stop"):
+    """Run deltas through the proxy and return (forwarded contents, tool calls)"""
+    request_id = str(uuid.uuid4())[:8]
+    request_states[request_id] = RequestState(request_id=request_id)
+    forwarded = []
+    tool_calls = []
+    try:
+        events = [content_event(d) for d in deltas]
+        events.append({"choices": [{"index": 0, "delta": {}, "finish_reason": finish_reason}]})
+        for event in events:
+            result = await process_sse_event(event, request_id)
+            delta = result["choices"][0]["delta"]
+            forwarded.append(delta.get("content", ""))
+            tool_calls += delta.get("tool_calls", [])
+    finally:
+        request_states.pop(request_id, None)
+    return forwarded, tool_calls
+
+
+async def test_prose_is_not_delayed():
+    """Plain prose, including '<' that cannot start a tag, goes out in the same delta"""
+    print("Testing prose pass-through:")
+    deltas = ["Hello, ", "if a ", "< b then ", "<b>bold</b>", " done"]
+    forwarded, tool_calls = await stream(deltas)
+    assert forwarded[:len(deltas)] == ["Hello, ", "if a ", "< b then ", "<b>bold</b>", " done"], forwarded
+    assert not tool_calls
+    print("  ✓ Every delta forwarded unchanged")
+
+
+async def test_possible_prefix_is_held_then_released():
+    """A trailing '<fun' is held and released as soon as it stops matching"""
+    print("\nTesting held prefix release:")
+    forwarded, _ = await stream(["Look at <fun", "ny> things"])
+    assert forwarded[0] == "Look at ", forwarded
+    assert forwarded[1] == "<funny> things", forwarded
+    print(f"  ✓ Forwarded {forwarded[:2]}")
+
+
+async def test_tool_call_xml_is_never_shown():
+    """Clients receive the prose and the tool call, but no fragment of the XML"""
+    print("\nTesting XML suppression:")
+    xml = "<function=glob>\n<parameter=pattern>\n*.py\n</parameter>\n</function>"
+    deltas = ["Let me search.\n"] + [xml[i:i + 3] for i in range(0, len(xml), 3)]
+    forwarded, tool_calls = await stream(deltas, finish_reason="tool_calls")
+    assert "".join(forwarded) == "Let me search.\n", forwarded
+    assert len(tool_calls) == 1
+    assert tool_calls[0]["function"]["name"] == "glob"
+    assert json.loads(tool_calls[0]["function"]["arguments"])["pattern"] == "*.py"
+    print("  ✓ No XML text leaked to the client")
+
+
+async def test_unclosed_call_is_released_on_finish():
+    """Held text is not lost when the stream finishes without closing the call"""
+    print("\nTesting release on finish:")
+    released_before = holdback_stats.released_bytes
+    forwarded, tool_calls = await stream(["Answer: <function=", "oops"])
+    assert "".join(forwarded) == "Answer: <function=oops", forwarded
+    assert not tool_calls
+    assert holdback_stats.released_bytes - released_before == len("<function=oops")
+    print(f"  ✓ Held text released, stats: {holdback_stats.as_dict()}")
+
+
+async def test_prose_around_call_in_one_delta():
+    """Text before and after a call in the same delta is forwarded, only the call is converted"""
+    print("\nTesting prose around a call in one delta:")
+    call = "<function=read><parameter=filePath>/a</parameter></function>"
+    converted_before = holdback_stats.converted_bytes
+    forwarded, tool_calls = await stream(["Let me check." + call + " Done."], finish_reason="tool_calls")
+    assert forwarded[0] == "Let me check. Done.", forwarded
+    assert len(tool_calls) == 1 and tool_calls[0]["function"]["name"] == "read"
+    assert holdback_stats.converted_bytes - converted_before == len(call)
+    forwarded, tool_calls = await stream(["Before <fun", "ction=read><parameter=filePath>/a</parameter>",
+                                          "</function> after"], finish_reason="tool_calls")
+    assert "".join(forwarded) == "Before  after" and len(tool_calls) == 1, forwarded
+    forwarded, tool_calls = await stream(["Wrapped: <tool_", "call>\n" + call + "\n</tool", "_call>\nThen more."],
+                                         finish_reason="tool_calls")
+    assert "".join(forwarded) == "Wrapped: \nThen more." and len(tool_calls) == 1, forwarded
+    print(f"  ✓ Forwarded {forwarded[0]!r} and the read call; <tool_call> wrapper removed")
+
+
+if __name__ == "__main__":
+    async def run_tests():
+        await test_prose_is_not_delayed()
+        await test_possible_prefix_is_held_then_released()
+        await test_tool_call_xml_is_never_shown()
+        await test_unclosed_call_is_released_on_finish()
+        await test_prose_around_call_in_one_delta()
+
+    try:
+        asyncio.run(run_tests())
+        print("\n🎉 All content holdback tests passed!")
+    except AssertionError as e:
+        print(f"\n💥 Test failed: {e}")
+        sys.exit(1)
@@ -0,0 +1,85 @@
+#!/usr/bin/env python3
+"""
+Test the process-wide expiry scheduler for tool buffers and request states
+"""
+import sys
+import os
+import asyncio
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import call_patch_proxy
+from call_patch_proxy import ExpiryScheduler, RequestState, ToolBuffer, request_states
+
+
+async def with_scheduler(test):
+    """Run a test against a fresh scheduler with short timeouts"""
+    settings = call_patch_proxy.fix_engine.settings
+    original = (settings.get('buffer_timeout'), settings.get('request_state_timeout'),
+                call_patch_proxy.expiry_scheduler)
+    settings['buffer_timeout'] = 0.2
+    settings['request_state_timeout'] = 0.4
+    scheduler = ExpiryScheduler()
+    call_patch_proxy.expiry_scheduler = scheduler
+    scheduler.start()
+    try:
+        await test(scheduler)
+    finally:
+        await scheduler.close()
+        settings['buffer_timeout'], settings['request_state_timeout'], call_patch_proxy.expiry_scheduler = original
+
+
+async def idle_buffers_are_evicted(scheduler):
+    state = RequestState(request_id="expiry-buffers")
+    request_states[state.request_id] = state
+    try:
+        idle = state.add_buffer("idle", ToolBuffer(call_id="idle"))
+        active = state.add_buffer("active", ToolBuffer(call_id="active"))
+        for _ in range(5):
+            await asyncio.sleep(0.1)
+            active.update_content("x")
+        assert "idle" not in state.tool_buffers, "Idle buffer should be evicted"
+        assert "active" in state.tool_buffers, "Active buffer should be rescheduled, not evicted"
+        await asyncio.sleep(0.35)
+        assert "active" not in state.tool_buffers
+        assert scheduler.buffers_evicted == 2
+        print(f"  ✓ Evicted idle buffers, kept active one while fed: {scheduler.stats()}")
+    finally:
+        request_states.pop(state.request_id, None)
+
+
+async def abandoned_requests_are_reaped(scheduler):
+    finished = RequestState(request_id="expiry-finished")
+    abandoned = RequestState(request_id="expiry-abandoned")
+    for state in (finished, abandoned):
+        request_states[state.request_id] = state
+        scheduler.track_request(state)
+    # The finished handler cleans up normally, the abandoned one never does
+    del request_states[finished.request_id]
+    await asyncio.sleep(0.6)
+    assert abandoned.request_id not in request_states
+    assert scheduler.requests_reaped == 1
+    assert scheduler.stats()['scheduled'] == 0
+    print(f"  ✓ Reaped abandoned request state: {scheduler.stats()}")
+
+
+async def test_idle_buffers_are_evicted():
+    print("Testing buffer expiry:")
+    await with_scheduler(idle_buffers_are_evicted)
+
+
+async def test_abandoned_requests_are_reaped():
+    print("\nTesting request state reaping:")
+    await with_scheduler(abandoned_requests_are_reaped)
+
+
+if __name__ == "__main__":
+    async def run_tests():
+        await test_idle_buffers_are_evicted()
+        await test_abandoned_requests_are_reaped()
+
+    try:
+        asyncio.run(run_tests())
+        print("\n🎉 All expiry scheduler tests passed!")
+    except AssertionError as e:
+        print(f"\n💥 Test failed: {e}")
+        sys.exit(1)
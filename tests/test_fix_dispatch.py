@@ -0,0 +1,71 @@
+#!/usr/bin/env python3
+"""
+Test the compiled per-tool fix dispatch tables
+"""
+import sys
+import os
+import asyncio
+import json
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from call_patch_proxy import ToolFixEngine, ToolBuffer, NO_FIXES, get_fixed_arguments
+import call_patch_proxy
+
+CONFIG_FILE = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "tool_fixes.yaml")
+
+
+def test_tables_compiled_from_yaml():
+    """Every configured tool gets a tuple of bound rules, others get NO_FIXES"""
+    print("Testing compiled dispatch tables:")
+    engine = ToolFixEngine(CONFIG_FILE)
+    for tool_name, tool_config in engine.config['tools'].items():
+        compiled = engine.get_fixes(tool_name)
+        assert [fix.name for fix in compiled] == [fix['name'] for fix in tool_config['fixes']], tool_name
+        assert all(callable(fix.condition) and callable(fix.action) for fix in compiled)
+        print(f"  ✓ {tool_name}: {len(compiled)} rule(s)")
+    assert engine.get_fixes("write") is NO_FIXES
+    assert engine.get_fixes("BASH") == engine.get_fixes("bash")
+    assert not engine.has_fixes("webfetch")
+    print("  ✓ Tools without rules map to NO_FIXES")
+
+
+def test_unknown_condition_is_skipped():
+    """A rule with an unknown condition never matched and is dropped at compile time"""
+    print("\nTesting unknown conditions:")
+    engine = ToolFixEngine(CONFIG_FILE)
+    engine.fix_table = engine._compile_fixes({"bash": {"fixes": [
+        {"name": "bogus", "parameter": "x", "condition": "is_purple", "action": "set_default", "default_value": 1},
+        {"name": "missing_description", "parameter": "description", "condition": "missing_or_empty",
+         "action": "set_default", "default_value": "Run"},
+    ]}})
+    assert [fix.name for fix in engine.get_fixes("bash")] == ["missing_description"]
+    _, fixed = engine.apply_fixes("bash", {"command": "ls"}, "test")
+    assert fixed == {"command": "ls", "description": "Run"}
+    print("  ✓ Unknown condition skipped, remaining rule applied")
+
+
+async def test_no_rule_tools_skip_round_trip():
+    """Arguments of tools without rules are forwarded byte for byte"""
+    print("\nTesting passthrough for tools without rules:")
+    content = '{"filePath": "/tmp/a.py",  "content": "caf\\u00e9"}'
+    tool_name, args = await get_fixed_arguments(ToolBuffer(call_id="t", content=content, tool_name="Write"), "test")
+    assert tool_name == "write"
+    assert args == content, "Arguments should not be re-serialized"
+    tool_name, args = await get_fixed_arguments(ToolBuffer(call_id="t", content='{"command": "ls"}', tool_name="bash"), "test")
+    assert json.loads(args)["description"] == call_patch_proxy.fix_engine.get_fixes("bash")[0].rule["default_value"]
+    print("  ✓ write forwarded untouched, bash still fixed")
+
+    tool_name, args = await get_fixed_arguments(ToolBuffer(call_id="t", content='{"filePath": "/a" "/b"}', tool_name="write"), "test")
+    assert args == "", "Balanced but malformed arguments should still be suppressed"
+    print("  ✓ Malformed arguments of tools without rules still suppressed")
+
+
+if __name__ == "__main__":
+    try:
+        test_tables_compiled_from_yaml()
+        test_unknown_condition_is_skipped()
+        asyncio.run(test_no_rule_tools_skip_round_trip())
+        print("\n🎉 All fix dispatch tests passed!")
+    except AssertionError as e:
+        print(f"\n💥 Test failed: {e}")
+        sys.exit(1)
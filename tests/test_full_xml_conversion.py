@@ -57,10 +57,11 @@ src/semantic_harvest/src/common/cli/commands/*.py
     
     # Verify XML was converted to tool_calls
     has_tool_calls = "tool_calls" in delta
-    content_cleared = delta.get("content", "") == ""
+    # The prose before the call is still shown; the XML is not
+    content_cleared = delta.get("content", "") == xml_content[:xml_content.index("<function=")]
     
     print(f"Has tool_calls after processing: {has_tool_calls}")
-    print(f"Content cleared: {content_cleared}")
+    print(f"XML removed from content: {content_cleared}")
     
     if has_tool_calls:
         tool_call = delta["tool_calls"][0]
@@ -0,0 +1,174 @@
+#!/usr/bin/env python3
+"""
+Test hedged requests when a backend is slow to send its first byte
+"""
+import sys
+import os
+import asyncio
+import json
+import time
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from aiohttp import web
+from aiohttp.test_utils import TestServer, TestClient
+
+import call_patch_proxy
+from call_patch_proxy import Histogram, backend_pool, handle_request, hedge_delay, proxy_metrics, upstream_pool_ctx
+from mock_backends import MockBackend, close_backends
+
+SETTINGS = {
+    'hedging': True,
+    'hedge_after': 0.1,
+    'hedge_min_delay': 0.05,
+}
+
+
+def override_settings(**overrides):
+    settings = call_patch_proxy.fix_engine.settings
+    values = dict(SETTINGS, **overrides)
+    original = {key: settings.get(key) for key in values}
+    settings.update(values)
+    return original
+
+
+def restore_settings(original):
+    settings = call_patch_proxy.fix_engine.settings
+    for key, value in original.items():
+        if value is None:
+            settings.pop(key, None)
+        else:
+            settings[key] = value
+
+
+def test_hedge_delay():
+    """Fixed or p95-derived thresholds, only for streaming requests"""
+    print("Testing hedge thresholds:")
+    histogram = Histogram('h', 'h', (0.1, 0.5, 1.0))
+    assert histogram.quantile(0.95) is None
+    for value in [0.05] * 90 + [0.7] * 10:
+        histogram.observe(value)
+    assert histogram.quantile(0.5) == 0.1 and histogram.quantile(0.95) == 1.0
+    print("  ✓ Histogram quantiles use bucket upper bounds")
+
+    stream = {"stream": True}
+    assert hedge_delay(stream) is None
+    original = override_settings()
+    try:
+        assert hedge_delay(stream) == 0.1
+        assert hedge_delay({"stream": False}) is None and hedge_delay(None) is None
+        call_patch_proxy.fix_engine.settings['hedge_after'] = 'p95'
+        expected = max(0.05, proxy_metrics.backend_ttfb.quantile(0.95) or 0.05)
+        assert hedge_delay(stream) == expected
+        print("  ✓ Fixed and p95 thresholds; non-streaming requests are not hedged")
+    finally:
+        restore_settings(original)
+
+
+async def test_slow_backend_is_hedged():
+    """A stalled primary loses to the duplicate, which is streamed; the primary is closed"""
+    original = override_settings()
+    slow = await MockBackend("slow", first_delay=0.6).start()
+    fast = await MockBackend("fast").start()
+    # The heavier weight makes the slow replica the first choice
+    backend_pool.configure([{'url': slow.url, 'weight': 10}, {'url': fast.url}])
+    app = web.Application()
+    app.cleanup_ctx.append(upstream_pool_ctx)
+    app.router.add_route("*", "/{tail:.*}", handle_request)
+    client = TestClient(TestServer(app))
+    await client.start_server()
+    sent, won = proxy_metrics.hedges_sent, proxy_metrics.hedges_won
+
+    try:
+        print("\nTesting hedged request against a stalled backend:")
+        started = time.monotonic()
+        resp = await client.post('/v1/chat/completions', json={"model": "test", "stream": True})
+        body = await resp.read()
+        elapsed = time.monotonic() - started
+        assert resp.status == 200 and b"fast:0" in body and b"slow:" not in body
+        assert elapsed < 0.5, elapsed
+        assert proxy_metrics.hedges_sent - sent == 1 and proxy_metrics.hedges_won - won == 1
+        print(f"  ✓ Duplicate answered in {elapsed * 1000:.0f}ms instead of waiting 600ms")
+
+        await asyncio.sleep(0.7)
+        assert slow.aborted == 1 and slow.active == 0
+        assert all(backend.outstanding == 0 for backend in backend_pool.backends)
+        print("  ✓ Losing stream was closed and both backends released")
+
+        resp = await client.post('/v1/chat/completions',
+                                 json={"model": "test", "stream": True, "mock_first_delay": 0})
+        body = await resp.read()
+        assert b"slow:0" in body and proxy_metrics.hedges_sent - sent == 1
+        print("  ✓ No duplicate when the first byte arrives in time")
+
+        resp = await client.post('/v1/chat/completions', json={"model": "test"})
+        body = await resp.read()
+        assert b"slow:0" in body and proxy_metrics.hedges_sent - sent == 1
+        print("  ✓ Non-streaming requests are never hedged")
+    finally:
+        await client.close()
+        await close_backends([slow, fast])
+        backend_pool.configure(call_patch_proxy.fix_engine.get_setting('backends'))
+        restore_settings(original)
+
+
+# Longer than the client stream reader's line limit (128-512 KB depending on the aiohttp version)
+LARGE_LINE = 2 * 1024 * 1024
+
+
+async def large_first_line(request: web.Request):
+    """A body whose first line is longer than the stream reader's line limit"""
+    body = await request.json()
+    content = "x" * LARGE_LINE
+    if not body.get("stream"):
+        return web.json_response({"choices": [{"index": 0, "message": {"content": content}}]})
+    response = web.StreamResponse(headers={"Content-Type": "text/event-stream"})
+    await response.prepare(request)
+    event = {"choices": [{"index": 0, "delta": {"content": content}}]}
+    await response.write(f"data: {json.dumps(event)}\n\ndata: [DONE]\n\n".encode())
+    return response
+
+
+async def test_large_first_line():
+    """A first line over the reader's limit is forwarded, not treated as a backend failure"""
+    original = override_settings()
+    backend_app = web.Application()
+    backend_app.router.add_post('/v1/chat/completions', large_first_line)
+    backend = TestServer(backend_app)
+    await backend.start_server()
+    backend_pool.configure([str(backend.make_url('')).rstrip('/')])
+    app = web.Application()
+    app.cleanup_ctx.append(upstream_pool_ctx)
+    app.router.add_route("*", "/{tail:.*}", handle_request)
+    client = TestClient(TestServer(app))
+    await client.start_server()
+
+    try:
+        print("\nTesting a first line larger than the line limit:")
+        resp = await client.post('/v1/chat/completions', json={"model": "test"})
+        assert resp.status == 200, resp.status
+        body = await resp.json()
+        assert len(body["choices"][0]["message"]["content"]) == LARGE_LINE
+        print("  ✓ 2 MB single-line JSON body passed through")
+
+        resp = await client.post('/v1/chat/completions', json={"model": "test", "stream": True})
+        body = await resp.read()
+        assert resp.status == 200 and b"x" * LARGE_LINE in body and b"[DONE]" in body
+        assert backend_pool.backends[0].state == call_patch_proxy.BREAKER_CLOSED
+        print("  ✓ 2 MB first SSE event streamed on a hedged request, breaker closed")
+    finally:
+        await client.close()
+        await backend.close()
+        backend_pool.configure(call_patch_proxy.fix_engine.get_setting('backends'))
+        restore_settings(original)
+
+
+if __name__ == "__main__":
+    try:
+        test_hedge_delay()
+        asyncio.run(test_slow_backend_is_hedged())
+        asyncio.run(test_large_first_line())
+        print("\n🎉 All hedging tests passed!")
+    except AssertionError as e:
+        print(f"\n💥 Test failed: {e}")
+        sys.exit(1)
@@ -0,0 +1,68 @@
+#!/usr/bin/env python3
+"""
+Test the pluggable JSON codec used on the streaming hot path
+"""
+import sys
+import os
+import json
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import call_patch_proxy
+from call_patch_proxy import JSONCodec
+
+AVAILABLE = ['stdlib'] + [name for name in ('orjson', 'ujson') if getattr(call_patch_proxy, name)]
+
+
+def test_round_trip_all_backends():
+    """Every installed backend decodes str/bytes and keeps non-ASCII text unescaped"""
+    print(f"Testing installed backends: {AVAILABLE}")
+    event = {"choices": [{"delta": {"content": "Привет, 世界 — café / path"}, "finish_reason": None}]}
+    for backend in AVAILABLE:
+        codec = JSONCodec(backend)
+        assert codec.backend == backend
+        encoded = codec.dumps_bytes(event)
+        assert "Привет, 世界 — café / path".encode("utf-8") in encoded, encoded
+        assert codec.loads(encoded) == event
+        assert codec.loads(encoded.decode("utf-8")) == event
+        assert codec.loads(codec.dumps(event)) == event
+        print(f"  ✓ {backend}: {len(encoded)} bytes, non-ASCII kept as UTF-8")
+
+
+def test_errors_are_json_decode_errors():
+    """Bad input raises json.JSONDecodeError whatever the backend"""
+    print("\nTesting decode errors:")
+    for backend in AVAILABLE:
+        codec = JSONCodec(backend)
+        for bad in ('{"a": ', b'\xff\xfe{}', "{'single': 'quotes'}"):
+            try:
+                codec.loads(bad)
+            except json.JSONDecodeError:
+                continue
+            raise AssertionError(f"{backend} accepted {bad!r}")
+        print(f"  ✓ {backend} raises JSONDecodeError")
+
+
+def test_fallbacks():
+    """Unknown or missing backends fall back to stdlib; unencodable values fall back per call"""
+    print("\nTesting fallbacks:")
+    assert JSONCodec('simdjson').backend == 'stdlib'
+    if call_patch_proxy.ujson is None:
+        assert JSONCodec('ujson').backend == 'stdlib'
+    for backend in AVAILABLE:
+        codec = JSONCodec(backend)
+        big = {"n": 2 ** 70, "nan": float("nan")}
+        assert b'"n": 1180591620717411303424' in codec.dumps_bytes(big) or \
+            b'"n":1180591620717411303424' in codec.dumps_bytes(big)
+        assert codec.loads('{"x": NaN}')["x"] != 0
+    print("  ✓ Fallbacks work")
+
+
+if __name__ == "__main__":
+    try:
+        test_round_trip_all_backends()
+        test_errors_are_json_decode_errors()
+        test_fallbacks()
+        print("\n🎉 All JSON codec tests passed!")
+    except AssertionError as e:
+        print(f"\n💥 Test failed: {e}")
+        sys.exit(1)
@@ -0,0 +1,120 @@
+#!/usr/bin/env python3
+"""
+Test the incremental JSON completeness scanner used by tool call buffers
+"""
+import sys
+import os
+import random
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from call_patch_proxy import JSONCompletenessScanner, ToolBuffer, is_json_complete
+
+
+def rescan_is_json_complete(json_str: str) -> bool:
+    """Reference full-rescan implementation the scanner must agree with"""
+    if not json_str or not json_str.strip():
+        return False
+    json_str = json_str.strip()
+    if not json_str.startswith(('{', '[')):
+        return False
+    stack = []
+    in_string = False
+    escape_next = False
+    for char in json_str:
+        if escape_next:
+            escape_next = False
+            continue
+        if char == '\\':
+            escape_next = True
+            continue
+        if char == '"':
+            in_string = not in_string
+            continue
+        if in_string:
+            continue
+        if char in '{[':
+            stack.append(char)
+        elif char in '}]':
+            if not stack:
+                return False
+            last = stack.pop()
+            if (char == '}' and last != '{') or (char == ']' and last != '['):
+                return False
+    return len(stack) == 0 and not in_string
+
+
+CASES = [
+    '{"key": "value"}',
+    '{"key": "value"',
+    '  {"nested": {"inner": [1, 2, {"x": "}"}]}}  ',
+    '{"string": "with \\"quotes\\" inside"}',
+    '{"backslash": "ends with \\\\"}',
+    '{"escaped_brace": \\{}',
+    '{"a": 1}}',
+    '{"a": [1, 2}',
+    '[{"todos": "[{\\"id\\": \\"1\\"}]"}]',
+    'not json {}',
+    '{}{',
+    '{}x',
+    '',
+    '   ',
+]
+
+
+def test_scanner_matches_rescan_on_fragments():
+    """Every fragmentation of every case must agree with a full rescan after each fragment"""
+    print("Testing incremental scanner against full rescan:")
+    rng = random.Random(1234)
+    for text in CASES:
+        for _ in range(50):
+            scanner = JSONCompletenessScanner()
+            seen = ""
+            pos = 0
+            while pos < len(text):
+                step = rng.randint(1, 4)
+                fragment = text[pos:pos + step]
+                pos += step
+                scanner.feed(fragment)
+                seen += fragment
+                assert scanner.is_complete() == rescan_is_json_complete(seen), (
+                    f"Mismatch after {seen!r}"
+                )
+        print(f"  ✓ {text[:40]!r}")
+
+
+def test_scanner_matches_rescan_on_random_input():
+    """Random structural noise split into 1-byte fragments"""
+    print("\nTesting scanner on random input:")
+    rng = random.Random(42)
+    alphabet = '{}[]"\\ a:,'
+    for _ in range(500):
+        text = rng.choice('{[ ') + ''.join(rng.choice(alphabet) for _ in range(rng.randint(0, 30)))
+        scanner = JSONCompletenessScanner()
+        for i, char in enumerate(text):
+            scanner.feed(char)
+            assert scanner.is_complete() == rescan_is_json_complete(text[:i + 1]), text[:i + 1]
+        assert is_json_complete(text) == rescan_is_json_complete(text), text
+    print("  ✓ 500 random strings agree")
+
+
+def test_tool_buffer_uses_scanner():
+    """ToolBuffer completeness follows update_content fragments"""
+    print("\nTesting ToolBuffer integration:")
+    buffer = ToolBuffer(call_id="test")
+    for fragment in ['{"command": "echo ', '\\"}', '\\""', ', "x": [1]', '}']:
+        assert not buffer.is_json_complete()
+        buffer.update_content(fragment)
+    assert buffer.is_json_complete()
+    assert ToolBuffer(call_id="prefilled", content='{"a": 1}').is_json_complete()
+    print("  ✓ ToolBuffer reports completeness incrementally")
+
+
+if __name__ == "__main__":
+    try:
+        test_scanner_matches_rescan_on_fragments()
+        test_scanner_matches_rescan_on_random_input()
+        test_tool_buffer_uses_scanner()
+        print("\n🎉 All JSON scanner tests passed!")
+    except AssertionError as e:
+        print(f"\n💥 Test failed: {e}")
+        sys.exit(1)
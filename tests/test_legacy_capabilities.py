@@ -0,0 +1,218 @@
+#!/usr/bin/env python3
+"""
+Test the per-backend, per-model legacy capability table
+"""
+import sys
+import os
+import asyncio
+import json
+import tempfile
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from aiohttp import web
+from aiohttp.test_utils import TestServer, TestClient
+
+import call_patch_proxy
+from call_patch_proxy import LegacyCapabilities, backend_pool, handle_request, legacy_capabilities, \
+    proxy_metrics, should_use_legacy_mode_for_model, upstream_pool, upstream_pool_ctx
+from mock_backends import MockBackend, close_backends
+
+TABLE_DIR = tempfile.mkdtemp(prefix="legacy-capabilities-")
+SETTINGS = {
+    'legacy_capability_file': os.path.join(TABLE_DIR, "table.json"),
+    'legacy_capability_ttl': 3600,
+    'legacy_probe_models': ['qwen3-coder'],
+    'breaker_failure_threshold': 100,
+}
+
+
+def override_settings(**overrides):
+    settings = call_patch_proxy.fix_engine.settings
+    values = dict(SETTINGS, **overrides)
+    original = {key: settings.get(key) for key in values}
+    settings.update(values)
+    return original
+
+
+def restore_settings(original):
+    settings = call_patch_proxy.fix_engine.settings
+    for key, value in original.items():
+        if value is None:
+            settings.pop(key, None)
+        else:
+            settings[key] = value
+
+
+class MalformedChunkBackend:
+    """Raw HTTP server whose chunked framing breaks before the first line, like the old gateways"""
+
+    def __init__(self):
+        self.hits = 0
+        self.server = None
+        self.url = None
+
+    async def start(self) -> 'MalformedChunkBackend':
+        self.server = await asyncio.start_server(self.handle, '127.0.0.1', 0)
+        self.url = f"http://127.0.0.1:{self.server.sockets[0].getsockname()[1]}"
+        return self
+
+    async def handle(self, reader, writer):
+        head = await reader.readuntil(b"\r\n\r\n")
+        length = 0
+        for line in head.split(b"\r\n"):
+            if line.lower().startswith(b"content-length:"):
+                length = int(line.split(b":", 1)[1])
+        await reader.readexactly(length)
+        self.hits += 1
+        event = {"choices": [{"index": 0, "delta": {"content": "legacy"}}]}
+        writer.write(b"HTTP/1.1 200 OK\r\nContent-Type: text/event-stream\r\nTransfer-Encoding: chunked\r\n"
+                     b"Connection: close\r\n\r\n")
+        await writer.drain()
+        await asyncio.sleep(0.05)
+        # The chunk header promises more than the server sends before closing
+        writer.write(b"1000\r\n" + f"data: {json.dumps(event)}".encode())
+        await writer.drain()
+        writer.close()
+
+    async def close(self):
+        self.server.close()
+        await self.server.wait_closed()
+
+
+def test_table():
+    """Lookups per pair, TTL expiry, persistence across restarts"""
+    print("Testing capability table:")
+    original = override_settings()
+    try:
+        table = LegacyCapabilities()
+        assert table.lookup("http://a", "m") is None
+        table.record("http://a", "m", True, 'runtime')
+        table.record("http://b", "m", False, 'probe')
+        assert table.lookup("http://a", "m") is True and table.lookup("http://b", "m") is False
+        assert table.lookup("http://a", "other") is None and table.detected()
+        print("  ✓ Keyed by backend and model")
+
+        restarted = LegacyCapabilities()
+        restarted.load()
+        assert restarted.lookup("http://a", "m") is True and restarted.lookup("http://b", "m") is False
+        print("  ✓ Reloaded from the table file after a restart")
+
+        call_patch_proxy.fix_engine.settings['legacy_capability_ttl'] = 0
+        assert restarted.lookup("http://a", "m") is None and not restarted.detected()
+        print("  ✓ Expired entries are checked again")
+    finally:
+        restore_settings(original)
+        os.remove(SETTINGS['legacy_capability_file'])
+
+
+async def test_runtime_detection():
+    """Only the broken backend switches to legacy mode, and it skips the failed attempt next time"""
+    original = override_settings()
+    broken = await MalformedChunkBackend().start()
+    healthy = await MockBackend("b0").start()
+    app = web.Application()
+    app.cleanup_ctx.append(upstream_pool_ctx)
+    app.router.add_route("*", "/{tail:.*}", handle_request)
+    client = TestClient(TestServer(app))
+    await client.start_server()
+    retries = proxy_metrics.legacy_retries
+
+    try:
+        print("\nTesting runtime detection:")
+        body = {"model": "qwen3-coder", "stream": True, "messages": []}
+        backend_pool.configure([broken.url])
+        resp = await client.post('/v1/chat/completions', json=body)
+        await resp.read()
+        assert resp.status == 200 and broken.hits == 2
+        assert proxy_metrics.legacy_retries - retries == 1
+        assert legacy_capabilities.lookup(broken.url, "qwen3-coder") is True
+        assert should_use_legacy_mode_for_model("qwen3-coder", broken.url)
+        assert not should_use_legacy_mode_for_model("other-model", broken.url)
+        print("  ✓ Payload error before any output retried in legacy mode and recorded")
+
+        resp = await client.post('/v1/chat/completions', json=body)
+        await resp.read()
+        assert broken.hits == 3 and proxy_metrics.legacy_retries - retries == 1
+        print("  ✓ Next request goes straight to legacy mode")
+
+        backend_pool.configure([healthy.url])
+        resp = await client.post('/v1/chat/completions', json=body)
+        assert b"b0:0" in await resp.read()
+        assert legacy_capabilities.lookup(healthy.url, "qwen3-coder") is False
+        await legacy_capabilities.flush()
+        with open(SETTINGS['legacy_capability_file']) as f:
+            saved = {(entry['backend'], entry['legacy']) for entry in json.load(f)['entries']}
+        assert {(broken.url, True), (healthy.url, False)} <= saved
+        print("  ✓ Healthy backend stays on the fast path; both saved")
+    finally:
+        await client.close()
+        await broken.close()
+        await close_backends([healthy])
+        backend_pool.configure(call_patch_proxy.fix_engine.get_setting('backends'))
+        # Local ports get reused; later tests must not inherit these entries
+        legacy_capabilities._entries.clear()
+        restore_settings(original)
+
+
+async def test_saved_in_background():
+    """Changes only mark the table dirty; it is written later, once, off the event loop"""
+    print("\nTesting background saves:")
+    original = override_settings()
+    path = SETTINGS['legacy_capability_file']
+    if os.path.exists(path):
+        os.remove(path)
+    try:
+        table = LegacyCapabilities()
+        table.record("http://a", "m", True, 'runtime')
+        table.record("http://b", "m", False, 'runtime')
+        assert not os.path.exists(path)
+        print("  ✓ Nothing written from the request path")
+
+        table.record("http://a", "m", True, 'runtime')
+        table.confirm("http://b", "m")
+        await table.close()
+        with open(path) as f:
+            assert len(json.load(f)['entries']) == 2
+        assert not table._dirty
+        print("  ✓ Written at shutdown; unchanged entries did not mark it dirty again")
+    finally:
+        restore_settings(original)
+        if os.path.exists(path):
+            os.remove(path)
+
+
+async def test_startup_probe():
+    """The startup probe fills the table without client traffic"""
+    original = override_settings(legacy_capability_file="")
+    broken = await MalformedChunkBackend().start()
+    healthy = await MockBackend("b0").start()
+    await upstream_pool.start()
+    try:
+        print("\nTesting startup probe:")
+        table = LegacyCapabilities()
+        await table.probe_all([broken.url, healthy.url])
+        assert table.lookup(broken.url, "qwen3-coder") is True
+        assert table.lookup(healthy.url, "qwen3-coder") is False
+        assert healthy.bodies[0]["max_tokens"] == 1
+        print("  ✓ One-token probe classified both backends")
+    finally:
+        await upstream_pool.close()
+        await broken.close()
+        await close_backends([healthy])
+        restore_settings(original)
+
+
+if __name__ == "__main__":
+    async def run_tests():
+        await test_runtime_detection()
+        await test_saved_in_background()
+        await test_startup_probe()
+
+    try:
+        test_table()
+        asyncio.run(run_tests())
+        print("\n🎉 All legacy capability tests passed!")
+    except AssertionError as e:
+        print(f"\n💥 Test failed: {e}")
+        sys.exit(1)
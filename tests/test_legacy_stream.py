@@ -0,0 +1,207 @@
+#!/usr/bin/env python3
+"""
+Test the tolerant HTTP/1.1 client used for legacy backends
+"""
+import sys
+import os
+import asyncio
+import json
+import time
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from aiohttp import web
+from aiohttp.test_utils import TestServer, TestClient
+
+import call_patch_proxy
+from call_patch_proxy import LegacyHTTPProtocol, backend_pool, handle_request, open_legacy_stream, \
+    upstream_pool_ctx
+
+
+def event(content: str) -> bytes:
+    return f"data: {json.dumps({'choices': [{'index': 0, 'delta': {'content': content}}]})}\n\n".encode()
+
+
+def chunk(data: bytes) -> bytes:
+    return b"%x\r\n" % len(data) + data + b"\r\n"
+
+
+SSE = event("Hello") + event(" world") + b"data: [DONE]\n\n"
+FIRST = event("Hello")
+
+
+def sse_lines(body: bytes):
+    """Non-blank lines; salvaged streams may carry extra blank lines, which SSE ignores"""
+    return [line for line in body.splitlines() if line.strip()]
+
+
+class RawBackend:
+    """Answers every request with a fixed status line, headers and body pieces"""
+
+    def __init__(self, head: bytes, pieces, close: bool = True):
+        self.head = head
+        self.pieces = pieces
+        self.close_after = close
+        self.requests = []
+        self.server = None
+        self.url = None
+
+    async def start(self) -> 'RawBackend':
+        self.server = await asyncio.start_server(self.handle, '127.0.0.1', 0)
+        self.url = f"http://127.0.0.1:{self.server.sockets[0].getsockname()[1]}"
+        return self
+
+    async def handle(self, reader, writer):
+        head = await reader.readuntil(b"\r\n\r\n")
+        length = 0
+        for line in head.split(b"\r\n"):
+            if line.lower().startswith(b"content-length:"):
+                length = int(line.split(b":", 1)[1])
+        self.requests.append(head + await reader.readexactly(length))
+        writer.write(self.head)
+        for piece in self.pieces:
+            await writer.drain()
+            await asyncio.sleep(0.01)
+            writer.write(piece)
+        await writer.drain()
+        if not self.close_after:
+            await reader.read()  # Keep-alive server: never closes first, waits for the client to
+        writer.close()
+
+    async def close(self):
+        self.server.close()
+
+
+CHUNKED = b"HTTP/1.1 200 OK\r\nContent-Type: text/event-stream\r\nTransfer-Encoding: chunked\r\n\r\n"
+
+
+async def read_all(backend: RawBackend) -> bytes:
+    resp = await open_legacy_stream("POST", f"{backend.url}/v1/chat/completions", {"Content-Type": "application/json"},
+                                    b'{"stream": true}', "test")
+    async with resp:
+        assert resp.status == 200 and resp.headers['content-type'] == 'text/event-stream'
+        return b"".join([data async for data in resp.iter_any()])
+
+
+async def test_framing():
+    """Valid, broken and missing chunk framing all yield the same SSE lines"""
+    print("Testing response framing:")
+    cases = [
+        ("valid chunks", RawBackend(CHUNKED, [chunk(SSE[:30]), chunk(SSE[30:]), b"0\r\n\r\n"])),
+        ("chunked header, plain body", RawBackend(CHUNKED, [SSE[:30], SSE[30:]])),
+        ("wrong chunk sizes", RawBackend(CHUNKED, [b"10\r\n" + FIRST + b"\r\n",
+                                                    b"5\r\n" + SSE[len(FIRST):] + b"\r\n0\r\n\r\n"])),
+        ("Content-Length", RawBackend(b"HTTP/1.1 200 OK\r\nContent-Type: text/event-stream\r\n"
+                                      b"Content-Length: %d\r\n\r\n" % len(SSE), [SSE[:10], SSE[10:]], close=False)),
+        ("no length, closed", RawBackend(b"HTTP/1.1 200 OK\r\nContent-Type: text/event-stream\r\n\r\n", [SSE])),
+    ]
+    for label, backend in cases:
+        await backend.start()
+        try:
+            body = await read_all(backend)
+            assert sse_lines(body) == sse_lines(SSE), (label, body)
+            print(f"  ✓ {label}")
+        finally:
+            await backend.close()
+
+    backend = await RawBackend(CHUNKED, [chunk(SSE)]).start()
+    try:
+        await read_all(backend)
+        request = backend.requests[0]
+        assert request.startswith(b"POST /v1/chat/completions HTTP/1.1\r\n")
+        assert b"Connection: close" in request and request.endswith(b'{"stream": true}')
+        print("  ✓ Request line, headers and body sent")
+    finally:
+        await backend.close()
+
+
+class NullTransport:
+    def pause_reading(self):
+        pass
+
+    def resume_reading(self):
+        pass
+
+    def close(self):
+        pass
+
+
+async def test_line_splitting():
+    """A long line split across many reads comes out whole, once it ends"""
+    print("\nTesting line splitting:")
+    protocol = LegacyHTTPProtocol()
+    protocol.connection_made(NullTransport())
+    protocol.data_received(CHUNKED)
+    long_event = event("x" * 20000)
+    body = chunk(long_event + SSE) + b"0\r\n\r\n"
+    lines = []
+    for i in range(0, len(body), 7):
+        protocol.data_received(body[i:i + 7])
+        lines += protocol.take_lines()
+        # Bytes already searched are not searched again on the next read
+        assert protocol._scanned == len(protocol.payload)
+    assert b"".join(lines) == long_event + SSE and lines[0] == long_event[:-1]
+    assert protocol.eof and not protocol.payload and not protocol.salvaged
+    print(f"  ✓ {len(lines)} lines from {len(body) // 7 + 1} reads of 7 bytes")
+
+
+async def test_done_ends_stream():
+    """data: [DONE] ends the stream at once, even if the server keeps the connection open"""
+    print("\nTesting end of stream:")
+    backend = await RawBackend(CHUNKED, [chunk(SSE)], close=False).start()
+    try:
+        started = time.monotonic()
+        body = await read_all(backend)
+        elapsed = time.monotonic() - started
+        assert body == SSE and elapsed < 1, elapsed
+        print(f"  ✓ Ended {elapsed * 1000:.0f}ms after the request, no read timeout")
+    finally:
+        await backend.close()
+
+    try:
+        await open_legacy_stream("POST", "http://127.0.0.1:9/v1/chat/completions", {}, b"", "test")
+        assert False, "connect should fail"
+    except ConnectionError:
+        print("  ✓ Refused connection raises ConnectionError")
+
+
+async def test_through_proxy():
+    """Forced legacy mode streams through the normal processing pipeline"""
+    print("\nTesting legacy mode through the proxy:")
+    settings = call_patch_proxy.fix_engine.settings
+    original = settings.get('legacy_api_mode')
+    settings['legacy_api_mode'] = True
+    backend = await RawBackend(CHUNKED, [SSE[:25], SSE[25:]], close=False).start()
+    backend_pool.configure([backend.url])
+    app = web.Application()
+    app.cleanup_ctx.append(upstream_pool_ctx)
+    app.router.add_route("*", "/{tail:.*}", handle_request)
+    client = TestClient(TestServer(app))
+    await client.start_server()
+    try:
+        started = time.monotonic()
+        resp = await client.post('/v1/chat/completions', json={"model": "legacy", "stream": True})
+        body = await resp.read()
+        assert resp.status == 200 and b'"Hello"' in body and body.rstrip().endswith(b"data: [DONE]")
+        assert time.monotonic() - started < 1
+        print("  ✓ Salvaged stream delivered and finished without waiting for the socket")
+    finally:
+        await client.close()
+        await backend.close()
+        backend_pool.configure(call_patch_proxy.fix_engine.get_setting('backends'))
+        settings['legacy_api_mode'] = original
+
+
+if __name__ == "__main__":
+    async def run_tests():
+        await test_framing()
+        await test_line_splitting()
+        await test_done_ends_stream()
+        await test_through_proxy()
+
+    try:
+        asyncio.run(run_tests())
+        print("\n🎉 All legacy stream tests passed!")
+    except AssertionError as e:
+        print(f"\n💥 Test failed: {e}")
+        sys.exit(1)
@@ -0,0 +1,121 @@
+#!/usr/bin/env python3
+"""
+Test least-outstanding-requests balancing across several backends
+"""
+import sys
+import os
+import asyncio
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from aiohttp import web
+from aiohttp.test_utils import TestServer, TestClient
+
+import call_patch_proxy
+from call_patch_proxy import BackendPool, backend_pool, handle_request, health_check, upstream_pool_ctx
+from mock_backends import start_backends, close_backends
+
+
+def build_proxy_app() -> web.Application:
+    app = web.Application()
+    app.cleanup_ctx.append(upstream_pool_ctx)
+    app.router.add_get('/_health', health_check)
+    app.router.add_route("*", "/{tail:.*}", handle_request)
+    return app
+
+
+def test_weighted_selection():
+    """Held streams are spread in proportion to backend weights"""
+    print("Testing weighted least-outstanding selection:")
+    pool = BackendPool()
+    pool.configure([{'url': 'http://a', 'weight': 2}, {'url': 'http://b', 'weight': 1}, 'http://c/'])
+    assert pool.urls() == ['http://a', 'http://b', 'http://c']
+
+    for _ in range(40):
+        pool.acquire(pool.select())
+    outstanding = {backend.url: backend.outstanding for backend in pool.backends}
+    print(f"  Outstanding after 40 held streams: {outstanding}")
+    assert outstanding == {'http://a': 20, 'http://b': 10, 'http://c': 10}
+    print("  ✓ Streams split 2:1:1")
+
+    backend_a = pool.backends[0]
+    for _ in range(20):
+        pool.release(backend_a)
+    assert pool.select() is backend_a
+    print("  ✓ A drained backend is picked first")
+
+    pool.configure([{'url': 'http://a', 'weight': 1}])
+    assert pool.backends == [backend_a] and backend_a.weight == 1 and backend_a.requests == 20
+    print("  ✓ Reconfiguring keeps counters of remaining backends")
+
+
+def test_default_backend_follows_target_host():
+    """Without configured backends the pool holds TARGET_HOST"""
+    print("\nTesting TARGET_HOST fallback:")
+    pool = BackendPool()
+    assert pool.urls() == [call_patch_proxy.TARGET_HOST.rstrip('/')]
+    original_target = call_patch_proxy.TARGET_HOST
+    call_patch_proxy.TARGET_HOST = "http://127.0.0.1:9"
+    try:
+        assert pool.urls() == ["http://127.0.0.1:9"]
+    finally:
+        call_patch_proxy.TARGET_HOST = original_target
+    print("  ✓ Single default backend tracks TARGET_HOST")
+
+
+async def test_streams_balanced_across_backends():
+    """Concurrent long streams land on different backends and are released afterwards"""
+    backends = await start_backends(3, chunks=4, delay=0.05)
+    backend_pool.configure([{'url': backend.url} for backend in backends])
+    client = TestClient(TestServer(build_proxy_app()))
+    await client.start_server()
+
+    try:
+        print("\nTesting concurrent streams across 3 mock backends:")
+
+        async def one_request():
+            resp = await client.post('/v1/chat/completions', json={"model": "test", "stream": True})
+            body = await resp.read()
+            assert resp.status == 200 and b"[DONE]" in body
+            return body
+
+        bodies = await asyncio.gather(*(one_request() for _ in range(6)))
+        served = [sum(f"{backend.name}:0".encode() in body for body in bodies) for backend in backends]
+        print(f"  Requests per backend: {served}, peak concurrency: {[b.max_active for b in backends]}")
+        assert served == [2, 2, 2]
+        assert all(backend.max_active == 2 for backend in backends)
+        print("  ✓ Six concurrent streams split evenly")
+
+        resp = await client.get('/_health')
+        stats = (await resp.json())['backends']
+        assert [entry['url'] for entry in stats] == [backend.url for backend in backends]
+        assert all(entry['outstanding'] == 0 and entry['requests'] == 2 for entry in stats)
+        print("  ✓ /_health reports per-backend stats with streams released")
+
+        # A backend busy with a long stream is avoided by the next requests
+        slow = asyncio.ensure_future(client.post('/v1/chat/completions',
+                                                 json={"model": "test", "mock_chunks": 20}))
+        await asyncio.sleep(0.1)
+        busy = [backend for backend in backends if backend.active]
+        assert len(busy) == 1
+        for _ in range(2):
+            resp = await client.post('/v1/chat/completions', json={"model": "test", "mock_chunks": 1})
+            body = await resp.read()
+            assert f"{busy[0].name}:0".encode() not in body
+        await (await slow).read()
+        print("  ✓ Short requests avoid the backend holding a long stream")
+    finally:
+        await client.close()
+        await close_backends(backends)
+        backend_pool.configure(call_patch_proxy.fix_engine.get_setting('backends'))
+
+
+if __name__ == "__main__":
+    try:
+        test_weighted_selection()
+        test_default_backend_follows_target_host()
+        asyncio.run(test_streams_balanced_across_backends())
+        print("\n🎉 All load balancing tests passed!")
+    except AssertionError as e:
+        print(f"\n💥 Test failed: {e}")
+        sys.exit(1)
@@ -0,0 +1,92 @@
+#!/usr/bin/env python3
+"""
+Test the queued logging pipeline, compressed log rotation and sampled SSE tracing
+"""
+import sys
+import os
+import gzip
+import logging
+import logging.handlers
+import tempfile
+import time
+import uuid
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import call_patch_proxy
+from call_patch_proxy import RequestState, build_file_handler, should_trace_event
+
+
+def test_records_written_off_loop():
+    """Loggers only enqueue, the listener thread writes the file"""
+    print("Testing queued log writes:")
+    for log in (call_patch_proxy.logger, call_patch_proxy.console_logger):
+        assert call_patch_proxy.queue_handler in log.handlers
+        assert call_patch_proxy.console_handler not in log.handlers
+        assert call_patch_proxy.file_handler not in log.handlers
+
+    record = logging.LogRecord("test", logging.INFO, __file__, 0, "lazy %s", ("arg",), None)
+    assert call_patch_proxy.queue_handler.prepare(record) is record and record.args == ("arg",)
+    print("  ✓ Records enqueued unformatted")
+
+    token = uuid.uuid4().hex
+    marker = f"queued-{token}"
+    call_patch_proxy.logger.info("queued-%s", token)
+    deadline = time.monotonic() + 5
+    found = False
+    while time.monotonic() < deadline and not found:
+        call_patch_proxy.file_handler.flush()
+        with open(call_patch_proxy.file_handler.baseFilename, encoding='utf-8') as f:
+            found = marker in f.read()
+        if not found:
+            time.sleep(0.05)
+    assert found, "Record never reached the log file"
+    print("  ✓ Record written by the listener thread")
+
+
+def test_rotation_compresses():
+    """Rotated generations are gzip files"""
+    print("\nTesting compressed rotation:")
+    with tempfile.TemporaryDirectory() as tmp:
+        handler = build_file_handler(os.path.join(tmp, "proxy.log"), max_bytes=200, backup_count=2)
+        handler.setFormatter(logging.Formatter("%(message)s"))
+        for i in range(20):
+            handler.emit(logging.LogRecord("test", logging.INFO, __file__, 0, f"line {i} " + "x" * 40, None, None))
+        handler.close()
+        rotated = sorted(name for name in os.listdir(tmp) if name.endswith(".gz"))
+        assert rotated == ["proxy.log.1.gz", "proxy.log.2.gz"], rotated
+        with gzip.open(os.path.join(tmp, "proxy.log.1.gz"), "rt") as f:
+            assert "line" in f.read()
+        print(f"  ✓ Kept {rotated}")
+
+
+def test_event_sampling():
+    """Sample rate and the per-request override decide per-event tracing"""
+    print("\nTesting sampled SSE tracing:")
+    settings = call_patch_proxy.fix_engine.settings
+    original = settings.get('sse_trace_sample_rate')
+    try:
+        settings['sse_trace_sample_rate'] = 0
+        assert not should_trace_event(RequestState(request_id="a"))
+        assert should_trace_event(RequestState(request_id="b", trace=True))
+        settings['sse_trace_sample_rate'] = 1
+        assert should_trace_event(RequestState(request_id="c"))
+        settings['sse_trace_sample_rate'] = 0.25
+        traced = sum(should_trace_event(RequestState(request_id="d")) for _ in range(4000))
+        assert 700 < traced < 1300, traced
+        print(f"  ✓ 0.25 rate traced {traced}/4000 events, override always traces")
+    finally:
+        if original is None:
+            settings.pop('sse_trace_sample_rate', None)
+        else:
+            settings['sse_trace_sample_rate'] = original
+
+
+if __name__ == "__main__":
+    try:
+        test_records_written_off_loop()
+        test_rotation_compresses()
+        test_event_sampling()
+        print("\n🎉 All logging pipeline tests passed!")
+    except AssertionError as e:
+        print(f"\n💥 Test failed: {e}")
+        sys.exit(1)
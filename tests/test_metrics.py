@@ -0,0 +1,116 @@
+#!/usr/bin/env python3
+"""
+Test the Prometheus-style /_metrics endpoint
+"""
+import sys
+import os
+import asyncio
+import json
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from aiohttp import web
+from aiohttp.test_utils import TestServer, TestClient
+
+import call_patch_proxy
+from call_patch_proxy import Histogram, handle_request, metrics_handler, upstream_pool_ctx
+
+
+def sse(event: dict) -> bytes:
+    return b"data: " + json.dumps(event).encode() + b"\n\n"
+
+
+async def mock_completion(request: web.Request):
+    """Streams some content and a bash call that needs the description fix"""
+    response = web.StreamResponse(headers={"Content-Type": "text/event-stream"})
+    await response.prepare(request)
+    await response.write(sse({"choices": [{"index": 0, "delta": {"content": "Running it"}}]}))
+    for fragment in ('{"command": ', '"ls -la"', '}'):
+        await asyncio.sleep(0.01)
+        await response.write(sse({"choices": [{"index": 0, "delta": {"tool_calls": [
+            {"index": 0, "function": {"arguments": fragment}}]}}]}))
+    await response.write(b"data: [DONE]\n\n")
+    await response.write_eof()
+    return response
+
+
+def parse_metrics(text: str) -> dict:
+    values = {}
+    for line in text.splitlines():
+        if line and not line.startswith("#"):
+            name, value = line.rsplit(" ", 1)
+            values[name] = float(value)
+    return values
+
+
+def test_histogram_buckets():
+    """Buckets are cumulative and +Inf equals the count"""
+    print("Testing histogram rendering:")
+    histogram = Histogram("test_seconds", "Test", (0.1, 1.0))
+    for value in (0.05, 0.1, 0.5, 3.0):
+        histogram.observe(value)
+    values = parse_metrics("\n".join(histogram.render()))
+    assert values['test_seconds_bucket{le="0.1"}'] == 2
+    assert values['test_seconds_bucket{le="1.0"}'] == 3
+    assert values['test_seconds_bucket{le="+Inf"}'] == 4
+    assert values['test_seconds_count'] == 4
+    assert abs(values['test_seconds_sum'] - 3.65) < 1e-9
+    print("  ✓ Cumulative buckets, sum and count")
+
+
+async def test_metrics_endpoint():
+    """A proxied stream shows up in latency histograms, byte counters and fix hits"""
+    backend_app = web.Application()
+    backend_app.router.add_post('/v1/chat/completions', mock_completion)
+    backend = TestServer(backend_app)
+    await backend.start_server()
+
+    original_target = call_patch_proxy.TARGET_HOST
+    call_patch_proxy.TARGET_HOST = str(backend.make_url('')).rstrip('/')
+    app = web.Application()
+    app.cleanup_ctx.append(upstream_pool_ctx)
+    app.router.add_get('/_metrics', metrics_handler)
+    app.router.add_route("*", "/{tail:.*}", handle_request)
+    client = TestClient(TestServer(app))
+    await client.start_server()
+
+    try:
+        print("\nTesting /_metrics after a proxied stream:")
+        before = parse_metrics(call_patch_proxy.proxy_metrics.render())
+        resp = await client.post('/v1/chat/completions', json={"model": "test", "stream": True})
+        body = await resp.read()
+        assert b"Execute the given shell command" in body
+
+        resp = await client.get('/_metrics')
+        assert resp.status == 200
+        assert resp.headers['Content-Type'].startswith('text/plain; version=0.0.4')
+        after = parse_metrics(await resp.text())
+
+        def delta(name):
+            return after.get(name, 0) - before.get(name, 0)
+
+        assert delta('qwen3_proxy_requests_total') == 1
+        assert delta('qwen3_proxy_backend_ttfb_seconds_count') == 1
+        assert delta('qwen3_proxy_client_ttfb_seconds_count') == 1
+        assert delta('qwen3_proxy_sse_event_gap_seconds_count') == 4
+        assert delta('qwen3_proxy_sse_event_processing_seconds_count') >= 5
+        assert delta('qwen3_proxy_tool_call_assembly_seconds_count') == 1
+        assert delta('qwen3_proxy_fix_applied_total{tool="bash",rule="missing_description"}') == 1
+        assert delta('qwen3_proxy_bytes_out_total') == len(body)
+        assert delta('qwen3_proxy_bytes_in_total') > 0
+        print(f"  ✓ {int(delta('qwen3_proxy_bytes_in_total'))} bytes in, {len(body)} bytes out")
+        print(f"  ✓ Gap histogram sum: {delta('qwen3_proxy_sse_event_gap_seconds_sum'):.3f} s")
+        print("  ✓ Fix hit recorded for bash/missing_description")
+    finally:
+        await client.close()
+        await backend.close()
+        call_patch_proxy.TARGET_HOST = original_target
+
+
+if __name__ == "__main__":
+    try:
+        test_histogram_buckets()
+        asyncio.run(test_metrics_endpoint())
+        print("\n🎉 All metrics tests passed!")
+    except AssertionError as e:
+        print(f"\n💥 Test failed: {e}")
+        sys.exit(1)
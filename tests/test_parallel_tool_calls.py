@@ -0,0 +1,114 @@
+#!/usr/bin/env python3
+"""
+Test that parallel tool calls with different indices are buffered and emitted separately
+"""
+import sys
+import os
+import asyncio
+import json
+import uuid
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from call_patch_proxy import process_sse_event, RequestState, request_states
+
+
+def tool_event(*tool_calls, finish_reason=None):
+    return {"choices": [{"index": 0, "delta": {"tool_calls": list(tool_calls)}, "finish_reason": finish_reason}]}
+
+
+def header(index, name):
+    return {"index": index, "id": f"call_{uuid.uuid4().hex[:24]}", "type": "function",
+            "function": {"name": name, "arguments": ""}}
+
+
+def fragment(index, text):
+    return {"index": index, "function": {"arguments": text}}
+
+
+async def run_events(events):
+    """Return the list of (event number, tool call) emitted to the client"""
+    request_id = str(uuid.uuid4())[:8]
+    request_states[request_id] = RequestState(request_id=request_id)
+    emitted = []
+    try:
+        for number, event in enumerate(events):
+            result = await process_sse_event(event, request_id)
+            for tool_call in result["choices"][0]["delta"].get("tool_calls", []):
+                emitted.append((number, tool_call))
+    finally:
+        request_states.pop(request_id, None)
+    return emitted
+
+
+async def test_interleaved_parallel_reads():
+    """Five interleaved read calls are emitted one by one with their own index"""
+    print("Testing interleaved parallel calls:")
+    files = [f"/src/module_{i}.py" for i in range(5)]
+    events = [tool_event(header(i, "read")) for i in range(5)]
+    pieces = [['{"filePath": ', json.dumps(path)[:6], json.dumps(path)[6:], '}'] for path in files]
+    # Call 0 streams faster than the others
+    for step in range(4):
+        for i in range(5):
+            if i == 0 or step < 3:
+                events.append(tool_event(fragment(i, pieces[i][step])))
+    for i in range(1, 5):
+        events.append(tool_event(fragment(i, pieces[i][3])))
+
+    emitted = await run_events(events)
+    assert len(emitted) == 5, emitted
+    first_event, first_call = emitted[0]
+    assert first_call["index"] == 0
+    assert json.loads(first_call["function"]["arguments"])["filePath"] == files[0]
+    assert first_event < emitted[1][0], "First call should be dispatched before the others finish"
+    for number, tool_call in emitted:
+        args = json.loads(tool_call["function"]["arguments"])
+        assert tool_call["function"]["name"] == "read"
+        assert args["filePath"] == files[tool_call["index"]]
+        print(f"  ✓ index {tool_call['index']} emitted at event {number}: {args['filePath']}")
+
+
+async def test_qwen_index_per_fragment_still_consolidated():
+    """Qwen3's single call spread over indices 1, 2, 3 is still one call"""
+    print("\nTesting index-per-fragment consolidation:")
+    emitted = await run_events([
+        tool_event(fragment(1, "{"), fragment(2, '"command": "ls -la"')),
+        tool_event(fragment(3, "}")),
+        tool_event(fragment(4, '{"pattern": "*.py"}')),
+    ])
+    assert len(emitted) == 2, emitted
+    assert emitted[0][1]["function"]["name"] == "bash" and emitted[0][1]["index"] == 0
+    assert emitted[1][1]["function"]["name"] == "glob" and emitted[1][1]["index"] == 1
+    print("  ✓ Fragments consolidated, following call numbered separately")
+
+
+async def test_header_with_partial_arguments():
+    """A header that already carries the first arguments keeps its tool name"""
+    print("\nTesting headers with partial arguments:")
+    first = header(0, "my_custom_tool")
+    first["function"]["arguments"] = '{"x"'
+    second = header(1, "my_other_tool")
+    second["function"]["arguments"] = '{"y": '
+    emitted = await run_events([
+        tool_event(first, second),
+        tool_event(fragment(0, ': 1}')),
+        tool_event(fragment(1, '2}')),
+    ])
+    assert [(call["index"], call["function"]["name"]) for _, call in emitted] == \
+        [(0, "my_custom_tool"), (1, "my_other_tool")], emitted
+    assert json.loads(emitted[0][1]["function"]["arguments"]) == {"x": 1}
+    assert json.loads(emitted[1][1]["function"]["arguments"]) == {"y": 2}
+    print("  ✓ Names the content cannot suggest are kept for both calls")
+
+
+if __name__ == "__main__":
+    async def run_tests():
+        await test_interleaved_parallel_reads()
+        await test_qwen_index_per_fragment_still_consolidated()
+        await test_header_with_partial_arguments()
+
+    try:
+        asyncio.run(run_tests())
+        print("\n🎉 All parallel tool call tests passed!")
+    except AssertionError as e:
+        print(f"\n💥 Test failed: {e}")
+        sys.exit(1)
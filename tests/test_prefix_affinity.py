@@ -0,0 +1,152 @@
+#!/usr/bin/env python3
+"""
+Test prefix-affinity routing on a consistent hash ring with bounded load
+"""
+import sys
+import os
+import asyncio
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from aiohttp import web
+from aiohttp.test_utils import TestServer, TestClient
+
+import call_patch_proxy
+from call_patch_proxy import BackendPool, backend_pool, handle_request, health_check, upstream_pool_ctx
+from mock_backends import start_backends, close_backends
+
+TOOLS = [{"type": "function", "function": {"name": "bash", "parameters": {"type": "object"}}}]
+
+
+def conversation(session: int, turns: int):
+    """Request body of a conversation after `turns` user turns"""
+    messages = [{"role": "system", "content": "You are a coding agent."},
+                {"role": "user", "content": f"Task {session}: fix the build"}]
+    for turn in range(1, turns):
+        messages.append({"role": "assistant", "content": f"step {turn}"})
+        messages.append({"role": "user", "content": f"continue {turn}"})
+    return {"model": "qwen3-coder", "tools": TOOLS, "messages": messages, "stream": True}
+
+
+def with_routing_mode():
+    settings = call_patch_proxy.fix_engine.settings
+    original = settings.get('routing_mode')
+    settings['routing_mode'] = 'prefix_affinity'
+    return original
+
+
+def restore_routing_mode(original):
+    settings = call_patch_proxy.fix_engine.settings
+    if original is None:
+        settings.pop('routing_mode', None)
+    else:
+        settings['routing_mode'] = original
+
+
+def test_affinity_key():
+    """The key covers the stable prefix and ignores the growing history"""
+    print("Testing affinity keys:")
+    original = with_routing_mode()
+    try:
+        pool = BackendPool()
+        key = pool.affinity_key(conversation(1, 1))
+        assert key is not None
+        assert all(pool.affinity_key(conversation(1, turns)) == key for turns in range(2, 6))
+        print("  ✓ Same key on every turn of a conversation")
+
+        assert pool.affinity_key(conversation(2, 1)) != key
+        changed_tools = dict(conversation(1, 3), tools=[])
+        assert pool.affinity_key(changed_tools) != key
+        print("  ✓ Different first message or tools give a different key")
+
+        assert pool.affinity_key({"model": "m", "prompt": "x" * 5000}) == \
+            pool.affinity_key({"model": "m", "prompt": "x" * 4096 + "y" * 100})
+        assert pool.affinity_key({"model": "m"}) is None and pool.affinity_key(None) is None
+        print("  ✓ Completion prompts hash their leading characters; no prompt, no key")
+    finally:
+        restore_routing_mode(original)
+    assert BackendPool().affinity_key(conversation(1, 1)) is None
+    print("  ✓ No key unless routing_mode is prefix_affinity")
+
+
+def test_ring_placement():
+    """Keys spread by weight, stay put when a backend is added, and spill under load"""
+    print("\nTesting consistent hash ring:")
+    original = with_routing_mode()
+    try:
+        pool = BackendPool()
+        pool.configure([{'url': 'http://a', 'weight': 2}, 'http://b', 'http://c'])
+        keys = [pool.affinity_key(conversation(session, 1)) for session in range(2000)]
+        placement = {key: pool.select(affinity_key=key).url for key in keys}
+        shares = {url: list(placement.values()).count(url) / len(keys) for url in pool.urls()}
+        print(f"  Shares: { {url: round(share, 2) for url, share in shares.items()} }")
+        assert 0.4 < shares['http://a'] < 0.6 and 0.15 < shares['http://b'] < 0.35
+        print("  ✓ Keys spread in proportion to weight")
+
+        pool.configure([{'url': 'http://a', 'weight': 2}, 'http://b', 'http://c', 'http://d'])
+        moved = [key for key in keys if pool.select(affinity_key=key).url != placement[key]]
+        assert all(pool.select(affinity_key=key).url == 'http://d' for key in moved)
+        print(f"  ✓ Adding a backend moved {len(moved) / len(keys):.0%} of keys, all to it")
+
+        pool = BackendPool()
+        pool.configure(['http://a', 'http://b', 'http://c'])
+        key = keys[0]
+        home = pool.select(affinity_key=key)
+        held = []
+        for _ in range(12):
+            backend = pool.select(affinity_key=key)
+            pool.acquire(backend)
+            held.append(backend)
+        print(f"  Outstanding with one hot prefix: {[b.outstanding for b in pool.backends]}")
+        assert home.outstanding < 12 and pool.affinity_spilled > 0
+        assert max(b.outstanding for b in pool.backends) <= 1.25 * 12 / 3 + 1
+        print("  ✓ Bounded load spills a hot prefix to the next backends")
+    finally:
+        restore_routing_mode(original)
+
+
+async def test_sessions_stick_to_backends():
+    """Multi-turn conversations through the proxy keep hitting one replica"""
+    original = with_routing_mode()
+    backends = await start_backends(3)
+    backend_pool.configure([backend.url for backend in backends])
+    before = backend_pool.affinity_stats()
+    app = web.Application()
+    app.cleanup_ctx.append(upstream_pool_ctx)
+    app.router.add_get('/_health', health_check)
+    app.router.add_route("*", "/{tail:.*}", handle_request)
+    client = TestClient(TestServer(app))
+    await client.start_server()
+
+    try:
+        print("\nTesting sticky multi-turn sessions through the proxy:")
+        for session in range(6):
+            served = set()
+            for turns in range(1, 5):
+                resp = await client.post('/v1/chat/completions', json=conversation(session, turns))
+                body = await resp.read()
+                served.update(backend.name for backend in backends if f"{backend.name}:0".encode() in body)
+            assert len(served) == 1, f"Session {session} served by {served}"
+        print(f"  ✓ Each of 6 sessions stayed on one backend (hits: {[b.hits for b in backends]})")
+
+        stats = (await (await client.get('/_health')).json())['affinity']
+        repeats = stats['prefix_repeats'] - before['prefix_repeats']
+        hits = stats['prefix_repeat_hits'] - before['prefix_repeat_hits']
+        assert repeats == 18 and hits == 18 and stats['hit_rate'] == 1.0
+        print(f"  ✓ /_health affinity: {repeats} repeated prefixes, {hits} routed to the same backend")
+    finally:
+        await client.close()
+        await close_backends(backends)
+        backend_pool.configure(call_patch_proxy.fix_engine.get_setting('backends'))
+        restore_routing_mode(original)
+
+
+if __name__ == "__main__":
+    try:
+        test_affinity_key()
+        test_ring_placement()
+        asyncio.run(test_sessions_stick_to_backends())
+        print("\n🎉 All prefix affinity tests passed!")
+    except AssertionError as e:
+        print(f"\n💥 Test failed: {e}")
+        sys.exit(1)
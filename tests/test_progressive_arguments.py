@@ -0,0 +1,138 @@
+#!/usr/bin/env python3
+"""
+Test progressive streaming of tool call arguments for append-safe tools
+"""
+import sys
+import os
+import asyncio
+import json
+import logging
+import uuid
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import call_patch_proxy
+from call_patch_proxy import process_sse_event, RequestState, request_states
+
+
+def tool_event(*tool_calls, finish_reason=None):
+    return {"choices": [{"index": 0, "delta": {"tool_calls": list(tool_calls)}, "finish_reason": finish_reason}]}
+
+
+def header(index, name):
+    return {"index": index, "id": f"call_{uuid.uuid4().hex[:24]}", "type": "function",
+            "function": {"name": name, "arguments": ""}}
+
+
+def fragment(index, text):
+    return {"index": index, "function": {"arguments": text}}
+
+
+async def run_events(events, progressive_tools):
+    """Return every tool call delta sent to the client"""
+    request_id = str(uuid.uuid4())[:8]
+    request_states[request_id] = RequestState(request_id=request_id)
+    original = call_patch_proxy.fix_engine.settings.get('progressive_tools')
+    call_patch_proxy.fix_engine.settings['progressive_tools'] = progressive_tools
+    sent = []
+    try:
+        for event in events:
+            result = await process_sse_event(event, request_id)
+            sent.extend(result["choices"][0]["delta"].get("tool_calls", []))
+    finally:
+        call_patch_proxy.fix_engine.settings['progressive_tools'] = original
+        request_states.pop(request_id, None)
+    return sent
+
+
+def joined_arguments(sent):
+    return "".join(tool_call["function"]["arguments"] for tool_call in sent)
+
+
+async def test_write_streams_every_fragment():
+    """A write call is forwarded fragment by fragment behind an early header"""
+    print("Testing progressive write call:")
+    args = json.dumps({"filePath": "/tmp/big.py", "content": "print('x')\n" * 50})
+    pieces = [args[i:i + 40] for i in range(0, len(args), 40)]
+    events = [tool_event(header(0, "write"))] + [tool_event(fragment(0, piece)) for piece in pieces]
+
+    sent = await run_events(events, ["write"])
+    assert len(sent) == len(pieces), f"Expected one delta per fragment, got {len(sent)}"
+    assert sent[0]["id"].startswith("call_") and sent[0]["function"]["name"] == "write"
+    assert all("id" not in tool_call for tool_call in sent[1:])
+    assert all(tool_call["index"] == 0 for tool_call in sent)
+    assert json.loads(joined_arguments(sent)) == json.loads(args)
+    print(f"  ✓ {len(sent)} deltas, header first, arguments intact")
+
+
+async def test_inferred_tool_gets_trailing_defaults():
+    """Defaults for missing parameters are appended before the final brace"""
+    print("\nTesting trailing fixes on an inferred glob call:")
+    sent = await run_events([
+        tool_event(fragment(0, '{"pattern": ')),
+        tool_event(fragment(0, '"**/*.py"')),
+        tool_event(fragment(0, '}')),
+    ], ["glob"])
+    assert sent[0]["function"]["name"] == "glob"
+    assert sent[0]["function"]["arguments"] == '{"pattern": '
+    assert json.loads(joined_arguments(sent)) == {"pattern": "**/*.py", "path": "."}
+    print(f"  ✓ Streamed arguments: {joined_arguments(sent)}")
+
+
+async def test_rewriting_tool_is_buffered():
+    """A tool whose fixes rewrite values stays suppress-until-complete"""
+    print("\nTesting that non append-safe tools are buffered:")
+    sent = await run_events([
+        tool_event(header(0, "edit")),
+        tool_event(fragment(0, '{"filePath": "a.py", "oldString": "a", ')),
+        tool_event(fragment(0, '"newString": "b", "replaceAll": "true"}')),
+    ], ["edit"])
+    assert len(sent) == 1, sent
+    assert json.loads(sent[0]["function"]["arguments"])["replaceAll"] is True
+    print("  ✓ edit emitted once, with replaceAll fixed")
+
+    warnings = []
+    handler = logging.Handler(logging.WARNING)
+    handler.emit = warnings.append
+    call_patch_proxy.logger.addHandler(handler)
+    try:
+        await run_events([tool_event(header(0, "edit"))] +
+                         [tool_event(fragment(0, piece)) for piece in ('{"filePath": ', '"a.py", ', '"x": 1}')], ["edit"])
+    finally:
+        call_patch_proxy.logger.removeHandler(handler)
+    assert len([record for record in warnings if "rewrite arguments" in record.getMessage()]) == 1, warnings
+    print("  ✓ Rewriting fixes reported once, not per fragment")
+
+
+async def test_truncated_call_is_closed():
+    """A streamed call still open at finish_reason gets its closing brace"""
+    print("\nTesting truncated streamed call:")
+    sent = await run_events([
+        tool_event(header(0, "write")),
+        tool_event(fragment(0, '{"filePath": "/tmp/a", ')),
+        tool_event(fragment(0, '"content": "x"'), finish_reason="tool_calls"),
+    ], ["write"])
+    assert json.loads(joined_arguments(sent)) == {"filePath": "/tmp/a", "content": "x"}
+    print(f"  ✓ Closed as: {joined_arguments(sent)}")
+
+    sent = await run_events([
+        tool_event(header(0, "write")),
+        tool_event(fragment(0, '{"filePath": "/tmp/a", "content": "a [b {c\\')),
+        tool_event(fragment(0, '"d'), finish_reason="tool_calls"),
+    ], ["write"])
+    assert json.loads(joined_arguments(sent)) == {"filePath": "/tmp/a", "content": 'a [b {c"d'}
+    print(f"  ✓ Cut off mid-string, closed as: {joined_arguments(sent)}")
+
+
+if __name__ == "__main__":
+    async def run_tests():
+        await test_write_streams_every_fragment()
+        await test_inferred_tool_gets_trailing_defaults()
+        await test_rewriting_tool_is_buffered()
+        await test_truncated_call_is_closed()
+
+    try:
+        asyncio.run(run_tests())
+        print("\n🎉 All progressive argument tests passed!")
+    except AssertionError as e:
+        print(f"\n💥 Test failed: {e}")
+        sys.exit(1)
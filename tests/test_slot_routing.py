@@ -0,0 +1,161 @@
+#!/usr/bin/env python3
+"""
+Test llama.cpp /slots-aware routing and the in-proxy slot queue
+"""
+import sys
+import os
+import asyncio
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from aiohttp import web
+from aiohttp.test_utils import TestServer, TestClient
+
+import call_patch_proxy
+from call_patch_proxy import (BackendPool, backend_pool, backend_health_ctx, handle_request, health_check,
+                              upstream_pool_ctx)
+from mock_backends import MockBackend, close_backends
+
+SETTINGS = {
+    'slot_aware_routing': True,
+    'slots_poll_interval': 0.05,
+    'queue_timeout': 5,
+    'health_check_interval': 0,
+}
+
+
+def override_settings(**overrides):
+    settings = call_patch_proxy.fix_engine.settings
+    values = dict(SETTINGS, **overrides)
+    original = {key: settings.get(key) for key in values}
+    settings.update(values)
+    return original
+
+
+def restore_settings(original):
+    settings = call_patch_proxy.fix_engine.settings
+    for key, value in original.items():
+        if value is None:
+            settings.pop(key, None)
+        else:
+            settings[key] = value
+
+
+def build_proxy_app() -> web.Application:
+    app = web.Application()
+    app.cleanup_ctx.append(upstream_pool_ctx)
+    app.cleanup_ctx.append(backend_health_ctx)
+    app.router.add_get('/_health', health_check)
+    app.router.add_route("*", "/{tail:.*}", handle_request)
+    return app
+
+
+async def test_poll_slots():
+    """Busy slots are read from is_processing; servers without /slots are not limited"""
+    original = override_settings()
+    with_slots = await MockBackend("s", slots=4).start()
+    without_slots = await MockBackend("n").start()
+    pool = BackendPool()
+    pool.configure([with_slots.url, without_slots.url])
+    try:
+        print("Testing /slots polling:")
+        with_slots.external_busy = 3
+        for backend in pool.backends:
+            await pool.poll_slots(backend)
+        limited, unlimited = pool.backends
+        assert (limited.slots_total, limited.slots_busy) == (4, 3) and limited.has_free_slot()
+        assert unlimited.slots_total is None and unlimited.has_free_slot()
+        print("  ✓ 3/4 slots busy; backend without /slots is unlimited")
+
+        pool.acquire(limited)
+        assert not limited.has_free_slot()
+        assert pool.select() is unlimited
+        pool.release(limited)
+        assert limited.has_free_slot()
+        print("  ✓ Dispatches between polls count against free slots")
+    finally:
+        await call_patch_proxy.upstream_pool.close()
+        await close_backends([with_slots, without_slots])
+        restore_settings(original)
+
+
+async def test_requests_queue_in_proxy():
+    """A saturated replica is avoided, and excess requests wait in the proxy, not the server"""
+    original = override_settings()
+    saturated = await MockBackend("busy", slots=2, delay=0.02).start()
+    idle = await MockBackend("idle", slots=2, delay=0.02).start()
+    saturated.external_busy = 2
+    backend_pool.configure([saturated.url, idle.url])
+    client = TestClient(TestServer(build_proxy_app()))
+    await client.start_server()
+
+    try:
+        print("\nTesting slot-aware routing with queueing:")
+        await asyncio.sleep(0.15)
+
+        async def one_request():
+            resp = await client.post('/v1/chat/completions', json={"model": "test", "mock_chunks": 5})
+            body = await resp.read()
+            assert resp.status == 200 and b"[DONE]" in body
+
+        requests = asyncio.gather(*(one_request() for _ in range(6)))
+        await asyncio.sleep(0.03)
+        stats = (await (await client.get('/_health')).json())['queue']
+        print(f"  Queue while slots are busy: {stats['waiting']}")
+        assert stats['waiting']['interactive'] > 0
+        await requests
+
+        print(f"  Hits: busy={saturated.hits} idle={idle.hits}, idle peak active={idle.max_active}, "
+              f"idle peak queued inside server={idle.max_waiting}")
+        assert saturated.hits == 0 and idle.hits == 6
+        assert idle.max_active == 2 and idle.max_waiting == 0
+        print("  ✓ Requests went to the idle replica and queued in the proxy")
+    finally:
+        await client.close()
+        await close_backends([saturated, idle])
+        backend_pool.configure(call_patch_proxy.fix_engine.get_setting('backends'))
+        restore_settings(original)
+
+
+async def test_queue_timeout():
+    """Requests give up with 503 when no slot frees in time"""
+    original = override_settings(queue_timeout=0.2)
+    full = await MockBackend("full", slots=1).start()
+    full.external_busy = 1
+    backend_pool.configure([full.url])
+    before = backend_pool.queue_timeouts['interactive']
+    client = TestClient(TestServer(build_proxy_app()))
+    await client.start_server()
+
+    try:
+        print("\nTesting slot queue timeout:")
+        await asyncio.sleep(0.15)
+        resp = await client.post('/v1/chat/completions', json={"model": "test"})
+        assert resp.status == 503 and resp.headers.get('Retry-After') == '1'
+        assert backend_pool.queue_timeouts['interactive'] - before == 1 and full.hits == 0
+        print("  ✓ 503 with Retry-After after queue_timeout")
+
+        full.external_busy = 0
+        await asyncio.sleep(0.15)
+        resp = await client.post('/v1/chat/completions', json={"model": "test"})
+        assert resp.status == 200 and full.hits == 1
+        print("  ✓ Served once the slot frees")
+    finally:
+        await client.close()
+        await close_backends([full])
+        backend_pool.configure(call_patch_proxy.fix_engine.get_setting('backends'))
+        restore_settings(original)
+
+
+if __name__ == "__main__":
+    async def run_tests():
+        await test_poll_slots()
+        await test_requests_queue_in_proxy()
+        await test_queue_timeout()
+
+    try:
+        asyncio.run(run_tests())
+        print("\n🎉 All slot routing tests passed!")
+    except AssertionError as e:
+        print(f"\n💥 Test failed: {e}")
+        sys.exit(1)
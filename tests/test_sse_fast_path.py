@@ -0,0 +1,81 @@
+#!/usr/bin/env python3
+"""
+Test the raw-bytes pass-through fast path for SSE events that need no rewriting
+"""
+import sys
+import os
+import asyncio
+import uuid
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from call_patch_proxy import (
+    RequestState, request_states, forward_sse_line, sse_line_needs_processing
+)
+
+
+class RecordingResponse:
+    """Stand-in for web.StreamResponse that records written bytes"""
+
+    def __init__(self):
+        self.writes = []
+
+    async def write(self, data: bytes):
+        self.writes.append(bytes(data))
+
+
+def test_pre_scan():
+    """Only events that may need rewriting are sent to the slow path"""
+    print("Testing SSE pre-scan:")
+    request_id = str(uuid.uuid4())[:8]
+    request_states[request_id] = RequestState(request_id=request_id)
+    try:
+        cases = [
+            (b'data: {"choices":[{"index":0,"delta":{"content":"Hello"},"finish_reason":null}]}\n', False),
+            (b'data: {"choices": [{"index": 0, "delta": {"content": "Hi"}, "finish_reason": null}]}\n', False),
+            (b'data: {"choices":[{"index":0,"delta":{"role":"assistant"}}]}\n', False),
+            (b'data: {"choices":[{"index":0,"delta":{"content":"a < b"},"finish_reason":null}]}\n', True),
+            (b'data: {"choices":[{"index":0,"delta":{"content":"\\u003cfunction="}}]}\n', True),
+            (b'data: {"choices":[{"index":0,"delta":{"tool_calls":[]}}]}\n', True),
+            (b'data: {"choices":[{"index":0,"delta":{},"finish_reason": "stop"}]}\n', True),
+            (b'data: [DONE]\n', True),
+        ]
+        for raw_line, expected in cases:
+            assert sse_line_needs_processing(raw_line, request_id) == expected, raw_line
+            print(f"  ✓ {raw_line[:60]!r} -> {expected}")
+
+        # Mid tool call, even plain content has to go through the lexer
+        request_states[request_id].xml_lexer.feed("<function=bash>")
+        assert sse_line_needs_processing(cases[0][0], request_id)
+        print("  ✓ Plain content is processed while an XML tool call is open")
+    finally:
+        request_states.pop(request_id, None)
+
+
+async def test_untouched_events_are_forwarded_verbatim():
+    """Fast-path events keep their exact original bytes"""
+    print("\nTesting verbatim forwarding:")
+    request_id = str(uuid.uuid4())[:8]
+    request_states[request_id] = RequestState(request_id=request_id)
+    response = RecordingResponse()
+    raw_line = b'data: {"id":"x","choices":[{"index":0,"delta":{"content":"caf\xc3\xa9"},"finish_reason":null}]}\n'
+    try:
+        assert await forward_sse_line(raw_line, request_id, response)
+        assert response.writes == [raw_line]
+        print("  ✓ Raw bytes written unchanged")
+
+        assert await forward_sse_line(b'data: {"choices":[{"index":0,"delta":{"content":"x <y"}}]}\n',
+                                      request_id, response)
+        assert response.writes[-1].startswith(b"data: ") and response.writes[-1].endswith(b"\n\n")
+        print("  ✓ Events with possible tags still go through processing")
+    finally:
+        request_states.pop(request_id, None)
+
+
+if __name__ == "__main__":
+    try:
+        test_pre_scan()
+        asyncio.run(test_untouched_events_are_forwarded_verbatim())
+        print("\n🎉 All SSE fast path tests passed!")
+    except AssertionError as e:
+        print(f"\n💥 Test failed: {e}")
+        sys.exit(1)
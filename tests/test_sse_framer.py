@@ -0,0 +1,108 @@
+#!/usr/bin/env python3
+"""
+Test framing the upstream body into server-sent events
+"""
+import sys
+import os
+import asyncio
+import json
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from aiohttp import web
+from aiohttp.test_utils import TestServer, TestClient
+
+import call_patch_proxy
+from call_patch_proxy import SSEFramer, backend_pool, handle_request, sse_data, upstream_pool_ctx
+
+CONTENT = b'data: {"choices":[{"index":0,"delta":{"content":"Hi"}}]}\n\n'
+MULTI_LINE = b'data: {"choices":[{"index":0,\r\ndata:  "delta":{"content":"there"}}]}\r\n\r\n'
+STREAM = (b": keep-alive\r\n\r\n" + CONTENT + b"event: message\nid: 7\nretry: 3000\n" + CONTENT +
+          MULTI_LINE + b": note\ndata: [DONE]\r\r")
+
+
+def frame(body: bytes, step: int):
+    framer = SSEFramer()
+    events = []
+    for i in range(0, len(body), step):
+        events += framer.feed(body[i:i + step])
+    return events + framer.close()
+
+
+def test_framing():
+    """Events come out the same whatever the read boundaries"""
+    print("Testing SSE framing:")
+    expected = None
+    for step in (len(STREAM), 64, 7, 1):
+        events = [(event.line, event.has_data, event.fields) for event in frame(STREAM, step)]
+        expected = expected or events
+        assert events == expected, step
+    print("  ✓ Same events from one read and from reads of 64, 7 and 1 bytes")
+
+    (comment, *_), (plain, *_), (named, _, fields), (multi, *_), (done, *_) = expected
+    assert comment == b": keep-alive\r\n\r\n" and not expected[0][1]
+    print("  ✓ Comment keep-alive passed through as it arrived")
+    assert plain == CONTENT and named == CONTENT
+    assert fields == b"event: message\nid: 7\nretry: 3000\n"
+    print("  ✓ Single data line kept byte-for-byte; event, id and retry fields kept")
+    assert multi == b'data: {"choices":[{"index":0,\ndata:  "delta":{"content":"there"}}]}\n\n'
+    assert json.loads(sse_data(multi))["choices"][0]["delta"]["content"] == "there"
+    assert done == b"data: [DONE]\n\n" and len(expected) == 5
+    print("  ✓ Multi-line data joined; CRLF and lone CR endings normalized")
+
+    events = frame(b"data: partial", 4)
+    assert [event.line for event in events] == [b"data: partial\n\n"]
+    assert [event.has_data for event in frame(b"data:\n\nretry: 10\n\n", 3)] == [False, False]
+    print("  ✓ Unterminated last event kept; events without data not dispatched as data")
+
+
+async def sse_backend(request: web.Request):
+    response = web.StreamResponse(headers={'Content-Type': 'text/event-stream'})
+    await response.prepare(request)
+    for piece in (STREAM[:30], STREAM[30:95], STREAM[95:]):
+        await response.write(piece)
+        await asyncio.sleep(0.01)
+    return response
+
+
+async def test_through_proxy():
+    """CRLF framing, comments, fields and multi-line data survive the proxy"""
+    print("\nTesting SSE framing through the proxy:")
+    backend_app = web.Application()
+    backend_app.router.add_post('/v1/chat/completions', sse_backend)
+    backend = TestServer(backend_app)
+    await backend.start_server()
+    backend_pool.configure([str(backend.make_url('')).rstrip('/')])
+    app = web.Application()
+    app.cleanup_ctx.append(upstream_pool_ctx)
+    app.router.add_route("*", "/{tail:.*}", handle_request)
+    client = TestClient(TestServer(app))
+    await client.start_server()
+    try:
+        resp = await client.post('/v1/chat/completions', json={"model": "test", "stream": True})
+        body = await resp.read()
+        events = [event for event in body.replace(b"\r\n", b"\n").split(b"\n\n") if event.strip()]
+        assert events[0] == b": keep-alive"
+        assert events[2].startswith(b"event: message\nid: 7\nretry: 3000\ndata: ")
+        contents = []
+        for event in events:
+            data = b"\n".join(line[len(b"data: "):] for line in event.split(b"\n") if line.startswith(b"data: "))
+            if data.startswith(b"{"):
+                contents.append(json.loads(data)["choices"][0]["delta"]["content"])
+        assert contents == ["Hi", "Hi", "there"], contents
+        assert body.endswith(b"data: [DONE]\n\n")
+        print(f"  ✓ {len(events)} events delivered, content {contents}")
+    finally:
+        await client.close()
+        await backend.close()
+        backend_pool.configure(call_patch_proxy.fix_engine.get_setting('backends'))
+
+
+if __name__ == "__main__":
+    try:
+        test_framing()
+        asyncio.run(test_through_proxy())
+        print("\n🎉 All SSE framer tests passed!")
+    except AssertionError as e:
+        print(f"\n💥 Test failed: {e}")
+        sys.exit(1)
@@ -0,0 +1,254 @@
+#!/usr/bin/env python3
+"""
+Test continuing a stream on another backend after a mid-stream failure
+"""
+import sys
+import os
+import asyncio
+import json
+import aiohttp
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from aiohttp import web
+from aiohttp.test_utils import TestServer, TestClient
+
+import call_patch_proxy
+from call_patch_proxy import RequestState, StreamTranscript, backend_pool, build_continuation_body, \
+    handle_request, prepare_continuation, process_sse_event, proxy_metrics, request_states, upstream_pool_ctx
+from mock_backends import MockBackend, close_backends
+
+SETTINGS = {
+    'stream_continuation': True,
+    'continuation_attempts': 2,
+    'continuation_retry_delay': 0.05,
+}
+
+MESSAGES = [{"role": "user", "content": "write a long answer"}]
+
+
+def override_settings(**overrides):
+    settings = call_patch_proxy.fix_engine.settings
+    values = dict(SETTINGS, **overrides)
+    original = {key: settings.get(key) for key in values}
+    settings.update(values)
+    return original
+
+
+def restore_settings(original):
+    settings = call_patch_proxy.fix_engine.settings
+    for key, value in original.items():
+        if value is None:
+            settings.pop(key, None)
+        else:
+            settings[key] = value
+
+
+def sse(delta: dict, finish_reason=None) -> bytes:
+    event = {"choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}]}
+    return f"data: {json.dumps(event)}\n\n".encode()
+
+
+def parse_stream(body: bytes):
+    """Content and tool calls as a client would assemble them"""
+    content, calls = [], {}
+    for line in body.split(b"\n"):
+        if not line.startswith(b"data:") or line.strip() == b"data: [DONE]":
+            continue
+        delta = json.loads(line[5:])["choices"][0].get("delta", {})
+        content.append(delta.get("content") or "")
+        for tool in delta.get("tool_calls") or ():
+            calls.setdefault(tool["index"], []).append(tool)
+    return "".join(content), calls
+
+
+def test_transcript():
+    """Content, reasoning and completed tool calls become the assistant prefix"""
+    print("Testing stream transcript:")
+    transcript = StreamTranscript()
+    transcript.record(sse({"role": "assistant", "reasoning_content": "think "}))
+    transcript.record(sse({"content": "Hello "}))
+    transcript.record(sse({"tool_calls": [{"index": 0, "id": "call_a", "function": {"name": "read", "arguments": ""}}]}))
+    transcript.record(sse({"tool_calls": [{"index": 0, "function": {"arguments": '{"path": "a"}'}}]}))
+    transcript.record(sse({"tool_calls": [{"index": 1, "id": "call_b", "function": {"name": "bash", "arguments": '{"comm'}}]}))
+    transcript.absorb()
+    message = transcript.assistant_message()
+    assert message["content"] == "Hello " and message["reasoning_content"] == "think "
+    assert [call["id"] for call in message["tool_calls"]] == ["call_a"]
+    assert not transcript.finished and transcript.lines == []
+    print("  ✓ Unfinished tool call left out of the prefix")
+
+    transcript.record(sse({"content": "world"}, finish_reason="stop"))
+    transcript.absorb()
+    assert transcript.finished and transcript.assistant_message()["content"] == "Hello world"
+    print("  ✓ Segments accumulate; finish_reason marks the generation finished")
+
+    original = override_settings()
+    try:
+        prefilled = {"model": "m", "stream": True,
+                     "messages": MESSAGES + [{"role": "assistant", "content": "Sure: "}]}
+        continued = json.loads(build_continuation_body(prefilled, {"role": "assistant", "content": "one"}))
+        assert continued["messages"][-1] == {"role": "assistant", "content": "Sure: one"}
+        assert len(continued["messages"]) == 2
+        assert continued["continue_final_message"] is True and continued["add_generation_prompt"] is False
+        print("  ✓ Client prefill extended; continuation parameters merged")
+    finally:
+        restore_settings(original)
+
+
+async def run_proxy(backends, body: dict, **overrides):
+    original = override_settings(**overrides)
+    # The heavier weight makes the first backend the first choice
+    backend_pool.configure([{'url': backends[0].url, 'weight': 10}] + [backend.url for backend in backends[1:]])
+    app = web.Application()
+    app.cleanup_ctx.append(upstream_pool_ctx)
+    app.router.add_route("*", "/{tail:.*}", handle_request)
+    client = TestClient(TestServer(app))
+    await client.start_server()
+    try:
+        resp = await client.post('/v1/chat/completions', json=body)
+        return resp.status, await resp.read()
+    finally:
+        await client.close()
+        backend_pool.configure(call_patch_proxy.fix_engine.get_setting('backends'))
+        restore_settings(original)
+
+
+async def test_content_continued():
+    """The client gets one unbroken generation across the failed and the healthy backend"""
+    print("\nTesting continuation of a content stream:")
+    failing = await MockBackend("b0", chunks=6, fail_after=3).start()
+    healthy = await MockBackend("b1", chunks=6).start()
+    continued = proxy_metrics.stream_continuations
+    try:
+        body = {"model": "test", "stream": True, "messages": MESSAGES}
+        status, raw = await run_proxy([failing, healthy], body)
+        content, _ = parse_stream(raw)
+        print(f"  Client content: {content!r}")
+        assert status == 200 and raw.rstrip().endswith(b"data: [DONE]")
+        assert content == "b0:0 b0:1 b0:2 b1:3 b1:4 b1:5 "
+        assert raw.count(b'"role"') == 0
+        prefix = healthy.bodies[0]["messages"][-1]
+        assert prefix == {"role": "assistant", "content": "b0:0 b0:1 b0:2 "}
+        assert proxy_metrics.stream_continuations - continued == 1
+        assert all(backend.outstanding == 0 for backend in backend_pool.backends)
+        print("  ✓ Continuation spliced after the emitted prefix")
+    finally:
+        await close_backends([failing, healthy])
+
+
+async def test_single_backend_retried():
+    """With one replica, the same backend is retried after the delay"""
+    print("\nTesting continuation on the same backend:")
+    backend = await MockBackend("b0", chunks=5, fail_after=2).start()
+    try:
+        body = {"model": "test", "stream": True, "messages": MESSAGES}
+        # The breaker would open after one failure and hide the only replica
+        status, raw = await run_proxy([backend], body, breaker_failure_threshold=5)
+        content, _ = parse_stream(raw)
+        assert status == 200 and content == "b0:0 b0:1 b0:2 b0:3 b0:4 ", content
+        # The backend keeps failing after two events, so it took two continuations
+        assert backend.failed == 2 and len(backend.bodies) == 3
+        print("  ✓ Same backend continued the generation, twice")
+    finally:
+        await close_backends([backend])
+
+
+async def test_tool_call_regenerated():
+    """A tool call cut off mid-arguments is regenerated, and the client sees it once"""
+    print("\nTesting continuation inside a tool call:")
+    tool_call = {"name": "read", "arguments": '{"filePath": "/tmp/a.txt"}'}
+    failing = await MockBackend("b0", chunks=2, fail_after=4, tool_call=tool_call).start()
+    healthy = await MockBackend("b1", chunks=2, tool_call=tool_call).start()
+    try:
+        body = {"model": "test", "stream": True, "messages": MESSAGES}
+        status, raw = await run_proxy([failing, healthy], body)
+        content, calls = parse_stream(raw)
+        assert status == 200 and content == "b0:0 b0:1 "
+        assert list(calls) == [0] and len(calls[0]) == 1
+        assert json.loads(calls[0][0]["function"]["arguments"]) == {"filePath": "/tmp/a.txt"}
+        assert "tool_calls" not in healthy.bodies[0]["messages"][-1]
+        print("  ✓ Unfinished call dropped and emitted once from the continuation")
+    finally:
+        await close_backends([failing, healthy])
+
+
+async def test_whole_call_keeps_its_index():
+    """A call that arrived complete in one event is not renumbered by the continuation"""
+    print("\nTesting continuation after a call sent whole:")
+    request_id = "continue-index"
+    request_state = request_states[request_id] = RequestState(request_id=request_id)
+    request_state.transcript = StreamTranscript()
+    whole_call = {"index": 0, "id": "call_a", "type": "function",
+                  "function": {"name": "read", "arguments": '{"filePath": "/a"}'}}
+    try:
+        await process_sse_event(json.loads(sse({"tool_calls": [dict(whole_call)]})[6:]), request_id)
+        assert request_state.next_tool_index == 1
+        prepare_continuation(request_state, request_id)
+        event = await process_sse_event(json.loads(sse({"tool_calls": [dict(whole_call, id="call_b")]})[6:]),
+                                        request_id)
+        assert [tool["index"] for tool in event["choices"][0]["delta"]["tool_calls"]] == [1]
+        print("  ✓ Continuation numbers its first call after the one already sent")
+    finally:
+        request_states.pop(request_id, None)
+
+
+class StalledBackend(MockBackend):
+    """Streams some content and half a tool call, then goes silent"""
+
+    async def completion(self, request: web.Request):
+        response = web.StreamResponse(headers={"Content-Type": "text/event-stream"})
+        await response.prepare(request)
+        await response.write(sse({"content": "Reading "}))
+        await response.write(sse({"tool_calls": [{"index": 0, "id": "call_a", "type": "function",
+                                                  "function": {"name": "read", "arguments": ""}}]}))
+        await response.write(sse({"tool_calls": [{"index": 0, "function": {"arguments": '{"filePath": "/a"'}}]}))
+        await asyncio.sleep(5)
+        return response
+
+
+async def test_stream_ended_cleanly():
+    """Without continuation, a backend failing mid-stream still ends the client's stream cleanly"""
+    print("\nTesting a clean end after a mid-stream failure:")
+    # Dropped after the third argument fragment, '{"filePath": "/tmp/abc.txt"'
+    tool_call = {"name": "read", "arguments": '{"filePath": "/tmp/abc.txt"}'}
+    failing = await MockBackend("b0", chunks=2, delay=0.02, fail_after=6, tool_call=tool_call).start()
+    try:
+        body = {"model": "test", "stream": True, "messages": MESSAGES}
+        status, raw = await run_proxy([failing], body, stream_continuation=False)
+        content, calls = parse_stream(raw)
+        assert status == 200 and content == "b0:0 b0:1 "
+        assert json.loads(calls[0][-1]["function"]["arguments"]) == {"filePath": "/tmp/abc.txt"}
+        print("  ✓ Dropped connection: unfinished call completed, stream closed")
+    finally:
+        await close_backends([failing])
+
+    stalled = await StalledBackend("b0").start()
+    request_timeout = backend_pool.request_timeout
+    backend_pool.request_timeout = lambda: aiohttp.ClientTimeout(total=300, sock_read=0.2)
+    try:
+        status, raw = await run_proxy([stalled], body, stream_continuation=False)
+        content, calls = parse_stream(raw)
+        assert status == 200 and content == "Reading "
+        assert json.loads(calls[0][-1]["function"]["arguments"]) == {"filePath": "/a"}
+        print("  ✓ Read timeout: held call sent, stream closed instead of reset")
+    finally:
+        backend_pool.request_timeout = request_timeout
+        await close_backends([stalled])
+
+
+if __name__ == "__main__":
+    async def run_tests():
+        await test_content_continued()
+        await test_single_backend_retried()
+        await test_tool_call_regenerated()
+        await test_whole_call_keeps_its_index()
+        await test_stream_ended_cleanly()
+
+    try:
+        test_transcript()
+        asyncio.run(run_tests())
+        print("\n🎉 All stream continuation tests passed!")
+    except AssertionError as e:
+        print(f"\n💥 Test failed: {e}")
+        sys.exit(1)
@@ -0,0 +1,68 @@
+#!/usr/bin/env python3
+"""
+Test the compact per-stream state objects
+"""
+import sys
+import os
+import random
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from call_patch_proxy import RequestState, ToolBuffer
+
+
+def test_incremental_sizes():
+    """Character and byte counts follow the fragments without re-encoding"""
+    print("Testing incremental buffer sizes:")
+    rng = random.Random(3)
+    alphabet = 'abc {}"\\:é漢🙂'
+    buffer = ToolBuffer(call_id="sizes")
+    expected = ""
+    for _ in range(300):
+        fragment = ''.join(rng.choice(alphabet) for _ in range(rng.randint(0, 6)))
+        buffer.update_content(fragment)
+        expected += fragment
+        assert buffer.length == len(expected)
+        assert buffer.size() == len(expected.encode('utf-8'))
+    assert buffer.content == expected
+    print(f"  ✓ {buffer.length} chars / {buffer.size()} bytes tracked incrementally")
+
+
+def test_tail_matches_slicing():
+    """tail(start) equals content[start:] for every offset"""
+    print("\nTesting tail():")
+    buffer = ToolBuffer(call_id="tail", content='{"a": ')
+    for fragment in ('"x', 'yz"', '', ', "b": [1, ', '2]}'):
+        buffer.update_content(fragment)
+    content = buffer.content
+    buffer.update_content(" ")
+    content += " "
+    for start in range(len(content) + 2):
+        assert buffer.tail(start) == content[start:], start
+    print("  ✓ tail() agrees with slicing at every offset")
+
+
+def test_state_is_slotted():
+    """State objects carry no per-instance __dict__ and use monotonic clocks"""
+    print("\nTesting slotted state:")
+    state = RequestState(request_id="slots")
+    buffer = state.add_buffer("b", ToolBuffer(call_id="b", tool_name="bash"))
+    for obj in (state, buffer):
+        assert not hasattr(obj, '__dict__'), type(obj).__name__
+        assert isinstance(obj.created_at, float) and isinstance(obj.last_activity, float)
+    try:
+        buffer.unexpected = 1
+        assert False, "Slotted buffer accepted an unknown attribute"
+    except AttributeError:
+        pass
+    print("  ✓ RequestState and ToolBuffer are slotted")
+
+
+if __name__ == "__main__":
+    try:
+        test_incremental_sizes()
+        test_tail_matches_slicing()
+        test_state_is_slotted()
+        print("\n🎉 All stream state tests passed!")
+    except AssertionError as e:
+        print(f"\n💥 Test failed: {e}")
+        sys.exit(1)
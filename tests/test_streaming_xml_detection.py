@@ -122,7 +122,7 @@ async def test_streaming_xml_detection():
         # Check final buffer state
         state = request_states.get(request_id)
         if state:
-            print(f"Final content buffer: {state.content_buffer[:100]}...")
+            print(f"Final XML lexer buffer: {state.xml_lexer.held_size()} chars held")
         
         return False
 
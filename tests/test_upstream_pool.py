@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+"""
+Test that proxied requests share one upstream connection pool
+"""
+import sys
+import os
+import asyncio
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from aiohttp import web
+from aiohttp.test_utils import TestServer, TestClient
+
+import call_patch_proxy
+from call_patch_proxy import handle_request, health_check, upstream_pool_ctx
+
+
+async def mock_completion(request: web.Request):
+    """Minimal OpenAI-compatible streaming backend"""
+    response = web.StreamResponse(headers={"Content-Type": "text/event-stream"})
+    await response.prepare(request)
+    await response.write(b'data: {"choices": [{"delta": {"content": "hi"}, "index": 0}]}\n\n')
+    await response.write(b"data: [DONE]\n\n")
+    await response.write_eof()
+    return response
+
+
+async def mock_health(request: web.Request):
+    return web.json_response({"status": "ok"})
+
+
+def build_proxy_app() -> web.Application:
+    app = web.Application()
+    app.cleanup_ctx.append(upstream_pool_ctx)
+    app.router.add_get('/_health', health_check)
+    app.router.add_route("*", "/{tail:.*}", handle_request)
+    return app
+
+
+async def test_connections_are_reused():
+    """Sequential requests should reuse the keep-alive connection to the backend"""
+    backend_app = web.Application()
+    backend_app.router.add_post('/v1/chat/completions', mock_completion)
+    backend_app.router.add_get('/health', mock_health)
+    backend = TestServer(backend_app)
+    await backend.start_server()
+
+    original_target = call_patch_proxy.TARGET_HOST
+    call_patch_proxy.TARGET_HOST = str(backend.make_url('')).rstrip('/')
+    client = TestClient(TestServer(build_proxy_app()))
+    await client.start_server()
+
+    try:
+        print("Testing upstream connection reuse:")
+        before = call_patch_proxy.upstream_pool.stats()
+        for i in range(3):
+            resp = await client.post('/v1/chat/completions', json={"model": "test", "stream": True})
+            body = await resp.read()
+            assert resp.status == 200
+            assert b"[DONE]" in body
+            print(f"  ✓ Request {i + 1} proxied ({len(body)} bytes)")
+
+        resp = await client.get('/_health')
+        stats = (await resp.json())['upstream_pool']
+        print(f"  Pool stats: {stats}")
+        assert stats['misses'] - before['misses'] == 1, "Only the first request should open a new connection"
+        assert stats['hits'] - before['hits'] == 2, "Following requests should reuse the pooled connection"
+        print("  ✓ Connection reused across requests")
+    finally:
+        await client.close()
+        await backend.close()
+        call_patch_proxy.TARGET_HOST = original_target
+
+
+async def test_warm_up_preconnects():
+    """Warm pre-connects should populate the pool before the first request"""
+    backend_app = web.Application()
+    backend_app.router.add_get('/health', mock_health)
+    backend = TestServer(backend_app)
+    await backend.start_server()
+
+    pool = call_patch_proxy.UpstreamPool()
+    try:
+        print("\nTesting warm pre-connects:")
+        await pool.warm_up(str(backend.make_url('')).rstrip('/'), 3, '/health')
+        stats = pool.stats()
+        print(f"  Pool stats: {stats}")
+        assert stats['warmed'] == 3
+        assert stats['misses'] == 3
+        print("  ✓ Warm-up opened 3 connections")
+    finally:
+        await pool.close()
+        await backend.close()
+
+
+if __name__ == "__main__":
+    async def run_tests():
+        await test_connections_are_reused()
+        await test_warm_up_preconnects()
+
+    try:
+        asyncio.run(run_tests())
+        print("\n🎉 All upstream pool tests passed!")
+    except Exception as e:
+        print(f"\n💥 Test failed: {e}")
+        sys.exit(1)
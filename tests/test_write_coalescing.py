@@ -0,0 +1,174 @@
+#!/usr/bin/env python3
+"""
+Test coalescing the events of one upstream read into one client write
+"""
+import sys
+import os
+import asyncio
+import json
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from aiohttp import web
+from aiohttp.client_exceptions import ClientConnectionResetError
+from aiohttp.test_utils import TestServer, TestClient
+
+import call_patch_proxy
+from call_patch_proxy import ClientWriter, backend_pool, handle_request, proxy_metrics, upstream_pool_ctx
+
+SETTINGS = {
+    'write_coalescing': True,
+    'write_coalesce_window': 0,
+    'write_flush_deadline': 0.01,
+}
+
+
+def override_settings(**overrides):
+    settings = call_patch_proxy.fix_engine.settings
+    values = dict(SETTINGS, **overrides)
+    original = {key: settings.get(key) for key in values}
+    settings.update(values)
+    return original
+
+
+def restore_settings(original):
+    settings = call_patch_proxy.fix_engine.settings
+    for key, value in original.items():
+        if value is None:
+            settings.pop(key, None)
+        else:
+            settings[key] = value
+
+
+def sse(delta: dict, finish_reason=None) -> bytes:
+    event = {"choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}]}
+    return f"data: {json.dumps(event)}\n\n".encode()
+
+
+class RecordingResponse:
+    """Stand-in for web.StreamResponse that records written bytes"""
+
+    def __init__(self):
+        self.writes = []
+
+    async def write(self, data: bytes):
+        self.writes.append(bytes(data))
+
+
+class ResetResponse:
+    """Stand-in for the response of a client that went away"""
+
+    async def write(self, data: bytes):
+        raise ClientConnectionResetError("Cannot write to closing transport")
+
+
+async def test_writer():
+    """One write per batch; urgent events and the deadline flush early"""
+    print("Testing client writer:")
+    original = override_settings()
+    try:
+        response = RecordingResponse()
+        writer = ClientWriter(response, "test")
+        for i in range(3):
+            await writer.write(sse({"content": f"t{i}"}))
+        assert response.writes == []
+        assert await writer.end_batch()
+        assert len(response.writes) == 1 and response.writes[0].count(b"data:") == 3
+        print("  ✓ Three events from one read sent as one write")
+
+        await writer.write(sse({"content": "a"}))
+        await writer.write(sse({"tool_calls": [{"index": 0, "id": "call_1", "function":
+                                                {"name": "bash", "arguments": "{}"}}]}))
+        assert len(response.writes) == 2 and response.writes[1].count(b"data:") == 2
+        await writer.write(sse({}, finish_reason="stop"))
+        await writer.write(b"data: [DONE]\n\n")
+        assert len(response.writes) == 4
+        print("  ✓ Tool call, finish_reason and [DONE] written at once with what preceded them")
+
+        call_patch_proxy.fix_engine.settings.update({'write_coalesce_window': 0.5, 'write_flush_deadline': 0.05})
+        writer = ClientWriter(response, "test")
+        await writer.write(sse({"content": "late"}))
+        assert await writer.end_batch() and len(response.writes) == 4
+        await asyncio.sleep(0.1)
+        assert len(response.writes) == 5 and b"late" in response.writes[4]
+        print("  ✓ Output waiting for the next read is written by the flush deadline")
+
+        writer = ClientWriter(ResetResponse(), "test")
+        await writer.write(sse({"content": "lost"}))
+        assert await writer.end_batch()
+        await asyncio.sleep(0.1)
+        assert not await writer.end_batch()
+        try:
+            await writer.write(sse({"content": "more"}))
+            raise AssertionError("Write after a failed timer flush should raise")
+        except ClientConnectionResetError:
+            pass
+        print("  ✓ Client reset seen by a timer flush stops the stream at its next write")
+
+        call_patch_proxy.fix_engine.settings['write_coalescing'] = False
+        writer = ClientWriter(response, "test")
+        await writer.write(sse({"content": "x"}))
+        assert len(response.writes) == 6
+        print("  ✓ Disabled coalescing writes every event")
+    finally:
+        restore_settings(original)
+
+
+CONTENT = b"".join(sse({"content": f"t{i} "}) for i in range(8))
+STREAM = CONTENT + sse({}, finish_reason="stop") + b"data: [DONE]\n\n"
+
+
+async def burst_backend(request: web.Request):
+    response = web.StreamResponse(headers={'Content-Type': 'text/event-stream'})
+    await response.prepare(request)
+    await response.write(STREAM)
+    return response
+
+
+async def client_writes(**overrides):
+    original = override_settings(**overrides)
+    backend_app = web.Application()
+    backend_app.router.add_post('/v1/chat/completions', burst_backend)
+    backend = TestServer(backend_app)
+    await backend.start_server()
+    backend_pool.configure([str(backend.make_url('')).rstrip('/')])
+    app = web.Application()
+    app.cleanup_ctx.append(upstream_pool_ctx)
+    app.router.add_route("*", "/{tail:.*}", handle_request)
+    client = TestClient(TestServer(app))
+    await client.start_server()
+    writes = proxy_metrics.client_writes
+    try:
+        resp = await client.post('/v1/chat/completions', json={"model": "test", "stream": True})
+        body = await resp.read()
+        # Content passes through untouched; the finish event is re-serialized
+        assert body.startswith(CONTENT) and body.count(b"\n\n") == 10, body
+        assert body.endswith(b"data: [DONE]\n\n")
+        return proxy_metrics.client_writes - writes
+    finally:
+        await client.close()
+        await backend.close()
+        backend_pool.configure(call_patch_proxy.fix_engine.get_setting('backends'))
+        restore_settings(original)
+
+
+async def test_through_proxy():
+    """A burst of events reaches the client in a couple of writes"""
+    print("\nTesting coalescing through the proxy:")
+    coalesced = await client_writes()
+    separate = await client_writes(write_coalescing=False)
+    assert separate == 10 and coalesced <= 3, (coalesced, separate)
+    print(f"  ✓ 10 events in {coalesced} writes instead of {separate}")
+
+
+if __name__ == "__main__":
+    async def run_tests():
+        await test_writer()
+        await test_through_proxy()
+
+    try:
+        asyncio.run(run_tests())
+        print("\n🎉 All write coalescing tests passed!")
+    except AssertionError as e:
+        print(f"\n💥 Test failed: {e}")
+        sys.exit(1)
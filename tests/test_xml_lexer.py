@@ -0,0 +1,103 @@
+#!/usr/bin/env python3
+"""
+Test the streaming XML tool call lexer
+"""
+import sys
+import os
+import random
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from call_patch_proxy import XMLToolCallLexer, partial_tag_suffix
+
+XML_CALL = (
+    "<tool_call>\n<function=bash>\n<parameter=command>\nls -la\n</parameter>\n"
+    "<parameter=description>List files</parameter>\n</function>\n</tool_call>"
+)
+
+
+def test_call_split_at_every_boundary():
+    """The same call must be recognised however the stream is split"""
+    print("Testing XML lexer across delta boundaries:")
+    text = "Let me check the files.\n\n" + XML_CALL
+    rng = random.Random(7)
+    for _ in range(200):
+        lexer = XMLToolCallLexer()
+        completed = []
+        wrapper_spans = []
+        pos = 0
+        while pos < len(text):
+            step = rng.randint(1, 6)
+            completed += lexer.feed(text[pos:pos + step])
+            wrapper_spans += lexer.wrapper_spans
+            pos += step
+        function_end = text.index("</function>") + len("</function>")
+        assert completed == [{
+            "function_name": "bash",
+            "arguments": {"command": "ls -la", "description": "List files"},
+            "span": (text.index("<tool_call>"), function_end)
+        }], completed
+        assert wrapper_spans == [(function_end, len(text))], wrapper_spans
+        assert not lexer.in_tool_call
+    print("  ✓ 200 random splits produce the same tool call and <tool_call> wrapper spans")
+
+
+def test_emits_only_when_function_closes():
+    """Nothing is emitted until </function>, even after a parameter closes"""
+    print("\nTesting emission point:")
+    lexer = XMLToolCallLexer()
+    assert lexer.feed("<function=write><parameter=filePath>/tmp/a.py</parameter>") == []
+    assert lexer.in_tool_call
+    assert lexer.feed("<parameter=content>if a < b:\n    pass</parameter>") == []
+    completed = lexer.feed("</function>")
+    assert completed[0]["arguments"]["content"] == "if a < b:\n    pass"
+    print("  ✓ Call emitted on </function> with '<' preserved inside values")
+
+
+def test_prose_is_not_retained():
+    """Plain text is dropped, only a possible tag prefix is kept"""
+    print("\nTesting memory retention:")
+    lexer = XMLToolCallLexer()
+    for _ in range(10000):
+        lexer.feed("Some long reasoning text with a < comparison. ")
+    lexer.feed("Ending with <func")
+    assert lexer.held_size() == len("<func")
+    assert not lexer.in_tool_call
+    print(f"  ✓ Only {lexer.held_size()} chars held after ~460 KB of prose")
+
+
+def test_multiple_calls_and_reset():
+    """Several calls in one delta are all returned; reset drops partial state"""
+    print("\nTesting multiple calls and reset:")
+    lexer = XMLToolCallLexer()
+    completed = lexer.feed(
+        "<function=read><parameter=filePath>a.py</parameter></function>"
+        "<function=read><parameter=filePath>b.py</parameter></function>"
+        "<function=glob><parameter=pattern>*.py"
+    )
+    assert [c["arguments"]["filePath"] for c in completed] == ["a.py", "b.py"]
+    assert lexer.in_tool_call
+    lexer.reset()
+    assert not lexer.in_tool_call and lexer.held_size() == 0
+    print("  ✓ Two calls returned, partial third dropped on reset")
+
+
+def test_partial_tag_suffix():
+    print("\nTesting partial tag suffix:")
+    assert partial_tag_suffix("hello <fun", ("<function=",)) == "<fun"
+    assert partial_tag_suffix("hello <", ("<function=",)) == "<"
+    assert partial_tag_suffix("a < b", ("<function=",)) == ""
+    assert partial_tag_suffix("x </par", ("<parameter=", "</parameter>")) == "</par"
+    print("  ✓ Suffixes detected")
+
+
+if __name__ == "__main__":
+    try:
+        test_call_split_at_every_boundary()
+        test_emits_only_when_function_closes()
+        test_prose_is_not_retained()
+        test_multiple_calls_and_reset()
+        test_partial_tag_suffix()
+        print("\n🎉 All XML lexer tests passed!")
+    except AssertionError as e:
+        print(f"\n💥 Test failed: {e}")
+        sys.exit(1)